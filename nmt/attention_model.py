@@ -126,7 +126,8 @@ class AttentionModel(model.Model):
         dropout=hparams.dropout,
         num_gpus=self.num_gpus,
         mode=self.mode,
-        single_cell_fn=self.single_cell_fn)
+        single_cell_fn=self.single_cell_fn,
+        fused=hparams.use_fused_rnn)
 
     # Only generate alignment in greedy INFER mode.
     # 就是attention的注意力图
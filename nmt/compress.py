@@ -0,0 +1,427 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Compress a trained model with low-rank (SVD) factorizations.
+
+The embeddings and the output projection of a checkpoint are replaced by
+truncated SVD factorizations, and the result is written as a new model
+directory that the infer graph loads directly:
+
+  embedding [vocab, num_units]
+    -> embedding [vocab, rank] and embedding projection [rank, num_units],
+       i.e. a factorized embedding with embed_dim=rank.
+  output_projection/kernel [num_units, vocab]
+    -> kernel_in [num_units, rank] and kernel_out [rank, vocab],
+       with output_projection_rank=rank.
+
+The rank of each matrix is the smallest one keeping a fraction --energy of its
+squared singular values (the encoder and decoder embeddings share the larger
+of their two ranks, since embed_dim is shared). With --max_bleu_drop, the
+energies of --energies are tried from the smallest up and the first model
+within that BLEU drop on the dev set is kept. Size, decoding time and BLEU of
+the original and compressed models are printed and written to
+<compress_dir>/report.
+
+Usage:
+  python -m nmt.compress --out_dir=/tmp/nmt_model \
+      --compress_dir=/tmp/nmt_model_compressed --max_bleu_drop=0.5
+"""
+from __future__ import print_function
+
+import argparse
+import codecs
+import collections
+import os
+import re
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from . import inference
+from . import model_helper
+from .utils import misc_utils as utils
+from .utils import nmt_utils
+from .utils import standard_hparams_utils
+
+__all__ = ["choose_rank", "compress_variables", "load_serving_variables",
+           "save_variables", "load_model_hparams", "write_model", "evaluate",
+           "compress"]
+
+_EMBEDDING_NAMES = ("embedding_share", "embedding_encoder",
+                    "embedding_decoder")
+
+
+def choose_rank(singular_values, energy):
+  """Smallest rank keeping energy of the sum of squared singular values."""
+  energies = np.cumsum(np.square(singular_values))
+  rank = np.searchsorted(energies, energy * energies[-1]) + 1
+  return int(min(rank, len(singular_values)))
+
+
+def _svd(matrix):
+  return np.linalg.svd(matrix.astype(np.float64), full_matrices=False)
+
+
+def _get_embeddings(values):
+  """The [vocab, num_units] embeddings in values, with projections applied."""
+  embeddings = collections.OrderedDict()
+  for name, value in values.items():
+    if name.rsplit("/", 1)[-1] in _EMBEDDING_NAMES:
+      if name + "_projection" in values:
+        value = value.dot(values[name + "_projection"])
+      embeddings[name] = value
+  return embeddings
+
+
+def _get_output_projection(values):
+  """Name prefix and [num_units, vocab] kernel of the output projection."""
+  for name, value in values.items():
+    if name.endswith("output_projection/kernel"):
+      return name[:-len("kernel")], value
+    if name.endswith("output_projection/kernel_in"):
+      prefix = name[:-len("kernel_in")]
+      return prefix, value.dot(values[prefix + "kernel_out"])
+  # Tied with the target embedding.
+  return None, None
+
+
+def compress_variables(values, energy):
+  """Replace the embeddings and output projection by rank-r factorizations.
+
+  A matrix is only factorized if that makes it smaller.
+
+  Args:
+    values: An OrderedDict of variable names to numpy values.
+    energy: Fraction of the squared singular values to keep, in (0, 1].
+
+  Returns:
+    compressed_values: An OrderedDict of the compressed variables.
+    ranks: A dict of the hparams to update: embed_dim and
+      output_projection_rank, for the factorized matrices only.
+  """
+  compressed_values = collections.OrderedDict(values)
+  ranks = {}
+
+  embeddings = _get_embeddings(values)
+  if embeddings:
+    svds = dict((name, _svd(embedding))
+                for name, embedding in embeddings.items())
+    rank = max(choose_rank(s, energy) for _, s, _ in svds.values())
+    if sum(rank * sum(e.shape) for e in embeddings.values()) < sum(
+        e.size for e in embeddings.values()):
+      for name, (u, s, vt) in svds.items():
+        dtype = values[name].dtype
+        compressed_values[name] = (u[:, :rank] * s[:rank]).astype(dtype)
+        compressed_values[name + "_projection"] = vt[:rank].astype(dtype)
+      ranks["embed_dim"] = rank
+
+  prefix, kernel = _get_output_projection(values)
+  if kernel is not None:
+    u, s, vt = _svd(kernel)
+    rank = choose_rank(s, energy)
+    if rank * sum(kernel.shape) < kernel.size:
+      for name in ("kernel", "kernel_in", "kernel_out"):
+        compressed_values.pop(prefix + name, None)
+      compressed_values[prefix + "kernel_in"] = (
+          u[:, :rank] * s[:rank]).astype(kernel.dtype)
+      compressed_values[prefix + "kernel_out"] = vt[:rank].astype(kernel.dtype)
+      ranks["output_projection_rank"] = rank
+
+  return compressed_values, ranks
+
+
+def _get_infer_variable_names(hparams, scope=None):
+  """Names of the variables the infer graph restores from a checkpoint."""
+  infer_model = model_helper.create_infer_model(
+      inference.get_model_creator(hparams), hparams, scope)
+  with infer_model.graph.as_default():
+    # Partitioned variables are saved under the name of the whole variable.
+    return set(re.sub(r"/part_\d+$", "", v.op.name)
+               for v in tf.global_variables())
+
+
+def load_serving_variables(hparams, ckpt, scope=None):
+  """Load the variables of ckpt that the infer graph needs.
+
+  Optimizer slots and other training-only variables are left out.
+  """
+  names = _get_infer_variable_names(hparams, scope)
+  reader = tf.contrib.framework.load_checkpoint(ckpt)
+  values = collections.OrderedDict()
+  for name, _ in tf.contrib.framework.list_variables(ckpt):
+    if name in names:
+      values[name] = reader.get_tensor(name)
+  return values
+
+
+def save_variables(values, model_dir, global_step):
+  """Save values as a checkpoint of model_dir; returns its path."""
+  tf.gfile.MakeDirs(model_dir)
+  # Assigned through placeholders, so that the values are not graph
+  # constants.
+  with tf.Graph().as_default():
+    tf_vars = [
+        tf.get_variable(name, shape=value.shape, dtype=tf.as_dtype(value.dtype),
+                        initializer=tf.zeros_initializer())
+        for name, value in values.items()]
+    placeholders = [tf.placeholder(v.dtype, shape=v.shape) for v in tf_vars]
+    assign_ops = [tf.assign(v, p) for (v, p) in zip(tf_vars, placeholders)]
+    saver = tf.train.Saver(tf.global_variables())
+
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      for p, assign_op, value in zip(placeholders, assign_ops,
+                                     values.values()):
+        sess.run(assign_op, {p: value})
+      return saver.save(sess, os.path.join(model_dir, "translate.ckpt"),
+                        global_step=global_step)
+
+
+def evaluate(name, hparams, ckpt, src_file, ref_file, trans_file, scope=None):
+  """Decode src_file with ckpt.
+
+  Returns:
+    scores: A dict of the hparams.metrics scores against ref_file.
+    decode_time: Seconds spent decoding, excluding graph building and loading.
+  """
+  infer_model = model_helper.create_infer_model(
+      inference.get_model_creator(hparams), hparams, scope)
+  infer_data = inference.load_data(src_file)
+  with tf.Session(
+      graph=infer_model.graph, config=utils.get_config_proto()) as sess:
+    loaded_infer_model = model_helper.load_model(
+        infer_model.model, ckpt, sess, "infer")
+    sess.run(
+        infer_model.iterator.initializer,
+        feed_dict={
+            infer_model.src_placeholder: infer_data,
+            infer_model.batch_size_placeholder: hparams.infer_batch_size
+        })
+    start_time = time.time()
+    scores = nmt_utils.decode_and_evaluate(
+        name,
+        loaded_infer_model,
+        sess,
+        trans_file,
+        ref_file=ref_file,
+        metrics=hparams.metrics,
+        subword_option=hparams.subword_option,
+        beam_width=hparams.beam_width,
+        tgt_eos=hparams.eos)
+    return scores, time.time() - start_time
+
+
+def load_model_hparams(model_dir):
+  """Load the hparams of model_dir, with defaults for newer hparams."""
+  hparams = utils.load_hparams(model_dir)
+  if not hparams:
+    raise ValueError("No hparams in %s" % model_dir)
+  default_config = standard_hparams_utils.create_standard_hparams().values()
+  for key, value in default_config.items():
+    if key not in hparams.values():
+      hparams.add_hparam(key, value)
+  return hparams
+
+
+def _model_dir_hparams(hparams, model_dir, updates):
+  """A copy of hparams for a model in model_dir, with updated values."""
+  model_hparams = tf.contrib.training.HParams(**hparams.values())
+  model_hparams.out_dir = model_dir
+  for key, value in hparams.values().items():
+    if key.endswith("_dir") and "best_" in key:
+      best_metric_dir = os.path.join(model_dir, os.path.basename(value))
+      tf.gfile.MakeDirs(best_metric_dir)
+      setattr(model_hparams, key, best_metric_dir)
+  for key, value in updates.items():
+    setattr(model_hparams, key, value)
+  return model_hparams
+
+
+def write_model(hparams, values, updates, model_dir, global_step):
+  """Save values and hparams with updates as the model of model_dir.
+
+  Returns:
+    The hparams and checkpoint path of the new model.
+  """
+  model_hparams = _model_dir_hparams(hparams, model_dir, updates)
+  ckpt = save_variables(values, model_dir, global_step)
+  utils.save_hparams(model_dir, model_hparams)
+  return model_hparams, ckpt
+
+
+def _report_line(name, values, ranks, scores, decode_time, num_sents,
+                 metrics, base_scores):
+  num_params = sum(v.size for v in values.values())
+  num_bytes = sum(v.nbytes for v in values.values())
+  line = "%s\t%s\t%s\t%d\t%.1f" % (
+      name, ranks.get("embed_dim", "-"),
+      ranks.get("output_projection_rank", "-"), num_params,
+      num_bytes / 2.0 ** 20)
+  if scores is not None:
+    line += "\t%.2f" % (1000.0 * decode_time / num_sents)
+    for metric in metrics:
+      line += "\t%.2f\t%+.2f" % (scores[metric],
+                                 scores[metric] - base_scores[metric])
+  return line
+
+
+def compress(hparams,
+             ckpt,
+             compress_dir,
+             energies,
+             src_file=None,
+             ref_file=None,
+             max_bleu_drop=None,
+             scope=None):
+  """Compress ckpt into compress_dir.
+
+  Args:
+    hparams: Hparams of the model of ckpt.
+    ckpt: Checkpoint to compress.
+    compress_dir: Directory of the compressed model.
+    energies: Fractions of the squared singular values to keep. Without
+      max_bleu_drop, only the first one is used.
+    src_file: Optional dev source file to report the decoding time and
+      scores of each model on.
+    ref_file: Reference translations of src_file.
+    max_bleu_drop: If set, the smallest of energies whose model loses at
+      most this much of the first of hparams.metrics on the dev set is kept.
+    scope: VariableScope of the model.
+
+  Returns:
+    The path of the compressed checkpoint.
+  """
+  start_time = time.time()
+  metric = hparams.metrics[0]
+  if max_bleu_drop is not None:
+    if not src_file:
+      raise ValueError("max_bleu_drop needs a dev set")
+    energies = sorted(energies)
+  else:
+    energies = energies[:1]
+
+  values = load_serving_variables(hparams, ckpt, scope)
+  global_step = int(ckpt.rsplit("-", 1)[1])
+  utils.print_out("# Compressing %s into %s" % (ckpt, compress_dir))
+  tf.gfile.MakeDirs(compress_dir)
+
+  num_sents = None
+  base_scores = None
+  header = "model\tembed_dim\toutput_rank\tparams\tMB"
+  if src_file:
+    num_sents = len(inference.load_data(src_file))
+    base_scores, decode_time = evaluate(
+        "original", hparams, ckpt, src_file, ref_file,
+        os.path.join(compress_dir, "output_original"), scope)
+    header += "\tms/sent" + "".join(
+        "\t%s\tdelta" % metric_name for metric_name in hparams.metrics)
+  else:
+    decode_time = None
+  lines = [header, _report_line("original", values, {}, base_scores,
+                                decode_time, num_sents, hparams.metrics,
+                                base_scores)]
+
+  chosen = None
+  for energy in energies:
+    name = "energy_%g" % energy
+    compressed_values, ranks = compress_variables(values, energy)
+    utils.print_out("  %s: %s" % (name, ranks or "nothing to factorize"))
+    scores = decode_time = None
+    if src_file:
+      model_dir = os.path.join(compress_dir, "candidates", name)
+      model_hparams, model_ckpt = write_model(
+          hparams, compressed_values, ranks, model_dir, global_step)
+      scores, decode_time = evaluate(
+          name, model_hparams, model_ckpt, src_file, ref_file,
+          os.path.join(model_dir, "output_dev"), scope)
+    lines.append(_report_line(name, compressed_values, ranks, scores,
+                              decode_time, num_sents, hparams.metrics,
+                              base_scores))
+    if (max_bleu_drop is None or
+        base_scores[metric] - scores[metric] <= max_bleu_drop):
+      chosen = (name, compressed_values, ranks)
+      break
+
+  if chosen is None:
+    utils.print_out("  no model within a %s drop of %g, keeping energy %g" %
+                    (metric, max_bleu_drop, energies[-1]))
+    chosen = (name, compressed_values, ranks)
+  name, compressed_values, ranks = chosen
+  _, compressed_ckpt = write_model(
+      hparams, compressed_values, ranks, compress_dir, global_step)
+  lines.append("# kept %s" % name)
+
+  with codecs.getwriter("utf-8")(
+      tf.gfile.GFile(os.path.join(compress_dir, "report"), "wb")) as f:
+    f.write("\n".join(lines) + "\n")
+  utils.print_out("\n".join(lines))
+  utils.print_time("# Done compressing", start_time)
+  return compressed_ckpt
+
+
+def add_arguments(parser):
+  """Build ArgumentParser."""
+  parser.add_argument("--out_dir", type=str, required=True,
+                      help="Model directory to compress.")
+  parser.add_argument("--ckpt", type=str, default="",
+                      help="Checkpoint to compress, the latest by default.")
+  parser.add_argument("--compress_dir", type=str, required=True,
+                      help="Directory of the compressed model.")
+  parser.add_argument("--energy", type=float, default=0.9,
+                      help="""\
+      Fraction of the squared singular values each factorization keeps.\
+      """)
+  parser.add_argument("--max_bleu_drop", type=float, default=None,
+                      help="""\
+      If set, try each of --energies from the smallest and keep the first
+      model within this drop of the first metric on the dev set.\
+      """)
+  parser.add_argument("--energies", type=str,
+                      default="0.5,0.6,0.7,0.8,0.9,0.95,0.99",
+                      help="Comma-separated energies for --max_bleu_drop.")
+  parser.add_argument("--dev_prefix", type=str, default=None,
+                      help="""\
+      Dev set to report decoding time and scores on, the model's dev set by
+      default. Set to "" to only report sizes.\
+      """)
+
+
+def main(unused_argv=None):
+  parser = argparse.ArgumentParser()
+  add_arguments(parser)
+  flags = parser.parse_args()
+
+  hparams = load_model_hparams(flags.out_dir)
+  ckpt = flags.ckpt or tf.train.latest_checkpoint(flags.out_dir)
+
+  dev_prefix = hparams.dev_prefix if flags.dev_prefix is None else (
+      flags.dev_prefix)
+  src_file = ref_file = None
+  if dev_prefix:
+    src_file = utils.get_data_file(dev_prefix, hparams.src)
+    ref_file = utils.get_data_file(dev_prefix, hparams.tgt)
+
+  if flags.max_bleu_drop is None:
+    energies = [flags.energy]
+  else:
+    energies = [float(energy) for energy in flags.energies.split(",")]
+  compress(hparams, ckpt, flags.compress_dir, energies,
+           src_file=src_file, ref_file=ref_file,
+           max_bleu_drop=flags.max_bleu_drop)
+
+
+if __name__ == "__main__":
+  main()
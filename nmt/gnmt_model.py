@@ -56,7 +56,7 @@ class GNMTModel(attention_model.AttentionModel):
   def _build_encoder(self, hparams):
     """Build a GNMT encoder."""
     # 如果是uni或者 bi-direction,直接调用基类方法
-    if hparams.encoder_type == "uni" or hparams.encoder_type == "bi":
+    if hparams.encoder_type in ("uni", "bi", "transformer"):
       return super(GNMTModel, self)._build_encoder(hparams)
 
     # 注意,对于gnmt,encoder部分也要重写
@@ -79,8 +79,7 @@ class GNMTModel(attention_model.AttentionModel):
 
       # Look up embedding, emp_inp: [max_time, batch_size, num_units]
       #   when time_major = True
-      encoder_emb_inp = tf.nn.embedding_lookup(self.embedding_encoder,
-                                               source)
+      encoder_emb_inp = self._embed_source(source)
 
       # Execute _build_bidirectional_rnn from Model class
       # 调用基类的双向rnn
@@ -107,18 +106,6 @@ class GNMTModel(attention_model.AttentionModel):
           num_bi_residual_layers=0,  # no residual connection
       )
 
-      uni_encoder_cell = model_helper.create_rnn_cell(
-          unit_type=hparams.unit_type,
-          num_units=hparams.num_units,
-          num_layers=num_uni_layers,
-          num_residual_layers=self.num_encoder_residual_layers,
-          forget_bias=hparams.forget_bias,
-          dropout=hparams.dropout,
-          num_gpus=self.num_gpus,
-          base_gpu=1,
-          mode=self.mode,
-          single_cell_fn=self.single_cell_fn)
-
       # encoder_outputs: size [max_time, batch_size, num_units]
       #   when time_major = True
       """
@@ -132,12 +119,40 @@ class GNMTModel(attention_model.AttentionModel):
       2.将bi_encoder_outputs输入到encoder中(普通的模型直接将input_embedding输入encoder)
       3.将bi-lstm的第1层以及所有的encoder state作为全部的state
       """
-      encoder_outputs, encoder_state = tf.nn.dynamic_rnn(
-          cell=uni_encoder_cell,
-          inputs=bi_encoder_outputs,
-          dtype=dtype,
-          sequence_length=iterator.source_sequence_length,
-          time_major=self.time_major)
+      if self._use_fused_encoder(hparams):
+        with tf.variable_scope("rnn"):
+          encoder_outputs, encoder_state = model_helper.run_fused_rnn(
+              hparams.unit_type,
+              bi_encoder_outputs,
+              iterator.source_sequence_length,
+              num_units=hparams.num_units,
+              num_layers=num_uni_layers,
+              num_residual_layers=self.num_encoder_residual_layers,
+              forget_bias=hparams.forget_bias,
+              dropout=hparams.dropout,
+              mode=self.mode,
+              num_gpus=self.num_gpus,
+              base_gpu=1,
+              dtype=dtype)
+      else:
+        uni_encoder_cell = model_helper.create_rnn_cell(
+            unit_type=hparams.unit_type,
+            num_units=hparams.num_units,
+            num_layers=num_uni_layers,
+            num_residual_layers=self.num_encoder_residual_layers,
+            forget_bias=hparams.forget_bias,
+            dropout=hparams.dropout,
+            num_gpus=self.num_gpus,
+            base_gpu=1,
+            mode=self.mode,
+            single_cell_fn=self.single_cell_fn,
+            fused=hparams.use_fused_rnn)
+        encoder_outputs, encoder_state = tf.nn.dynamic_rnn(
+            cell=uni_encoder_cell,
+            inputs=bi_encoder_outputs,
+            dtype=dtype,
+            sequence_length=iterator.source_sequence_length,
+            time_major=self.time_major)
 
       # Pass all encoder state except the first bi-directional layer's state to
       # decoder.
@@ -192,6 +207,7 @@ class GNMTModel(attention_model.AttentionModel):
         num_gpus=self.num_gpus,
         mode=self.mode,
         single_cell_fn=self.single_cell_fn,
+        fused=hparams.use_fused_rnn,
         residual_fn=gnmt_residual_fn
     )
 
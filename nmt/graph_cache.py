@@ -0,0 +1,219 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Cache the train/eval/infer graphs as MetaGraphs in out_dir.
+
+Building a graph in python (seq2seq decoders, attention wrappers, beam
+search) takes a while and gives the same graph for the same hparams. The
+first run exports each graph to <out_dir>/graph_cache/<name>_<fingerprint>,
+where the fingerprint is a hash of the hparams that determine the graph, and
+later runs import it instead of building it. Any change in those hparams
+changes the fingerprint, so the graph is then built again.
+"""
+from __future__ import print_function
+
+import codecs
+import hashlib
+import json
+import os
+import time
+
+import tensorflow as tf
+# Register the contrib ops (fused LSTM cells, the GatherTree of beam search),
+# which import_meta_graph can't resolve before their modules are loaded.
+# pylint: disable=unused-import
+from tensorflow.contrib import rnn as contrib_rnn
+from tensorflow.contrib import seq2seq as contrib_seq2seq
+# pylint: enable=unused-import
+
+from . import model as nmt_model
+from . import model_helper
+from .utils import iterator_utils
+from .utils import misc_utils as utils
+
+__all__ = ["get_fingerprint", "CachedModel", "create_model"]
+
+# Hparams read by the train loop, evals and logging only, or updated during
+# training, which do not change the graph.
+_NON_GRAPH_HPARAMS = (
+    "out_dir", "dev_prefix", "test_prefix", "steps_per_stats",
+    "steps_per_external_eval", "steps_per_epoch", "epoch_step", "metrics",
+    "subword_option", "avg_ckpts", "eval_time_fraction", "eval_sets",
+    "eval_subset_size", "full_eval_every", "best_metric_source",
+    "override_loaded_hparams", "lazy_graph_build", "cache_graphs",
+    "log_device_placement", "num_intra_threads", "num_inter_threads")
+_NON_GRAPH_HPARAM_PREFIXES = ("best_", "avg_best_")
+
+# Errors of a missing, partial or incompatible cache.
+_CACHE_ERRORS = (IOError, OSError, KeyError, ValueError, tf.errors.OpError)
+
+# Model attributes used to train, eval and decode with a model.
+_MODEL_ATTRIBUTES = ("update", "train_loss", "predict_count", "train_summary",
+                     "global_step", "word_count", "batch_size", "grad_norm",
+                     "learning_rate", "eval_loss", "infer_logits",
+                     "infer_summary", "sample_id", "sample_words")
+
+# Ops that call back into python and cannot be imported in a new process.
+_PY_FUNC_OPS = ("PyFunc", "PyFuncStateless", "EagerPyFunc")
+
+
+def get_fingerprint(hparams, *extra_keys):
+  """Hash of the hparams and extra_keys that determine a graph."""
+  values = dict(
+      (name, value) for name, value in hparams.values().items()
+      if name not in _NON_GRAPH_HPARAMS and
+      not name.startswith(_NON_GRAPH_HPARAM_PREFIXES))
+  if not hparams.decay_scheme:
+    # Only a learning rate decay starts at a step computed from it.
+    values.pop("num_train_steps", None)
+  key = json.dumps([values] + list(extra_keys), sort_keys=True, default=str)
+  return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+class CachedModel(nmt_model.BaseModel):
+  """A model imported from a cached MetaGraph.
+
+  It exposes the tensors used by BaseModel.train, eval and decode, so it can
+  be used in place of the model it was exported from.
+  """
+
+  def __init__(self, hparams, mode, iterator, tensors, saver):
+    # pylint: disable=super-init-not-called
+    self.mode = mode
+    self.iterator = iterator
+    self.time_major = hparams.time_major
+    for name, tensor in tensors.items():
+      setattr(self, name, tensor)
+    self.saver = saver
+
+
+def _is_cacheable(graph):
+  """Whether the graph can be exported and imported in another process."""
+  graph_def = graph.as_graph_def()
+  nodes = list(graph_def.node)
+  for function in graph_def.library.function:
+    nodes.extend(function.node_def)
+  return not any(node.op in _PY_FUNC_OPS for node in nodes)
+
+
+def _get_element_names(model_tuple):
+  """Map the fields of model_tuple to the names of their tensors/ops."""
+  names = {}
+  for field, value in model_tuple._asdict().items():
+    if field not in ("graph", "model", "iterator"):
+      names[field] = value.name
+  for field, value in model_tuple.iterator._asdict().items():
+    if value is not None:
+      names["iterator/" + field] = value.name
+  for attribute in _MODEL_ATTRIBUTES:
+    value = getattr(model_tuple.model, attribute, None)
+    if value is not None:
+      names["model/" + attribute] = value.name
+  return names
+
+
+def _export(model_tuple, cache_path):
+  """Write the graph of model_tuple and its element names to cache_path."""
+  tf.train.export_meta_graph(
+      filename=cache_path + ".meta",
+      graph=model_tuple.graph,
+      saver_def=model_tuple.model.saver.as_saver_def())
+  # The names are written last, their presence marks a complete export.
+  with codecs.getwriter("utf-8")(
+      tf.gfile.GFile(cache_path + ".json", "wb")) as f:
+    f.write(json.dumps(_get_element_names(model_tuple)))
+
+
+def _import(model_tuple_class, hparams, mode, cache_path):
+  """Rebuild a model tuple from the graph exported to cache_path."""
+  with codecs.getreader("utf-8")(
+      tf.gfile.GFile(cache_path + ".json", "rb")) as f:
+    names = json.load(f)
+
+  graph = tf.Graph()
+  with graph.as_default():
+    saver = tf.train.import_meta_graph(cache_path + ".meta")
+    elements = dict((key, graph.as_graph_element(name))
+                    for key, name in names.items())
+
+  iterator = iterator_utils.BatchedInput(**dict(
+      (field, elements.get("iterator/" + field))
+      for field in iterator_utils.BatchedInput._fields))
+  tensors = dict((attribute, elements["model/" + attribute])
+                 for attribute in _MODEL_ATTRIBUTES
+                 if "model/" + attribute in elements)
+  model = CachedModel(hparams, mode, iterator, tensors, saver)
+
+  fields = dict((field, elements.get(field))
+                for field in model_tuple_class._fields)
+  fields.update(graph=graph, model=model, iterator=iterator)
+  return model_tuple_class(**fields)
+
+
+_MODEL_TUPLES = {
+    "train": (model_helper.TrainModel, tf.contrib.learn.ModeKeys.TRAIN),
+    "eval": (model_helper.EvalModel, tf.contrib.learn.ModeKeys.EVAL),
+    "infer": (model_helper.InferModel, tf.contrib.learn.ModeKeys.INFER),
+}
+
+
+def create_model(create_fn, model_creator, hparams, name, scope=None):
+  """Import the graph of create_fn from the cache, or build and cache it.
+
+  Args:
+    create_fn: model_helper.create_train_model, create_eval_model or
+      create_infer_model.
+    model_creator: the model class, part of the fingerprint.
+    hparams: hyperparameters, the graph is cached under their fingerprint.
+    name: "train", "eval" or "infer".
+    scope: variable scope of the model.
+
+  Returns:
+    The TrainModel, EvalModel or InferModel returned by create_fn, or an
+    equivalent one imported from the cache.
+  """
+  model_tuple_class, mode = _MODEL_TUPLES[name]
+  extra_keys = [name, model_creator.__name__, scope]
+  if name == "train":
+    # The train files are listed in the graph, and a glob may match new
+    # shards with the same hparams.
+    extra_keys.append(model_helper.get_train_files(hparams))
+  cache_dir = os.path.join(hparams.out_dir, "graph_cache")
+  cache_path = os.path.join(
+      cache_dir, "%s_%s" % (name, get_fingerprint(hparams, *extra_keys)))
+
+  start_time = time.time()
+  if tf.gfile.Exists(cache_path + ".json"):
+    try:
+      model_tuple = _import(model_tuple_class, hparams, mode, cache_path)
+      utils.print_out("  imported %s graph from %s, time %.2fs" %
+                      (name, cache_path, time.time() - start_time))
+      return model_tuple
+    except _CACHE_ERRORS as e:
+      utils.print_out("  can't import %s graph from %s, rebuilding: %s: %s" %
+                      (name, cache_path, type(e).__name__, e))
+
+  model_tuple = create_fn(model_creator, hparams, scope)
+  if not _is_cacheable(model_tuple.graph):
+    utils.print_out("  %s graph calls python functions, not caching it" % name)
+    return model_tuple
+  try:
+    tf.gfile.MakeDirs(cache_dir)
+    _export(model_tuple, cache_path)
+    utils.print_out("  cached %s graph to %s" % (name, cache_path))
+  except _CACHE_ERRORS as e:
+    utils.print_out("  can't cache %s graph: %s: %s" %
+                    (name, type(e).__name__, e))
+  return model_tuple
@@ -28,7 +28,7 @@ from . import model_helper
 from .utils import misc_utils as utils
 from .utils import nmt_utils
 
-__all__ = ["load_data", "inference",
+__all__ = ["load_data", "get_model_creator", "inference",
            "single_worker_inference", "multi_worker_inference"]
 
 
@@ -42,7 +42,7 @@ def _decode_inference_indices(model, sess, output_infer,
                   (output_infer, len(inference_indices)))
   start_time = time.time()
   with codecs.getwriter("utf-8")(
-      tf.gfile.GFile(output_infer, mode="wb")) as trans_f:
+      utils.open_file(output_infer, mode="wb")) as trans_f:
     trans_f.write("")  # Write empty string to ensure file is created.
     for decode_id in inference_indices:
       nmt_outputs, infer_summary = model.decode(sess)
@@ -71,7 +71,7 @@ def _decode_inference_indices(model, sess, output_infer,
 def load_data(inference_input_file, hparams=None):
   """Load inference data."""
   with codecs.getreader("utf-8")(
-      tf.gfile.GFile(inference_input_file, mode="rb")) as f:
+      utils.open_file(inference_input_file, mode="rb")) as f:
     inference_data = f.read().splitlines()
 
   if hparams and hparams.inference_indices:
@@ -80,6 +80,18 @@ def load_data(inference_input_file, hparams=None):
   return inference_data
 
 
+def get_model_creator(hparams):
+  """Get the model class for the architecture in hparams."""
+  if not hparams.attention:
+    return nmt_model.Model
+  elif hparams.attention_architecture == "standard":
+    return attention_model.AttentionModel
+  elif hparams.attention_architecture in ["gnmt", "gnmt_v2"]:
+    return gnmt_model.GNMTModel
+  else:
+    raise ValueError("Unknown model architecture")
+
+
 def inference(ckpt,
               inference_input_file,
               inference_output_file,
@@ -91,14 +103,7 @@ def inference(ckpt,
   if hparams.inference_indices:
     assert num_workers == 1
 
-  if not hparams.attention:
-    model_creator = nmt_model.Model
-  elif hparams.attention_architecture == "standard":
-    model_creator = attention_model.AttentionModel
-  elif hparams.attention_architecture in ["gnmt", "gnmt_v2"]:
-    model_creator = gnmt_model.GNMTModel
-  else:
-    raise ValueError("Unknown model architecture")
+  model_creator = get_model_creator(hparams)
   infer_model = model_helper.create_infer_model(model_creator, hparams, scope)
 
   if num_workers == 1:
@@ -218,9 +223,10 @@ def multi_worker_inference(infer_model,
     # Job 0 is responsible for the clean up.
     if jobid != 0: return
 
-    # Now write all translations
+    # Now write all translations, compressing them if the output file name
+    # asks for it. Per-worker files are always written uncompressed.
     with codecs.getwriter("utf-8")(
-        tf.gfile.GFile(final_output_infer, mode="wb")) as final_f:
+        utils.open_file(final_output_infer, mode="wb")) as final_f:
       for worker_id in range(num_workers):
         worker_infer_done = "%s_done_%d" % (inference_output_file, worker_id)
         while not tf.gfile.Exists(worker_infer_done):
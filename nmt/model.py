@@ -30,11 +30,89 @@ from . import model_helper
 from .utils import iterator_utils
 from .utils import misc_utils as utils
 
-utils.check_tensorflow_version()
-
 __all__ = ["BaseModel", "Model"]
 
 
+def _apply_to_last_dim(fn, inputs, units):
+  """Apply fn to inputs reshaped to [N, num_units]; [..., units] outputs."""
+  num_units = inputs.get_shape()[-1].value
+  outputs = fn(tf.reshape(inputs, [-1, num_units]))
+  outputs = tf.reshape(outputs, tf.concat([tf.shape(inputs)[:-1], [units]], 0))
+  outputs.set_shape(inputs.get_shape()[:-1].concatenate(units))
+  return outputs
+
+
+class _TiedOutputProjection(layers_core.Dense):
+  """Output projection whose kernel is the transpose of the target embedding.
+
+  The logits are the dot products of the outputs with the embedding rows, so
+  the layer has no variable of its own. The outputs of a factorized embedding
+  are first projected back to embed_size by the transposed embedding
+  projection.
+  """
+
+  def __init__(self, embedding, projection=None, name="output_projection"):
+    super(_TiedOutputProjection, self).__init__(
+        embedding.get_shape()[0].value, use_bias=False, name=name)
+    self.embedding = embedding
+    self.projection = projection
+
+  @property
+  def kernel(self):
+    if self.projection is None:
+      return tf.transpose(self.embedding)
+    return tf.matmul(self.projection, self.embedding,
+                     transpose_a=True, transpose_b=True)
+
+  def build(self, input_shape):
+    self.built = True
+
+  def project_to_embedding(self, inputs):
+    """[N, num_units] outputs to the [N, embed_size] space of the embedding."""
+    if self.projection is None:
+      return inputs
+    return tf.matmul(inputs, self.projection, transpose_b=True)
+
+  def call(self, inputs):
+    # matmul with transpose_b reads the embedding in place, while tensordot
+    # with the kernel would copy the [vocab, num_units] matrix every step.
+    return _apply_to_last_dim(
+        lambda x: tf.matmul(self.project_to_embedding(x),
+                            tf.convert_to_tensor(self.embedding),
+                            transpose_b=True),
+        inputs, self.units)
+
+
+class _LowRankOutputProjection(layers_core.Dense):
+  """Output projection with a rank-factorized kernel.
+
+  The [num_units, vocab] kernel is the product of kernel_in [num_units, rank]
+  and kernel_out [rank, vocab], as written by compress.py.
+  """
+
+  def __init__(self, units, rank, name="output_projection"):
+    super(_LowRankOutputProjection, self).__init__(
+        units, use_bias=False, name=name)
+    self.rank = rank
+
+  @property
+  def kernel(self):
+    return tf.matmul(self.kernel_in, self.kernel_out)
+
+  def build(self, input_shape):
+    num_units = tf.TensorShape(input_shape)[-1].value
+    self.kernel_in = self.add_variable(
+        "kernel_in", shape=[num_units, self.rank], dtype=self.dtype)
+    self.kernel_out = self.add_variable(
+        "kernel_out", shape=[self.rank, self.units], dtype=self.dtype)
+    self.built = True
+
+  def call(self, inputs):
+    return _apply_to_last_dim(
+        lambda x: tf.matmul(tf.matmul(x, self.kernel_in), self.kernel_out),
+        inputs, self.units)
+
+
 class BaseModel(object):
   """Sequence-to-sequence base class.
   """
@@ -108,8 +186,15 @@ class BaseModel(object):
     """
     with tf.variable_scope(scope or "build_network"):
       with tf.variable_scope("decoder/output_projection"):
-        self.output_layer = layers_core.Dense(
-            hparams.tgt_vocab_size, use_bias=False, name="output_projection")
+        if hparams.tie_embeddings:
+          self.output_layer = _TiedOutputProjection(
+              self.embedding_decoder, projection=self.decoder_emb_projection)
+        elif hparams.output_projection_rank:
+          self.output_layer = _LowRankOutputProjection(
+              hparams.tgt_vocab_size, hparams.output_projection_rank)
+        else:
+          self.output_layer = layers_core.Dense(
+              hparams.tgt_vocab_size, use_bias=False, name="output_projection")
 
     ## Train graph
     res = self.build_graph(hparams, scope=scope)
@@ -149,6 +234,10 @@ class BaseModel(object):
         tf.summary.scalar("lr", self.learning_rate)
       elif hparams.optimizer == "adam":
         opt = tf.train.AdamOptimizer(self.learning_rate)
+      elif hparams.optimizer == "lazy_adam":
+        # Sparse gradients (embeddings) only update the Adam slots of the
+        # rows in the batch, instead of decaying every row at every step.
+        opt = tf.contrib.opt.LazyAdamOptimizer(self.learning_rate)
 
       # Gradients
       gradients = tf.gradients(
@@ -234,6 +323,9 @@ class BaseModel(object):
                                          start_decay_step,
                                          decay_steps,
                                          decay_factor))
+    if not hparams.decay_scheme:
+      # Keeps num_train_steps out of the graph, see graph_cache.
+      return self.learning_rate
 
     return tf.cond(
         self.global_step < start_decay_step,
@@ -245,34 +337,63 @@ class BaseModel(object):
         name="learning_rate_decay_cond")
 
   def init_embeddings(self, hparams, scope):
-    """Init embeddings."""
+    """Init embeddings.
+
+    With embed_dim smaller than num_units, the embeddings are factorized: a
+    [vocab_size, embed_dim] table followed by a [embed_dim, num_units]
+    projection, which _embed_source and _embed_target apply.
+    """
+    embed_size = hparams.embed_dim or hparams.num_units
     self.embedding_encoder, self.embedding_decoder = (
         model_helper.create_emb_for_encoder_and_decoder(
             share_vocab=hparams.share_vocab,
             src_vocab_size=self.src_vocab_size,
             tgt_vocab_size=self.tgt_vocab_size,
-            src_embed_size=hparams.num_units,
-            tgt_embed_size=hparams.num_units,
+            src_embed_size=embed_size,
+            tgt_embed_size=embed_size,
             num_partitions=hparams.num_embeddings_partitions,
             src_vocab_file=hparams.src_vocab_file,
             tgt_vocab_file=hparams.tgt_vocab_file,
             src_embed_file=hparams.src_embed_file,
             tgt_embed_file=hparams.tgt_embed_file,
+            train_tgt_embed=hparams.tie_embeddings,
             scope=scope,
         )
     )
+    self.encoder_emb_projection, self.decoder_emb_projection = (
+        model_helper.create_emb_projections(
+            share_vocab=hparams.share_vocab,
+            embed_size=embed_size,
+            num_units=hparams.num_units,
+            scope=scope,
+        )
+    )
+
+  def _embed_source(self, ids):
+    """Source embeddings of ids, [ids shape, num_units]."""
+    return model_helper.embedding_lookup(
+        self.embedding_encoder, ids, projection=self.encoder_emb_projection)
+
+  def _embed_target(self, ids):
+    """Target embeddings of ids, [ids shape, num_units]."""
+    return model_helper.embedding_lookup(
+        self.embedding_decoder, ids, projection=self.decoder_emb_projection)
 
   def train(self, sess):
     assert self.mode == tf.contrib.learn.ModeKeys.TRAIN
-    return sess.run([self.update,
-                     self.train_loss,
-                     self.predict_count,
-                     self.train_summary,
-                     self.global_step,
-                     self.word_count,
-                     self.batch_size,
-                     self.grad_norm,
-                     self.learning_rate])
+    fetches = [self.update,
+               self.train_loss,
+               self.predict_count,
+               self.train_summary,
+               self.global_step,
+               self.word_count,
+               self.batch_size,
+               self.grad_norm,
+               self.learning_rate]
+    # Pairs per corpus in this batch, when training on a mixture.
+    if self.iterator.source_counts is not None:
+      fetches.append(self.iterator.source_counts)
+    return sess.run(fetches)
 
   def eval(self, sess):
     assert self.mode == tf.contrib.learn.ModeKeys.EVAL
@@ -317,7 +438,7 @@ class BaseModel(object):
         with tf.device(model_helper.get_device_str(self.num_encoder_layers - 1,
                                                    self.num_gpus)):
           # train阶段需要计算loss
-          loss = self._compute_loss(logits)
+          loss = self._compute_loss(logits, hparams)
       else:
         loss = None
 
@@ -351,7 +472,8 @@ class BaseModel(object):
         num_gpus=hparams.num_gpus,
         mode=self.mode,
         base_gpu=base_gpu,
-        single_cell_fn=self.single_cell_fn)
+        single_cell_fn=self.single_cell_fn,
+        fused=hparams.use_fused_rnn)
 
   def _get_infer_maximum_iterations(self, hparams, source_sequence_length):
     """Maximum decoding steps at inference time."""
@@ -378,6 +500,8 @@ class BaseModel(object):
     Returns:
       A tuple of final logits and final decoder state:
         logits: size [time, batch_size, vocab_size] when time_major=True.
+          With a sampled softmax in TRAIN mode or a chunked loss, the
+          decoder outputs before the output projection instead.
     """
     # 将 word -> id
     tgt_sos_id = tf.cast(self.tgt_vocab_table.lookup(tf.constant(hparams.sos)),
@@ -405,16 +529,16 @@ class BaseModel(object):
         if self.time_major:
           # target_input:[max_time, batch_size]
           target_input = tf.transpose(target_input)
-        # embedding_decoder: [vocab_size, embedding_size=(num_units)]
+        # embedding_decoder: [vocab_size, embedding_size], projected to num_units
         # decoder_emp_inp: [max_time, batch_size, num_units]
-        decoder_emb_inp = tf.nn.embedding_lookup(self.embedding_decoder, target_input)
+        decoder_emb_inp = self._embed_target(target_input)
 
         """
         By separating out decoders and helpers, we can reuse different codebases, 
         e.g., TrainingHelper can be substituted with GreedyEmbeddingHelper to do greedy decoding.
         """
         # Helper
-        # decoder_embed_inp: [max_time, batch, num_units=embedding_size]
+        # decoder_embed_inp: [max_time, batch, num_units]
         # sequence_length: [batch]
         helper = tf.contrib.seq2seq.TrainingHelper(
             inputs = decoder_emb_inp,
@@ -452,8 +576,16 @@ class BaseModel(object):
         #   10% improvements for small models & 20% for larger ones.
         # If memory is a concern, we should apply output_layer per timestep.
 
-        # logits: [batch_size, decoder_targets_length, vocab_size]
-        logits = self.output_layer(decoder_outputs.rnn_output)
+        if (self._use_sampled_softmax(hparams) or
+            self._use_chunked_loss(hparams)):
+          # The loss projects the outputs itself, on a few columns of the
+          # output projection or a few time steps at a time, so the
+          # projection is built but not applied.
+          self.output_layer.build(decoder_outputs.rnn_output.get_shape())
+          logits = decoder_outputs.rnn_output
+        else:
+          # logits: [batch_size, decoder_targets_length, vocab_size]
+          logits = self.output_layer(decoder_outputs.rnn_output)
 
       ## Inference
       else:
@@ -467,7 +599,7 @@ class BaseModel(object):
           # beam search
           my_decoder = tf.contrib.seq2seq.BeamSearchDecoder(
               cell=cell,
-              embedding=self.embedding_decoder,
+              embedding=self._embed_target,
               start_tokens=start_tokens,
               end_token=end_token,
               initial_state=decoder_initial_state, # decoder时,输入的初始化状态
@@ -489,7 +621,7 @@ class BaseModel(object):
             Must be strictly greater than 0. Defaults to 1.0.
             """
             helper = tf.contrib.seq2seq.SampleEmbeddingHelper(
-                embedding=self.embedding_decoder,
+                embedding=self._embed_target,
                 start_tokens=start_tokens, # int32 vector shaped [batch_size], the start tokens.
                 end_token=end_token, # int32 scalar, the token that marks end of decoding.
                 softmax_temperature=sampling_temperature,
@@ -504,7 +636,7 @@ class BaseModel(object):
             One heuristic is to decode up to two times the source sentence lengths.
             """
             helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(
-                embedding=self.embedding_decoder,
+                embedding=self._embed_target,
                 start_tokens=start_tokens, # int32 vector shaped [batch_size], the start tokens.
                 end_token=end_token) # int32 scalar, the token that marks end of decoding.
 
@@ -559,7 +691,45 @@ class BaseModel(object):
     """
     pass
 
-  def _compute_loss(self, logits):
+  def _use_sampled_softmax(self, hparams):
+    return (self.mode == tf.contrib.learn.ModeKeys.TRAIN and
+            hparams.num_sampled_softmax > 0)
+
+  def _use_chunked_loss(self, hparams):
+    return (self.mode != tf.contrib.learn.ModeKeys.INFER and
+            hparams.loss_chunk_size > 0 and
+            not self._use_sampled_softmax(hparams))
+
+  def _sampled_softmax_crossent(self, outputs, target_output, hparams):
+    """Sampled softmax cross entropy of the decoder outputs.
+
+    Only the columns of the output projection of the targets and of
+    num_sampled_softmax words drawn from a log-uniform (Zipfian) distribution
+    are computed, which assumes the vocab file is sorted by frequency.
+    """
+    num_units = outputs.get_shape()[-1].value
+    inputs = tf.reshape(outputs, [-1, num_units])
+    output_layer = self.output_layer
+    if hparams.tie_embeddings:
+      # Rows of the embedding, whose gradients are IndexedSlices.
+      inputs = output_layer.project_to_embedding(inputs)
+      gather_weights = lambda ids: tf.gather(self.embedding_decoder, ids)
+    elif hparams.output_projection_rank:
+      gather_weights = lambda ids: tf.matmul(
+          tf.gather(output_layer.kernel_out, ids, axis=1),
+          output_layer.kernel_in, transpose_a=True, transpose_b=True)
+    else:
+      # Columns of the [num_units, vocab] kernel, which is not transposed.
+      gather_weights = lambda ids: tf.transpose(
+          tf.gather(output_layer.kernel, ids, axis=1))
+    crossent = model_helper.sampled_softmax_cross_entropy(
+        inputs, gather_weights, target_output,
+        num_sampled=hparams.num_sampled_softmax,
+        num_classes=self.tgt_vocab_size,
+        seed=hparams.random_seed)
+    return tf.reshape(crossent, tf.shape(target_output))
+
+  def _compute_loss(self, logits, hparams):
     """Compute optimization loss."""
     # target_output:[batch, max_time]
     target_output = self.iterator.target_output
@@ -583,7 +753,6 @@ class BaseModel(object):
     
     google的这段注释的确精辟
     """
-    crossent = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=target_output, logits=logits)
     # target_sequence_length:[batch, target_sequence_length]
     # target_sequence_mask:[batch, max_target_sequence_length]
     target_weights = tf.sequence_mask(
@@ -593,6 +762,22 @@ class BaseModel(object):
     if self.time_major:
       target_weights = tf.transpose(target_weights)
 
+    if self._use_chunked_loss(hparams):
+      # The [time, batch, vocab] logits only exist loss_chunk_size steps at a
+      # time, in the forward and in the backward pass.
+      if not self.time_major:
+        logits = tf.transpose(logits, [1, 0, 2])
+        target_output = tf.transpose(target_output)
+        target_weights = tf.transpose(target_weights)
+      return model_helper.chunked_softmax_cross_entropy(
+          logits, self.output_layer.kernel, target_output, target_weights,
+          hparams.loss_chunk_size) / tf.to_float(self.batch_size)
+
+    if self._use_sampled_softmax(hparams):
+      crossent = self._sampled_softmax_crossent(logits, target_output, hparams)
+    else:
+      crossent = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=target_output, logits=logits)
+
     loss = tf.reduce_sum(input_tensor=crossent * target_weights, axis=None) / tf.to_float(self.batch_size)
     return loss
 
@@ -653,24 +838,40 @@ class Model(BaseModel):
       # Look up embedding
       # embedding_encoder: [src_vocab_size, embedding_size]
       # source: [max_time, batch_size]
-      # encoder_emp_inp: [max_time, batch_size, embedding_size]
-      encoder_emb_inp = tf.nn.embedding_lookup(params=self.embedding_encoder, ids=source)
+      # encoder_emp_inp: [max_time, batch_size, num_units]
+      encoder_emb_inp = self._embed_source(source)
 
       # Encoder_outputs: [max_time, batch_size, num_units]
       if hparams.encoder_type == "uni": # 单向
         utils.print_out("  num_layers = %d, num_residual_layers=%d" %
                         (num_layers, num_residual_layers))
-        cell = self._build_encoder_cell(
-            hparams, num_layers, num_residual_layers)
-        # encoder_output:[batch, source_sequence_length, hidden_size]
-        # encoder_state:[hidden=[batch, hidden_size], cell=[batch, hidden_size]]
-        encoder_outputs, encoder_state = tf.nn.dynamic_rnn(
-            cell=cell,
-            inputs=encoder_emb_inp,
-            dtype=dtype,
-            sequence_length=iterator.source_sequence_length,
-            time_major=self.time_major,
-            swap_memory=True)
+        if self._use_fused_encoder(hparams):
+          # Same variables as dynamic_rnn below.
+          with tf.variable_scope("rnn"):
+            encoder_outputs, encoder_state = model_helper.run_fused_rnn(
+                hparams.unit_type,
+                encoder_emb_inp,
+                iterator.source_sequence_length,
+                num_units=hparams.num_units,
+                num_layers=num_layers,
+                num_residual_layers=num_residual_layers,
+                forget_bias=hparams.forget_bias,
+                dropout=hparams.dropout,
+                mode=self.mode,
+                num_gpus=self.num_gpus,
+                dtype=dtype)
+        else:
+          cell = self._build_encoder_cell(
+              hparams, num_layers, num_residual_layers)
+          # encoder_output:[batch, source_sequence_length, hidden_size]
+          # encoder_state:[hidden=[batch, hidden_size], cell=[batch, hidden_size]]
+          encoder_outputs, encoder_state = tf.nn.dynamic_rnn(
+              cell=cell,
+              inputs=encoder_emb_inp,
+              dtype=dtype,
+              sequence_length=iterator.source_sequence_length,
+              time_major=self.time_major,
+              swap_memory=True)
       elif hparams.encoder_type == "bi": # 双向
         num_bi_layers = int(num_layers / 2)
         num_bi_residual_layers = int(num_residual_layers / 2)
@@ -701,6 +902,24 @@ class Model(BaseModel):
             encoder_state.append(bi_encoder_state[1][layer_id])  # backward
           # 将多个layer的LSTMStateTuple拼接起来
           encoder_state = tuple(encoder_state) # 将list转为tuple
+      elif hparams.encoder_type == "transformer":
+        utils.print_out("  num_layers = %d, num_attention_heads=%d" %
+                        (num_layers, hparams.num_attention_heads))
+        if self.time_major:
+          encoder_emb_inp = tf.transpose(encoder_emb_inp, [1, 0, 2])
+        encoder_outputs = model_helper.build_transformer_encoder(
+            encoder_emb_inp,
+            iterator.source_sequence_length,
+            num_layers=num_layers,
+            num_heads=hparams.num_attention_heads,
+            ffn_units=hparams.transformer_ffn_units or 4 * hparams.num_units,
+            dropout=hparams.dropout,
+            mode=self.mode)
+        if self.time_major:
+          encoder_outputs = tf.transpose(encoder_outputs, [1, 0, 2])
+        # There is no recurrent state, the decoder reads the encoder through
+        # its attention memory only (pass_hidden_state is off).
+        encoder_state = ()
       else:
         raise ValueError("Unknown encoder_type %s" % hparams.encoder_type)
     return encoder_outputs, encoder_state
@@ -730,6 +949,11 @@ class Model(BaseModel):
       state.
     """
 
+    if self._use_fused_encoder(hparams):
+      return self._build_fused_bidirectional_rnn(
+          inputs, sequence_length, dtype, hparams, num_bi_layers,
+          num_bi_residual_layers, base_gpu=base_gpu)
+
     # Construct forward and backward cells
     fw_cell = self._build_encoder_cell(hparams,
                                        num_bi_layers,
@@ -764,6 +988,53 @@ class Model(BaseModel):
     # bi_outputs: [batch, input_sequence_length, 2*num_units]
     return tf.concat(bi_outputs, axis=-1), bi_state
 
+  def _use_fused_encoder(self, hparams):
+    """Whether to run the encoder RNNs with model_helper.run_fused_rnn.
+
+    SRU encoders always do, as their input projections are then computed for
+    all steps at once.
+    """
+    return ((hparams.unit_type == "sru" or
+             (hparams.use_fused_rnn and hparams.unit_type == "lstm")) and
+            self.time_major and not self.single_cell_fn)
+
+  def _build_fused_bidirectional_rnn(self,
+                                     inputs,
+                                     sequence_length,
+                                     dtype,
+                                     hparams,
+                                     num_bi_layers,
+                                     num_bi_residual_layers,
+                                     base_gpu=0):
+    """Fused version of _build_bidirectional_rnn, for time major inputs.
+
+    The variables are those of tf.nn.bidirectional_dynamic_rnn. The forward
+    and backward RNNs do not depend on each other, so they run concurrently
+    when the session has more than one inter-op thread.
+    """
+    kwargs = dict(num_units=hparams.num_units,
+                  num_layers=num_bi_layers,
+                  num_residual_layers=num_bi_residual_layers,
+                  forget_bias=hparams.forget_bias,
+                  dropout=hparams.dropout,
+                  mode=self.mode,
+                  num_gpus=self.num_gpus,
+                  dtype=dtype)
+    with tf.variable_scope("bidirectional_rnn"):
+      with tf.variable_scope("fw"):
+        output_fw, state_fw = model_helper.run_fused_rnn(
+            hparams.unit_type, inputs, sequence_length, base_gpu=base_gpu,
+            **kwargs)
+      with tf.variable_scope("bw"):
+        reversed_inputs = tf.reverse_sequence(
+            inputs, sequence_length, seq_axis=0, batch_axis=1)
+        reversed_output_bw, state_bw = model_helper.run_fused_rnn(
+            hparams.unit_type, reversed_inputs, sequence_length,
+            base_gpu=(base_gpu + num_bi_layers), **kwargs)
+        output_bw = tf.reverse_sequence(
+            reversed_output_bw, sequence_length, seq_axis=0, batch_axis=1)
+    return tf.concat([output_fw, output_bw], axis=-1), (state_fw, state_bw)
+
   def _build_decoder_cell(self, hparams, encoder_outputs, encoder_state,
                           source_sequence_length):
     """Build an RNN cell that can be used by decoder."""
@@ -780,7 +1051,8 @@ class Model(BaseModel):
         dropout=hparams.dropout,
         num_gpus=self.num_gpus,
         mode=self.mode,
-        single_cell_fn=self.single_cell_fn)
+        single_cell_fn=self.single_cell_fn,
+        fused=hparams.use_fused_rnn)
 
     # For beam search, we need to replicate encoder infos beam_width times
     if self.mode == tf.contrib.learn.ModeKeys.INFER and hparams.beam_width > 0:
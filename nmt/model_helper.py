@@ -2,6 +2,7 @@
 from __future__ import print_function
 
 import collections
+import contextlib
 import six
 import os
 import time
@@ -18,9 +19,13 @@ from .utils import vocab_utils
 # add some comment
 # __all__ 显式表明该类中哪些方法可以导出
 __all__ = [
-    "get_initializer", "get_device_str", "create_train_model",
-    "create_eval_model", "create_infer_model",
-    "create_emb_for_encoder_and_decoder", "create_rnn_cell", "gradient_clip",
+    "get_initializer", "get_device_str", "get_train_files",
+    "get_train_mixture",
+    "create_train_model", "create_eval_model", "create_infer_model",
+    "create_emb_for_encoder_and_decoder", "create_emb_projections",
+    "embedding_lookup", "create_rnn_cell", "run_fused_rnn",
+    "build_transformer_encoder", "chunked_softmax_cross_entropy",
+    "sampled_softmax_cross_entropy", "gradient_clip",
     "create_or_load_model", "load_model", "avg_checkpoints",
     "compute_perplexity"
 ]
@@ -56,6 +61,61 @@ class ExtraArgs(
   pass
 
 
+def _get_train_prefixes(prefix, hparams):
+  """Expand a train prefix that may be a glob pattern of shards."""
+  if not any(c in prefix for c in "*?["):
+    return [prefix]
+  prefixes = []
+  for compressed_suffix in ("",) + utils.COMPRESSED_SUFFIXES:
+    src_suffix = "." + hparams.src + compressed_suffix
+    prefixes.extend(
+        src_file[:-len(src_suffix)] for src_file in
+        tf.gfile.Glob(prefix + src_suffix))
+  prefixes = sorted(set(prefixes))
+  if not prefixes:
+    raise ValueError("No train files match %s" % prefix)
+  return prefixes
+
+
+def _get_data_files(prefixes, hparams):
+  src_files = [utils.get_data_file(prefix, hparams.src) for prefix in prefixes]
+  tgt_files = [utils.get_data_file(prefix, hparams.tgt) for prefix in prefixes]
+  return src_files, tgt_files
+
+
+def get_train_files(hparams):
+  """Return the aligned lists of source and target train files.
+
+  The train data is either one train_prefix, a glob pattern in train_prefix
+  that matches several shards (e.g. "data/train-*"), or a train_manifest file
+  listing one shard prefix per line. Files may be gzip or zstd compressed, in
+  which case they carry a ".gz" or ".zst" suffix after the language suffix.
+  With a train_mixture, these are the files of all mixture sources.
+  """
+  if hparams.train_mixture:
+    prefixes = [
+        shard_prefix for prefix, _ in get_train_mixture(hparams)
+        for shard_prefix in _get_train_prefixes(prefix, hparams)]
+  elif hparams.train_manifest:
+    with tf.gfile.GFile(hparams.train_manifest, mode="r") as f:
+      prefixes = [line.strip() for line in f if line.strip()]
+  else:
+    prefixes = _get_train_prefixes(hparams.train_prefix, hparams)
+  return _get_data_files(prefixes, hparams)
+
+
+def get_train_mixture(hparams):
+  """Parse hparams.train_mixture into a list of (prefix, weight) pairs."""
+  mixture = []
+  for source in hparams.train_mixture.split(","):
+    prefix, _, weight = source.strip().rpartition(":")
+    if not prefix:
+      raise ValueError("Expected prefix:weight in train_mixture, got %s" %
+                       source)
+    mixture.append((prefix, float(weight)))
+  return mixture
+
+
 class TrainModel(
     collections.namedtuple("TrainModel", ("graph", "model", "iterator",
                                           "skip_count_placeholder"))):
@@ -65,8 +125,7 @@ class TrainModel(
 def create_train_model(model_creator, hparams, scope=None, num_workers=1, jobid=0,
     extra_args=None):
   """Create train graph, model, and iterator."""
-  src_file = "%s.%s" % (hparams.train_prefix, hparams.src)
-  tgt_file = "%s.%s" % (hparams.train_prefix, hparams.tgt)
+  src_files, tgt_files = get_train_files(hparams)
   src_vocab_file = hparams.src_vocab_file
   tgt_vocab_file = hparams.tgt_vocab_file
 
@@ -76,8 +135,44 @@ def create_train_model(model_creator, hparams, scope=None, num_workers=1, jobid=
     src_vocab_table, tgt_vocab_table = vocab_utils.create_vocab_tables(
         src_vocab_file, tgt_vocab_file, hparams.share_vocab)
 
-    src_dataset = tf.data.TextLineDataset(filenames=src_file)
-    tgt_dataset = tf.data.TextLineDataset(filenames=tgt_file)
+    num_sources = 0
+    if hparams.train_mixture:
+      # Each corpus is read on its own and pairs are drawn from them with the
+      # mixture weights, tagged with the index of their corpus. Workers
+      # split the shard files of every corpus between them before the
+      # corpora are repeated.
+      mixture = get_train_mixture(hparams)
+      src_tgt_datasets = []
+      for prefix, _ in mixture:
+        source_src_files, source_tgt_files = _get_data_files(
+            _get_train_prefixes(prefix, hparams), hparams)
+        src_tgt_datasets.append(iterator_utils.get_sharded_dataset(
+            source_src_files, source_tgt_files,
+            num_shards=num_workers,
+            shard_index=jobid,
+            random_seed=hparams.random_seed,
+            num_parallel_reads=hparams.num_parallel_reads))
+      src_dataset = iterator_utils.get_mixture_dataset(
+          src_tgt_datasets, [weight for _, weight in mixture],
+          random_seed=hparams.random_seed)
+      tgt_dataset = None
+      num_sources = len(mixture)
+      num_shards, shard_index = 1, 0
+    elif len(src_files) > 1:
+      # Workers read disjoint sets of shards in parallel, so the pairs are
+      # already sharded when they reach get_iterator.
+      src_dataset = iterator_utils.get_sharded_dataset(
+          src_files, tgt_files,
+          num_shards=num_workers,
+          shard_index=jobid,
+          random_seed=hparams.random_seed,
+          num_parallel_reads=hparams.num_parallel_reads)
+      tgt_dataset = None
+      num_shards, shard_index = 1, 0
+    else:
+      src_dataset = iterator_utils.get_text_line_dataset(src_files[0])
+      tgt_dataset = iterator_utils.get_text_line_dataset(tgt_files[0])
+      num_shards, shard_index = num_workers, jobid
     skip_count_placeholder = tf.placeholder(shape=(), dtype=tf.int64) # scalar没有shape
 
     iterator = iterator_utils.get_iterator(
@@ -93,8 +188,12 @@ def create_train_model(model_creator, hparams, scope=None, num_workers=1, jobid=
         src_max_len=hparams.src_max_len,
         tgt_max_len=hparams.tgt_max_len,
         skip_count=skip_count_placeholder,
-        num_shards=num_workers,
-        shard_index=jobid)
+        num_shards=num_shards,
+        shard_index=shard_index,
+        repeat_dataset=hparams.repeat_train_data,
+        memory_budget_mb=hparams.input_memory_budget_mb,
+        batch_first=hparams.batch_first_preprocessing,
+        num_sources=num_sources)
 
     # Note: One can set model_device_fn to
     # `tf.train.replica_device_setter(ps_tasks)` for distributed training.
@@ -121,7 +220,8 @@ def create_train_model(model_creator, hparams, scope=None, num_workers=1, jobid=
 class EvalModel(
     collections.namedtuple("EvalModel",
                            ("graph", "model", "src_file_placeholder",
-                            "tgt_file_placeholder", "iterator"))):
+                            "tgt_file_placeholder",
+                            "compression_type_placeholder", "iterator"))):
   pass
 
 
@@ -136,20 +236,24 @@ def create_eval_model(model_creator, hparams, scope=None, extra_args=None):
         src_vocab_file, tgt_vocab_file, hparams.share_vocab)
     src_file_placeholder = tf.placeholder(shape=(), dtype=tf.string)
     tgt_file_placeholder = tf.placeholder(shape=(), dtype=tf.string)
-    src_dataset = tf.data.TextLineDataset(src_file_placeholder)
-    tgt_dataset = tf.data.TextLineDataset(tgt_file_placeholder)
-    iterator = iterator_utils.get_iterator(
+    # "" or "GZIP", fed along with the file names.
+    compression_type_placeholder = tf.placeholder_with_default(
+        "", shape=(), name="compression_type")
+    src_dataset = tf.data.TextLineDataset(
+        src_file_placeholder, compression_type=compression_type_placeholder)
+    tgt_dataset = tf.data.TextLineDataset(
+        tgt_file_placeholder, compression_type=compression_type_placeholder)
+    iterator = iterator_utils.get_eval_iterator(
         src_dataset,
         tgt_dataset,
         src_vocab_table,
         tgt_vocab_table,
-        hparams.batch_size,
+        hparams.eval_batch_size or hparams.batch_size,
         sos=hparams.sos,
         eos=hparams.eos,
-        random_seed=hparams.random_seed,
-        num_buckets=hparams.num_buckets,
         src_max_len=hparams.src_max_len_infer,
-        tgt_max_len=hparams.tgt_max_len_infer)
+        tgt_max_len=hparams.tgt_max_len_infer,
+        batch_tokens=hparams.eval_batch_tokens)
     model = model_creator(
         hparams,
         iterator=iterator,
@@ -163,6 +267,7 @@ def create_eval_model(model_creator, hparams, scope=None, extra_args=None):
       model=model,
       src_file_placeholder=src_file_placeholder,
       tgt_file_placeholder=tgt_file_placeholder,
+      compression_type_placeholder=compression_type_placeholder,
       iterator=iterator)
 
 
@@ -195,7 +300,8 @@ def create_infer_model(model_creator, hparams, scope=None, extra_args=None):
         src_vocab_table,
         batch_size=batch_size_placeholder,
         eos=hparams.eos,
-        src_max_len=hparams.src_max_len_infer)
+        src_max_len=hparams.src_max_len_infer,
+        batch_first=hparams.batch_first_preprocessing)
     model = model_creator(
         hparams,
         iterator=iterator,
@@ -223,13 +329,15 @@ def _get_embed_device(vocab_size):
 
 def _create_pretrained_emb_from_txt(
     vocab_file, embed_file, num_trainable_tokens=3, dtype=tf.float32,
-    scope=None):
+    scope=None, trainable=False):
   """Load pretrain embeding from embed_file, and return an embedding matrix.
 
   Args:
     embed_file: Path to a Glove formated embedding txt file.
     num_trainable_tokens: Make the first n tokens in the vocab file as trainable
       variables. Default is 3, which is "<unk>", "<s>" and "</s>".
+    trainable: Instead, make all the embedding a variable initialized with the
+      pretrained vectors.
   """
   vocab, _ = vocab_utils.load_vocab(vocab_file)
   trainable_tokens = vocab[:num_trainable_tokens] # 为何其它的都是不可训练的呢?
@@ -245,6 +353,12 @@ def _create_pretrained_emb_from_txt(
 
   emb_mat = np.array(
       [emb_dict[token] for token in vocab], dtype=dtype.as_numpy_dtype())
+  if trainable:
+    utils.print_out("    (all tokens)")
+    with tf.variable_scope(scope or "pretrain_embeddings", dtype=dtype):
+      with tf.device(_get_embed_device(len(vocab))):
+        return tf.get_variable("emb_mat_var", initializer=emb_mat)
+
   emb_mat = tf.constant(emb_mat)
   #除了这3个词以外,其它的词的embedding均不参与训练
   emb_mat_const = tf.slice(emb_mat, begin=[num_trainable_tokens, 0], size=[-1, -1])
@@ -256,10 +370,11 @@ def _create_pretrained_emb_from_txt(
 
 
 def _create_or_load_embed(embed_name, vocab_file, embed_file,
-                          vocab_size, embed_size, dtype):
+                          vocab_size, embed_size, dtype, trainable=False):
   """Create a new or load an existing embedding matrix."""
   if vocab_file and embed_file:
-    embedding = _create_pretrained_emb_from_txt(vocab_file, embed_file)
+    embedding = _create_pretrained_emb_from_txt(vocab_file, embed_file,
+                                                trainable=trainable)
   else:
     with tf.device(_get_embed_device(vocab_size)):
       embedding = tf.get_variable( # 一般都是用get_variable
@@ -278,6 +393,7 @@ def create_emb_for_encoder_and_decoder(share_vocab,
                                        tgt_vocab_file=None,
                                        src_embed_file=None,
                                        tgt_embed_file=None,
+                                       train_tgt_embed=False,
                                        scope=None):
   """Create embedding matrix for both encoder and decoder.
 
@@ -292,6 +408,8 @@ def create_emb_for_encoder_and_decoder(share_vocab,
       embedding.
     dtype: dtype of the embedding matrix. Default to float32.
     num_partitions: number of partitions used for the embedding vars.
+    train_tgt_embed: A boolean. Whether all of a pretrained decoder's embedding
+      is trainable, e.g. because it is also the output projection.
     scope: VariableScope for the created subgraph. Default to "embedding".
 
   Returns:
@@ -330,7 +448,7 @@ def create_emb_for_encoder_and_decoder(share_vocab,
 
       embedding_encoder = _create_or_load_embed(
           "embedding_share", vocab_file, embed_file,
-          src_vocab_size, src_embed_size, dtype)
+          src_vocab_size, src_embed_size, dtype, trainable=train_tgt_embed)
       embedding_decoder = embedding_encoder
     else:
       with tf.variable_scope("encoder", partitioner=partitioner):
@@ -341,11 +459,72 @@ def create_emb_for_encoder_and_decoder(share_vocab,
       with tf.variable_scope("decoder", partitioner=partitioner):
         embedding_decoder = _create_or_load_embed(
             "embedding_decoder", tgt_vocab_file, tgt_embed_file,
-            tgt_vocab_size, tgt_embed_size, dtype)
+            tgt_vocab_size, tgt_embed_size, dtype, trainable=train_tgt_embed)
 
   return embedding_encoder, embedding_decoder
 
 
+def create_emb_projections(share_vocab, embed_size, num_units,
+                           dtype=tf.float32, scope=None):
+  """Create the projections of factorized embeddings to num_units.
+
+  Args:
+    share_vocab: A boolean. Whether the encoder and the decoder share the
+      embedding matrix, and so its projection.
+    embed_size: An integer. The embedding dimension.
+    num_units: An integer. The network size.
+    dtype: dtype of the projection matrices. Default to float32.
+    scope: VariableScope for the created subgraph. Default to "embedding".
+
+  Returns:
+    encoder_projection: [embed_size, num_units] matrix, or None if embed_size
+      is num_units.
+    decoder_projection: same for the decoder.
+  """
+  if embed_size == num_units:
+    return None, None
+
+  utils.print_out("# Factorized embeddings: %d projected to %d" %
+                  (embed_size, num_units))
+  with tf.variable_scope(scope or "embeddings", dtype=dtype):
+    if share_vocab:
+      encoder_projection = tf.get_variable(
+          "embedding_share_projection", [embed_size, num_units], dtype)
+      decoder_projection = encoder_projection
+    else:
+      with tf.variable_scope("encoder"):
+        encoder_projection = tf.get_variable(
+            "embedding_encoder_projection", [embed_size, num_units], dtype)
+      with tf.variable_scope("decoder"):
+        decoder_projection = tf.get_variable(
+            "embedding_decoder_projection", [embed_size, num_units], dtype)
+
+  return encoder_projection, decoder_projection
+
+
+def embedding_lookup(embedding, ids, projection=None):
+  """Look up ids in embedding, then apply the projection if there is one.
+
+  Args:
+    embedding: [vocab_size, embed_size] embedding matrix, possibly partitioned.
+    ids: An int Tensor of any shape.
+    projection: An optional [embed_size, num_units] matrix of a factorized
+      embedding.
+
+  Returns:
+    [ids shape, embed_size] embeddings, or [ids shape, num_units] with a
+    projection.
+  """
+  emb_inp = tf.nn.embedding_lookup(embedding, ids)
+  if projection is None:
+    return emb_inp
+  embed_size, num_units = projection.get_shape().as_list()
+  outputs = tf.matmul(tf.reshape(emb_inp, [-1, embed_size]), projection)
+  outputs = tf.reshape(outputs, tf.concat([tf.shape(ids), [num_units]], 0))
+  outputs.set_shape(ids.get_shape().concatenate(num_units))
+  return outputs
+
+
 def _single_cell(unit_type, num_units, forget_bias, dropout, mode,
                  residual_connection=False, device_str=None, residual_fn=None):
   """Create an instance of a single RNN cell."""
@@ -358,6 +537,18 @@ def _single_cell(unit_type, num_units, forget_bias, dropout, mode,
     single_cell = tf.contrib.rnn.BasicLSTMCell(
         num_units,
         forget_bias=forget_bias)
+  elif unit_type == "block_lstm":
+    # Same variables as BasicLSTMCell, so checkpoints are interchangeable, but
+    # each step is a single fused op.
+    utils.print_out("  Block LSTM, forget_bias=%g" % forget_bias,
+                    new_line=False)
+    single_cell = tf.contrib.rnn.LSTMBlockCell(
+        num_units,
+        forget_bias=forget_bias,
+        name="basic_lstm_cell")
+  elif unit_type == "sru":
+    utils.print_out("  SRU", new_line=False)
+    single_cell = tf.contrib.rnn.SRUCell(num_units, name="sru_cell")
   elif unit_type == "gru":
     utils.print_out("  GRU", new_line=False)
     single_cell = tf.contrib.rnn.GRUCell(num_units)
@@ -398,10 +589,12 @@ def _single_cell(unit_type, num_units, forget_bias, dropout, mode,
 
 def _cell_list(unit_type, num_units, num_layers, num_residual_layers,
                forget_bias, dropout, mode, num_gpus, base_gpu=0,
-               single_cell_fn=None, residual_fn=None):
+               single_cell_fn=None, residual_fn=None, fused=False):
   """Create a list of RNN cells."""
   if not single_cell_fn: # 如果single_cell_fn为空, 使用默认的single_cell_fn
     single_cell_fn = _single_cell # 创建一个lstm或者gru的层
+  if fused and unit_type == "lstm":
+    unit_type = "block_lstm"
 
   # Multi-GPU
   cell_list = []
@@ -425,7 +618,7 @@ def _cell_list(unit_type, num_units, num_layers, num_residual_layers,
 # num_residual_layers:最后多少层里有残差网络
 def create_rnn_cell(unit_type, num_units, num_layers, num_residual_layers,
                     forget_bias, dropout, mode, num_gpus, base_gpu=0,
-                    single_cell_fn=None):
+                    single_cell_fn=None, fused=False):
   """Create multi-layer RNN cell.
 
   Args:
@@ -446,6 +639,8 @@ def create_rnn_cell(unit_type, num_units, num_layers, num_residual_layers,
       as its device id.
     single_cell_fn: allow for adding customized cell.
       When not specified, we default to model_helper._single_cell
+    fused: use LSTMBlockCell for "lstm" cells, see run_fused_rnn for the
+      whole-sequence version.
   Returns:
     An `RNNCell` instance.
   """
@@ -458,7 +653,8 @@ def create_rnn_cell(unit_type, num_units, num_layers, num_residual_layers,
                          mode=mode,
                          num_gpus=num_gpus,
                          base_gpu=base_gpu,
-                         single_cell_fn=single_cell_fn)
+                         single_cell_fn=single_cell_fn,
+                         fused=fused)
 
   if len(cell_list) == 1:  # Single layer.
     return cell_list[0] # 如果是单层的话, 只取第一个cell
@@ -466,8 +662,368 @@ def create_rnn_cell(unit_type, num_units, num_layers, num_residual_layers,
     return tf.contrib.rnn.MultiRNNCell(cell_list)
 
 
+def _run_sru_layer(inputs, sequence_length, num_units, dtype=None):
+  """Run a tf.contrib.rnn.SRUCell over time major inputs.
+
+  The input projections of all steps are one matmul, which leaves only
+  elementwise ops in the recurrence. The variables are those of the SRUCell,
+  to be called in its variable scope.
+  """
+  dtype = dtype or inputs.dtype
+  input_depth = inputs.get_shape()[-1].value
+  kernel = tf.get_variable("kernel", [input_depth, 4 * num_units], dtype)
+  bias = tf.get_variable("bias", [2 * num_units], dtype,
+                         initializer=tf.constant_initializer(0.0))
+
+  # [max_time, batch_size, 4 * num_units]
+  projections = tf.tensordot(inputs, kernel, [[2], [0]])
+  x_bar, f_intermediate, r_intermediate, x_tx = tf.split(
+      projections, 4, axis=2)
+  f, r = tf.split(
+      tf.sigmoid(tf.concat([f_intermediate, r_intermediate], 2) + bias),
+      2, axis=2)
+
+  # c_t = f_t * c_{t-1} + (1 - f_t) * x_bar_t
+  batch_size = tf.shape(inputs)[1]
+  initial_state = tf.zeros([batch_size, num_units], dtype=dtype)
+  states = tf.scan(lambda c, f_x: f_x[0] * c + (1.0 - f_x[0]) * f_x[1],
+                   (f, x_bar), initializer=initial_state)
+  outputs = r * tf.tanh(states) + (1.0 - r) * x_tx
+
+  # Like dynamic_rnn, zero the outputs past sequence_length and return the
+  # state at sequence_length.
+  mask = tf.sequence_mask(sequence_length, tf.shape(inputs)[0], dtype=dtype)
+  outputs *= tf.expand_dims(tf.transpose(mask), -1)
+  all_states = tf.concat([tf.expand_dims(initial_state, 0), states], 0)
+  final_state = tf.gather_nd(
+      all_states, tf.stack([sequence_length, tf.range(batch_size)], axis=1))
+  return outputs, final_state
+
+
+def run_fused_rnn(unit_type, inputs, sequence_length, num_units, num_layers,
+                  num_residual_layers, forget_bias, dropout, mode, num_gpus,
+                  base_gpu=0, dtype=None):
+  """Run a multi-layer RNN over a whole sequence, one layer at a time.
+
+  This computes the same as tf.nn.dynamic_rnn with the cell of
+  create_rnn_cell, called in the current variable scope, and creates the same
+  variables. "lstm" layers are one LSTMBlockFusedCell op; "sru" layers do
+  their input projections for all steps at once. Dropout and residual
+  connections are applied between layers instead of by cell wrappers.
+
+  Args:
+    unit_type: "lstm" or "sru".
+    inputs: time major inputs, [max_time, batch_size, depth].
+    sequence_length: int32 [batch_size] lengths of the inputs.
+    Others as in create_rnn_cell.
+
+  Returns:
+    outputs: [max_time, batch_size, num_units], zero past sequence_length.
+    state: the final state, or a tuple of one per layer when num_layers > 1,
+      as returned for a MultiRNNCell.
+  """
+  dropout = dropout if mode == tf.contrib.learn.ModeKeys.TRAIN else 0.0
+
+  states = []
+  for i in range(num_layers):
+    layer_inputs = inputs
+    if dropout > 0.0:
+      layer_inputs = tf.nn.dropout(layer_inputs, keep_prob=1.0 - dropout)
+
+    with tf.device(get_device_str(i + base_gpu, num_gpus)), (
+        _fused_layer_scope(i, num_layers)):
+      if unit_type == "lstm":
+        utils.print_out("  fused cell %d  Block LSTM, forget_bias=%g" %
+                        (i, forget_bias))
+        cell = tf.contrib.rnn.LSTMBlockFusedCell(
+            num_units, forget_bias=forget_bias, name="basic_lstm_cell")
+        outputs, state = cell(layer_inputs, dtype=dtype,
+                              sequence_length=sequence_length)
+      elif unit_type == "sru":
+        utils.print_out("  fused cell %d  SRU" % i)
+        with tf.variable_scope("sru_cell"):
+          outputs, state = _run_sru_layer(layer_inputs, sequence_length,
+                                          num_units, dtype=dtype)
+      else:
+        raise ValueError("No fused version of unit type %s" % unit_type)
+
+    if i >= num_layers - num_residual_layers:
+      # Like dynamic_rnn, keep the outputs past sequence_length at zero.
+      mask = tf.sequence_mask(sequence_length, tf.shape(inputs)[0],
+                              dtype=outputs.dtype)
+      outputs = (outputs + inputs) * tf.expand_dims(tf.transpose(mask), -1)
+    states.append(state)
+    inputs = outputs
+
+  if num_layers == 1:
+    return inputs, states[0]
+  return inputs, tuple(states)
+
+
+@contextlib.contextmanager
+def _fused_layer_scope(layer_id, num_layers):
+  """The variable scope of layer layer_id in a cell from create_rnn_cell."""
+  if num_layers == 1:
+    yield
+  else:
+    with tf.variable_scope("multi_rnn_cell"), tf.variable_scope(
+        "cell_%d" % layer_id):
+      yield
+
+
+def get_position_encoding(length, depth, dtype=tf.float32):
+  """Sinusoid position encodings of the Transformer, [length, depth]."""
+  num_timescales = depth // 2
+  log_timescale_increment = np.log(10000.0) / max(num_timescales - 1, 1)
+  inv_timescales = tf.exp(
+      tf.to_float(tf.range(num_timescales)) * -log_timescale_increment)
+  scaled_time = (tf.expand_dims(tf.to_float(tf.range(length)), 1) *
+                 tf.expand_dims(inv_timescales, 0))
+  signal = tf.concat([tf.sin(scaled_time), tf.cos(scaled_time)], axis=1)
+  signal = tf.pad(signal, [[0, 0], [0, depth % 2]])
+  return tf.cast(signal, dtype)
+
+
+def _multihead_self_attention(inputs, bias, num_units, num_heads, dropout):
+  """Multi-head scaled dot-product attention of inputs over themselves.
+
+  Args:
+    inputs: [batch_size, max_time, num_units].
+    bias: [batch_size, 1, 1, max_time], added to the attention logits to mask
+      padded positions.
+    num_units: total depth of the heads.
+    num_heads: number of attention heads, which divides num_units.
+    dropout: dropout rate of the attention weights.
+
+  Returns:
+    [batch_size, max_time, num_units] attention outputs.
+  """
+  batch_size = tf.shape(inputs)[0]
+  max_time = tf.shape(inputs)[1]
+  head_units = num_units // num_heads
+
+  def split_heads(x):
+    # [batch_size, num_heads, max_time, head_units]
+    x = tf.reshape(x, [batch_size, max_time, num_heads, head_units])
+    return tf.transpose(x, [0, 2, 1, 3])
+
+  query, key, value = tf.split(
+      tf.layers.dense(inputs, 3 * num_units, use_bias=False, name="qkv"),
+      3, axis=2)
+  query = split_heads(query) * head_units ** -0.5
+  logits = tf.matmul(query, split_heads(key), transpose_b=True) + bias
+  weights = tf.nn.softmax(logits)
+  if dropout > 0.0:
+    weights = tf.nn.dropout(weights, keep_prob=1.0 - dropout)
+  context = tf.transpose(tf.matmul(weights, split_heads(value)), [0, 2, 1, 3])
+  context = tf.reshape(context, [batch_size, max_time, num_units])
+  return tf.layers.dense(context, num_units, use_bias=False, name="output")
+
+
+def build_transformer_encoder(inputs, sequence_length, num_layers, num_heads,
+                              ffn_units, dropout, mode):
+  """Self-attention encoder of the Transformer (Vaswani et al., 2017).
+
+  Each layer is multi-head self-attention followed by a position-wise feed
+  forward network, both normalized before and added back to their inputs.
+  All time steps are computed at once.
+
+  Args:
+    inputs: batch major embeddings, [batch_size, max_time, num_units].
+    sequence_length: int32 [batch_size] lengths of the inputs.
+    num_layers: number of layers.
+    num_heads: number of attention heads, which divides num_units.
+    ffn_units: depth of the hidden feed forward layer.
+    dropout: dropout rate, ignored if mode != TRAIN.
+    mode: either tf.contrib.learn.TRAIN/EVAL/INFER
+
+  Returns:
+    [batch_size, max_time, num_units] outputs, zero past sequence_length.
+  """
+  dropout = dropout if mode == tf.contrib.learn.ModeKeys.TRAIN else 0.0
+
+  def apply_dropout(x):
+    if dropout > 0.0:
+      return tf.nn.dropout(x, keep_prob=1.0 - dropout)
+    return x
+
+  def layer_norm(x):
+    return tf.contrib.layers.layer_norm(x, begin_norm_axis=-1)
+
+  num_units = inputs.get_shape()[-1].value
+  max_time = tf.shape(inputs)[1]
+  mask = tf.sequence_mask(sequence_length, max_time, dtype=inputs.dtype)
+  bias = tf.expand_dims(tf.expand_dims((1.0 - mask) * -1e9, 1), 1)
+
+  outputs = apply_dropout(
+      inputs * num_units ** 0.5 +
+      get_position_encoding(max_time, num_units, dtype=inputs.dtype))
+  for i in range(num_layers):
+    utils.print_out("  transformer layer %d, num_heads=%d, ffn_units=%d" %
+                    (i, num_heads, ffn_units))
+    with tf.variable_scope("layer_%d" % i):
+      with tf.variable_scope("self_attention"):
+        attention = _multihead_self_attention(
+            layer_norm(outputs), bias, num_units, num_heads, dropout)
+        outputs += apply_dropout(attention)
+      with tf.variable_scope("ffn"):
+        hidden = tf.layers.dense(layer_norm(outputs), ffn_units,
+                                 activation=tf.nn.relu, name="hidden")
+        outputs += apply_dropout(
+            tf.layers.dense(apply_dropout(hidden), num_units, name="output"))
+  with tf.variable_scope("output_norm"):
+    outputs = layer_norm(outputs)
+  return outputs * tf.expand_dims(mask, -1)
+
+
+def chunked_softmax_cross_entropy(outputs, kernel, labels, weights,
+                                  chunk_size):
+  """Weighted softmax cross entropy of projected outputs, by time chunks.
+
+  Computes the same loss and gradients as
+
+    logits = tf.tensordot(outputs, kernel, [[2], [0]])
+    tf.reduce_sum(weights * tf.nn.sparse_softmax_cross_entropy_with_logits(
+        labels=labels, logits=logits))
+
+  but projects chunk_size time steps at a time, and recomputes the logits of
+  each chunk in the backward pass instead of keeping them. The logits never
+  take more than [chunk_size, batch_size, vocab_size] memory.
+
+  Args:
+    outputs: time major decoder outputs, [max_time, batch_size, num_units].
+    kernel: output projection, [num_units, vocab_size].
+    labels: int [max_time, batch_size] target ids.
+    weights: [max_time, batch_size] weights of the targets, e.g. 0 for
+      padding.
+    chunk_size: number of time steps projected at once.
+
+  Returns:
+    The scalar loss.
+  """
+  dtype = outputs.dtype
+  vocab_size = tf.shape(kernel)[1]
+  num_chunks = (tf.shape(outputs)[0] + chunk_size - 1) // chunk_size
+
+  def get_chunk(tensor, i):
+    return tensor[i * chunk_size:(i + 1) * chunk_size]
+
+  def get_logits(outputs_chunk, kernel):
+    return tf.tensordot(outputs_chunk, kernel, [[2], [0]])
+
+  @tf.custom_gradient
+  def loss_fn(outputs, kernel):
+    """Loss of outputs and kernel, with the recomputing gradient."""
+
+    def forward(i, loss):
+      crossent = tf.nn.sparse_softmax_cross_entropy_with_logits(
+          labels=get_chunk(labels, i),
+          logits=get_logits(get_chunk(outputs, i), kernel))
+      return i + 1, loss + tf.reduce_sum(crossent * get_chunk(weights, i))
+
+    _, loss = tf.while_loop(
+        lambda i, _: i < num_chunks, forward,
+        [tf.constant(0), tf.zeros([], dtype=dtype)])
+
+    def grad_fn(loss_grad):
+      """d(loss)/d(logits) = (softmax(logits) - one_hot(labels)) * weights."""
+
+      def backward(i, outputs_grads, kernel_grad):
+        outputs_chunk = get_chunk(outputs, i)
+        logits_grad = (
+            tf.nn.softmax(get_logits(outputs_chunk, kernel)) -
+            tf.one_hot(get_chunk(labels, i), vocab_size, dtype=dtype)) * (
+                tf.expand_dims(get_chunk(weights, i) * loss_grad, -1))
+        outputs_grads = outputs_grads.write(
+            i, tf.tensordot(logits_grad, kernel, [[2], [1]]))
+        kernel_grad += tf.tensordot(outputs_chunk, logits_grad,
+                                    [[0, 1], [0, 1]])
+        return i + 1, outputs_grads, kernel_grad
+
+      _, outputs_grads, kernel_grad = tf.while_loop(
+          lambda i, *_: i < num_chunks, backward,
+          [tf.constant(0),
+           tf.TensorArray(dtype, size=num_chunks, infer_shape=False),
+           tf.zeros_like(kernel)])
+      return outputs_grads.concat(), kernel_grad
+
+    return loss, grad_fn
+
+  return loss_fn(outputs, kernel)
+
+
+def sampled_softmax_cross_entropy(inputs, gather_weights, labels, num_sampled,
+                                  num_classes, seed=None):
+  """Sampled softmax cross entropy reading only the sampled output weights.
+
+  Computes the same loss as tf.nn.sampled_softmax_loss with zero biases and
+  a log-uniform sampler, but the weight rows of the true and sampled ids are
+  read by gather_weights. A [num_units, vocab_size] kernel can then be
+  gathered by column, without transposing the full matrix every step, and a
+  [vocab_size, num_units] embedding by row, which gives IndexedSlices
+  gradients.
+
+  Args:
+    inputs: [N, num_units] decoder outputs.
+    gather_weights: function from int64 [M] ids to their [M, num_units]
+      output weights.
+    labels: int [N] target ids.
+    num_sampled: number of classes sampled per batch.
+    num_classes: vocab size.
+    seed: random seed of the sampler.
+
+  Returns:
+    The [N] per example losses.
+  """
+  labels = tf.reshape(tf.to_int64(labels), [-1, 1])
+  sampled, true_expected_count, sampled_expected_count = (
+      tf.stop_gradient(s) for s in tf.nn.log_uniform_candidate_sampler(
+          true_classes=labels, num_true=1, num_sampled=num_sampled,
+          unique=True, range_max=num_classes, seed=seed))
+  num_true = tf.shape(labels)[0]
+  weights = gather_weights(tf.concat([tf.reshape(labels, [-1]), sampled], 0))
+  dtype = inputs.dtype
+
+  true_logits = tf.expand_dims(
+      tf.reduce_sum(inputs * weights[:num_true], 1), 1)
+  true_logits -= tf.log(tf.cast(true_expected_count, dtype))
+  sampled_logits = tf.matmul(inputs, weights[num_true:], transpose_b=True)
+  sampled_logits -= tf.log(tf.cast(sampled_expected_count, dtype))
+
+  # A sampled id that is also the target of an example is not a negative for
+  # that example.
+  hit_indices, hit_ids, hit_weights = tf.nn.compute_accidental_hits(
+      labels, sampled, num_true=1)
+  sampled_logits += tf.sparse_to_dense(
+      tf.stack([hit_indices, tf.to_int32(hit_ids)], 1),
+      tf.stack([num_true, num_sampled]), tf.cast(hit_weights, dtype),
+      default_value=0.0, validate_indices=False)
+
+  # The target is the first of the [1 + num_sampled] logits of each example.
+  return tf.nn.sparse_softmax_cross_entropy_with_logits(
+      labels=tf.zeros([num_true], dtype=tf.int32),
+      logits=tf.concat([true_logits, sampled_logits], 1))
+
+
+def _deduplicate_indexed_slices(gradient):
+  """Sum the rows of an IndexedSlices gradient that have the same index."""
+  unique_indices, positions = tf.unique(gradient.indices)
+  summed_values = tf.unsorted_segment_sum(
+      gradient.values, positions, tf.shape(unique_indices)[0])
+  return tf.IndexedSlices(summed_values, unique_indices, gradient.dense_shape)
+
+
 def gradient_clip(gradients, max_gradient_norm):
-  """Clipping gradients of a model."""
+  """Clipping gradients of a model.
+
+  Sparse (IndexedSlices) gradients, e.g. of the embeddings, stay sparse. Their
+  rows are summed per index first, so that the global norm is that of the
+  dense gradient and the optimizer gets one row per word of the batch.
+  """
+  gradients = [
+      _deduplicate_indexed_slices(gradient)
+      if isinstance(gradient, tf.IndexedSlices) else gradient
+      for gradient in gradients]
   clipped_gradients, gradient_norm = tf.clip_by_global_norm(
       gradients, max_gradient_norm)
   gradient_norm_summary = [tf.summary.scalar("grad_norm", gradient_norm)]
@@ -536,7 +1092,7 @@ def avg_checkpoints(model_dir, num_last_checkpoints, global_step,
   # variables into the avg_model_dir.
   with tf.Graph().as_default():
     tf_vars = [
-        tf.get_variable(v, shape=var_values[v].shape, dtype=var_dtypes[name])
+        tf.get_variable(v, shape=var_values[v].shape, dtype=var_dtypes[v])
         for v in var_values
     ]
 
@@ -0,0 +1,123 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for model_helper."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+from . import model_helper
+
+
+class ModelHelperTest(tf.test.TestCase):
+
+  def testChunkedSoftmaxCrossEntropy(self):
+    max_time, batch_size, num_units, vocab_size = 7, 3, 4, 11
+    rng = np.random.RandomState(0)
+    outputs = tf.constant(
+        rng.randn(max_time, batch_size, num_units).astype(np.float32))
+    kernel = tf.constant(rng.randn(num_units, vocab_size).astype(np.float32))
+    labels = tf.constant(
+        rng.randint(vocab_size, size=(max_time, batch_size)).astype(np.int32))
+    weights = tf.transpose(
+        tf.sequence_mask([7, 5, 2], max_time, dtype=tf.float32))
+
+    logits = tf.tensordot(outputs, kernel, [[2], [0]])
+    loss = tf.reduce_sum(
+        weights * tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=labels, logits=logits))
+    # The last chunk is shorter than the others.
+    chunked_loss = model_helper.chunked_softmax_cross_entropy(
+        outputs, kernel, labels, weights, chunk_size=3)
+
+    with self.test_session() as sess:
+      (loss, grads, chunked_loss, chunked_grads) = sess.run(
+          [loss, tf.gradients(loss, [outputs, kernel]),
+           chunked_loss, tf.gradients(chunked_loss, [outputs, kernel])])
+
+    self.assertAllClose(loss, chunked_loss)
+    self.assertAllClose(grads[0], chunked_grads[0])
+    self.assertAllClose(grads[1], chunked_grads[1])
+
+  def testSampledSoftmaxCrossEntropy(self):
+    num_examples, num_units, vocab_size, num_sampled = 6, 4, 20, 5
+    rng = np.random.RandomState(0)
+    inputs = tf.constant(
+        rng.randn(num_examples, num_units).astype(np.float32))
+    embedding = tf.Variable(
+        rng.randn(vocab_size, num_units).astype(np.float32))
+    kernel = tf.Variable(rng.randn(num_units, vocab_size).astype(np.float32))
+    # Word 3 is both a target and likely to be sampled.
+    labels = tf.constant([3, 0, 7, 3, 19, 1])
+
+    def sampled_loss(gather_weights):
+      return model_helper.sampled_softmax_cross_entropy(
+          inputs, gather_weights, labels, num_sampled, vocab_size, seed=1)
+
+    def reference_loss(weights):
+      return tf.nn.sampled_softmax_loss(
+          weights=weights, biases=tf.zeros([vocab_size]),
+          labels=tf.reshape(tf.to_int64(labels), [-1, 1]), inputs=inputs,
+          num_sampled=num_sampled, num_classes=vocab_size,
+          partition_strategy="div", seed=1)
+
+    embedding_loss = sampled_loss(lambda ids: tf.gather(embedding, ids))
+    kernel_loss = sampled_loss(
+        lambda ids: tf.transpose(tf.gather(kernel, ids, axis=1)))
+    embedding_gradient = tf.gradients(embedding_loss, embedding)[0]
+    self.assertIsInstance(embedding_gradient, tf.IndexedSlices)
+
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      self.assertAllClose(sess.run(reference_loss(embedding)),
+                          sess.run(embedding_loss))
+      self.assertAllClose(sess.run(reference_loss(tf.transpose(kernel))),
+                          sess.run(kernel_loss))
+
+  def testGradientClipSparse(self):
+    embedding = tf.constant(np.arange(12, dtype=np.float32).reshape([6, 2]))
+    dense = tf.constant([[1.0, 2.0]])
+    # Word 1 appears twice in the batch.
+    loss = (tf.reduce_sum(tf.nn.embedding_lookup(embedding, [1, 3, 1])) +
+            tf.reduce_sum(dense))
+    gradients = tf.gradients(loss, [embedding, dense])
+    self.assertIsInstance(gradients[0], tf.IndexedSlices)
+
+    clipped_gradients, _, gradient_norm = model_helper.gradient_clip(
+        gradients, max_gradient_norm=1.0)
+    self.assertIsInstance(clipped_gradients[0], tf.IndexedSlices)
+
+    with self.test_session() as sess:
+      (gradient_norm, indices, sparse_gradient, dense_gradient) = sess.run(
+          [gradient_norm, clipped_gradients[0].indices,
+           tf.convert_to_tensor(clipped_gradients[0]), clipped_gradients[1]])
+
+    # The norm of the dense embedding gradient, not of the duplicated rows.
+    self.assertAllClose(np.sqrt(12.0), gradient_norm)
+    self.assertAllEqual([1, 3], indices)
+    scale = 1.0 / np.sqrt(12.0)
+    expected = np.zeros([6, 2], dtype=np.float32)
+    expected[1] = 2.0 * scale
+    expected[3] = scale
+    self.assertAllClose(expected, sparse_gradient)
+    self.assertAllClose([[scale, scale]], dense_gradient)
+
+
+if __name__ == "__main__":
+  tf.test.main()
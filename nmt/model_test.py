@@ -18,6 +18,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import pprint
 import sys
 import numpy as np
@@ -479,6 +480,66 @@ class ModelTest(tf.test.TestCase):
         infer_m = self._createTestInferModel(model.Model, hparams, sess)
         self._assertInferLogits(infer_m, sess, 'NoAttentionResidualBiEncoder')
 
+  def testFusedRnnMatchesBasicLstm(self):
+    hparams = common_test_utils.create_test_hparams(
+        encoder_type='bi',
+        num_layers=4,
+        attention='',
+        attention_architecture='',
+        use_residual=True,)
+    ckpt = os.path.join(self.get_temp_dir(), 'fused_rnn_test')
+
+    with tf.Graph().as_default():
+      with tf.Session(config=self._get_session_config()) as sess:
+        eval_m = self._createTestEvalModel(model.Model, hparams, sess)
+        sess.run(tf.global_variables_initializer())
+        var_names = sorted(v.name for v in tf.trainable_variables())
+        eval_loss, _, _ = eval_m.eval(sess)
+        eval_m.saver.save(sess, ckpt)
+
+    # The fused model restores the checkpoint and computes the same loss.
+    hparams.use_fused_rnn = True
+    with tf.Graph().as_default():
+      with tf.Session(config=self._get_session_config()) as sess:
+        eval_m = self._createTestEvalModel(model.Model, hparams, sess)
+        self.assertEqual(var_names,
+                         sorted(v.name for v in tf.trainable_variables()))
+        eval_m.saver.restore(sess, ckpt)
+        fused_eval_loss, _, _ = eval_m.eval(sess)
+
+    self.assertAllClose(eval_loss, fused_eval_loss)
+
+  def testSruEncoderMatchesSruCell(self):
+    hparams = common_test_utils.create_test_hparams(
+        unit_type='sru',
+        encoder_type='bi',
+        num_layers=4,
+        attention='',
+        attention_architecture='',
+        use_residual=True,)
+    ckpt = os.path.join(self.get_temp_dir(), 'sru_test')
+
+    # Time major, the encoder projects the inputs of all steps at once.
+    with tf.Graph().as_default():
+      with tf.Session(config=self._get_session_config()) as sess:
+        eval_m = self._createTestEvalModel(model.Model, hparams, sess)
+        sess.run(tf.global_variables_initializer())
+        var_names = sorted(v.name for v in tf.trainable_variables())
+        eval_loss, _, _ = eval_m.eval(sess)
+        eval_m.saver.save(sess, ckpt)
+
+    # Batch major, the encoder steps SRUCells in dynamic_rnn.
+    hparams.time_major = False
+    with tf.Graph().as_default():
+      with tf.Session(config=self._get_session_config()) as sess:
+        eval_m = self._createTestEvalModel(model.Model, hparams, sess)
+        self.assertEqual(var_names,
+                         sorted(v.name for v in tf.trainable_variables()))
+        eval_m.saver.restore(sess, ckpt)
+        cell_eval_loss, _, _ = eval_m.eval(sess)
+
+    self.assertAllClose(eval_loss, cell_eval_loss)
+
   ## Test attention mechanisms: luong, scaled_luong, bahdanau, normed_bahdanau
   def testAttentionMechanismLuong(self):
     hparams = common_test_utils.create_test_hparams(
@@ -850,6 +911,128 @@ class ModelTest(tf.test.TestCase):
         self._assertInferLogits(infer_m, sess,
                                 'UniEncoderStandardAttentionArchitecture')
 
+  def testSampledSoftmaxLoss(self):
+    hparams = common_test_utils.create_test_hparams(
+        encoder_type='uni',
+        num_layers=1,
+        attention='',
+        attention_architecture='',
+        use_residual=False,)
+    hparams.num_sampled_softmax = 2
+
+    with tf.Graph().as_default():
+      with tf.Session(config=self._get_session_config()) as sess:
+        train_m = self._createTestTrainModel(model.Model, hparams, sess)
+        # The train graph has the output projection used by eval and infer.
+        self.assertIn('dynamic_seq2seq/decoder/output_projection/kernel:0',
+                      [v.name for v in tf.trainable_variables()])
+        _, loss, _, _, _, _, _, _, _ = train_m.train(sess)
+        self.assertTrue(np.isfinite(loss))
+
+    with tf.Graph().as_default():
+      with tf.Session(config=self._get_session_config()) as sess:
+        eval_m = self._createTestEvalModel(model.Model, hparams, sess)
+        sess.run(tf.global_variables_initializer())
+        loss, _, _ = eval_m.eval(sess)
+        self.assertTrue(np.isfinite(loss))
+
+  def testTiedEmbeddings(self):
+    hparams = common_test_utils.create_test_hparams(
+        encoder_type='uni',
+        num_layers=1,
+        attention='scaled_luong',
+        attention_architecture='standard',
+        use_residual=False,
+        beam_width=3)
+    hparams.share_vocab = True
+    hparams.tie_embeddings = True
+
+    with tf.Graph().as_default():
+      with tf.Session(config=self._get_session_config()) as sess:
+        train_m = self._createTestTrainModel(attention_model.AttentionModel,
+                                             hparams, sess)
+        # A single embedding is also the output projection.
+        var_names = [v.name for v in tf.trainable_variables()]
+        self.assertEqual(['dynamic_seq2seq/embedding_share:0'],
+                         [name for name in var_names if 'embedding' in name])
+        self.assertFalse(
+            [name for name in var_names if 'output_projection' in name])
+        _, loss, _, _, _, _, _, _, _ = train_m.train(sess)
+        self.assertTrue(np.isfinite(loss))
+
+    with tf.Graph().as_default():
+      with tf.Session(config=self._get_session_config()) as sess:
+        infer_m = self._createTestInferModel(
+            attention_model.AttentionModel, hparams, sess, True)
+        nmt_outputs, _ = infer_m.decode(sess)
+        # [beam_width, batch_size, time]
+        self.assertEqual(3, nmt_outputs.shape[0])
+
+  def testFactorizedEmbeddings(self):
+    hparams = common_test_utils.create_test_hparams(
+        encoder_type='bi',
+        num_layers=2,
+        attention='scaled_luong',
+        attention_architecture='standard',
+        use_residual=False,
+        beam_width=3)
+    hparams.embed_dim = 3
+    hparams.num_embeddings_partitions = 2
+
+    with tf.Graph().as_default():
+      with tf.Session(config=self._get_session_config()) as sess:
+        train_m = self._createTestTrainModel(attention_model.AttentionModel,
+                                             hparams, sess)
+        var_shapes = dict((v.name, v.get_shape().as_list())
+                          for v in tf.trainable_variables())
+        self.assertEqual(
+            3, var_shapes['dynamic_seq2seq/encoder/embedding_encoder/part_0:0'][1])
+        self.assertEqual(
+            [3, 5],
+            var_shapes['dynamic_seq2seq/encoder/embedding_encoder_projection:0'])
+        self.assertEqual(
+            [3, 5],
+            var_shapes['dynamic_seq2seq/decoder/embedding_decoder_projection:0'])
+        _, loss, _, _, _, _, _, _, _ = train_m.train(sess)
+        self.assertTrue(np.isfinite(loss))
+
+    with tf.Graph().as_default():
+      with tf.Session(config=self._get_session_config()) as sess:
+        infer_m = self._createTestInferModel(
+            attention_model.AttentionModel, hparams, sess, True)
+        nmt_outputs, _ = infer_m.decode(sess)
+        # [beam_width, batch_size, time]
+        self.assertEqual(3, nmt_outputs.shape[0])
+
+  def testTransformerEncoderAttentionModel(self):
+    hparams = common_test_utils.create_test_hparams(
+        encoder_type='transformer',
+        num_layers=2,
+        attention='scaled_luong',
+        attention_architecture='standard',
+        beam_width=3)
+    hparams.num_attention_heads = 1
+    hparams.pass_hidden_state = False
+
+    with tf.Graph().as_default():
+      with tf.Session(config=self._get_session_config()) as sess:
+        train_m = self._createTestTrainModel(attention_model.AttentionModel,
+                                             hparams, sess)
+        var_names = [v.name for v in tf.trainable_variables()]
+        self.assertIn(
+            'dynamic_seq2seq/encoder/layer_1/self_attention/qkv/kernel:0',
+            var_names)
+        _, loss, _, _, _, _, _, _, _ = train_m.train(sess)
+        self.assertTrue(np.isfinite(loss))
+
+    with tf.Graph().as_default():
+      with tf.Session(config=self._get_session_config()) as sess:
+        infer_m = self._createTestInferModel(
+            attention_model.AttentionModel, hparams, sess, True)
+        nmt_outputs, _ = infer_m.decode(sess)
+        # [beam_width, batch_size, time]
+        self.assertEqual(3, nmt_outputs.shape[0])
+
   # Test gnmt model.
   def _testGNMTModel(self, architecture):
     hparams = common_test_utils.create_test_hparams(
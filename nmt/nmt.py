@@ -17,31 +17,61 @@
 from __future__ import print_function
 
 import argparse
+import collections
+import importlib
 import os
 import random
 import sys
+import time
 
+_start_time = time.time()
 # import matplotlib.image as mpimg
 import numpy as np
 import tensorflow as tf
 
-from . import inference
-from . import train
-from .utils import evaluation_utils
 from .utils import misc_utils as utils
 from .utils import vocab_utils
 
-utils.check_tensorflow_version()
+# Import times of the modules loaded by this file, see --report_import_times.
+# The train, inference, sweep and evaluation modules pull in the models and
+# tf.contrib, so they are only imported by the code paths that need them.
+_import_times = collections.OrderedDict(
+    [("tensorflow and nmt.utils", time.time() - _start_time)])
 
 FLAGS = None
 
 
+def _import(name):
+  """Import the nmt module name on first use and record its import time.
+
+  A module imported by an earlier one is already loaded and takes no time,
+  its import time is part of the earlier one.
+  """
+  start_time = time.time()
+  module = importlib.import_module("." + name, __package__)
+  if name not in _import_times:
+    _import_times[name] = time.time() - start_time
+  return module
+
+
+def _print_import_times():
+  utils.print_out("# Import times")
+  for name, import_time in _import_times.items():
+    utils.print_out("  %s %.2fs" % (name, import_time))
+  utils.print_out("  total %.2fs" % sum(_import_times.values()))
+
+
 def add_arguments(parser):
   """Build ArgumentParser."""
   parser.register("type", "bool", lambda v: v.lower() == "true")
 
   # network
   parser.add_argument("--num_units", type=int, default=32, help="Network size.")
+  parser.add_argument("--embed_dim", type=int, default=0,
+                      help="""\
+      Size of factorized source and target embeddings, which are projected to
+      num_units. 0 uses num_units-sized embeddings without projections.\
+      """)
   parser.add_argument("--num_layers", type=int, default=2,
                       help="Network depth.")
   parser.add_argument("--num_encoder_layers", type=int, default=None,
@@ -49,10 +79,18 @@ def add_arguments(parser):
   parser.add_argument("--num_decoder_layers", type=int, default=None,
                       help="Decoder depth, equal to num_layers if None.")
   parser.add_argument("--encoder_type", type=str, default="uni", help="""\
-      uni | bi | gnmt.
+      uni | bi | gnmt | transformer.
       For bi, we build num_encoder_layers/2 bi-directional layers.
       For gnmt, we build 1 bi-directional layer, and (num_encoder_layers - 1)
-        uni-directional layers.\
+        uni-directional layers.
+      For transformer, we build num_encoder_layers self-attention layers, which
+        need an attention decoder.\
+      """)
+  parser.add_argument("--num_attention_heads", type=int, default=4,
+                      help="Attention heads of the transformer encoder.")
+  parser.add_argument("--transformer_ffn_units", type=int, default=0,
+                      help="""\
+      Hidden feed forward depth of the transformer encoder, 4 * num_units if 0.\
       """)
   parser.add_argument("--residual", type="bool", nargs="?", const=True,
                       default=False,
@@ -97,7 +135,11 @@ def add_arguments(parser):
       """)
 
   # optimizer
-  parser.add_argument("--optimizer", type=str, default="sgd", help="sgd | adam")
+  parser.add_argument("--optimizer", type=str, default="sgd", help="""\
+      sgd | adam | lazy_adam.
+      lazy_adam only updates the Adam moments of the embedding rows in the
+      batch, which is faster for large vocabularies.\
+      """)
   parser.add_argument("--learning_rate", type=float, default=1.0,
                       help="Learning rate. Adam: 0.001 | 0.0001")
   parser.add_argument("--warmup_steps", type=int, default=0,
@@ -139,7 +181,26 @@ def add_arguments(parser):
   parser.add_argument("--tgt", type=str, default=None,
                       help="Target suffix, e.g., de.")
   parser.add_argument("--train_prefix", type=str, default=None,
-                      help="Train prefix, expect files with src/tgt suffixes.")
+                      help="""\
+      Train prefix, expect files with src/tgt suffixes. May be a glob pattern
+      such as data/train-* to read several aligned shards. Files may be .gz or
+      .zst compressed. zstd is decompressed in python, so a single .zst file
+      is read serially; shard it to decompress num_parallel_reads files at
+      once.\
+      """)
+  parser.add_argument("--train_manifest", type=str, default=None,
+                      help="""\
+      File listing one train shard prefix per line. Overrides train_prefix.\
+      """)
+  parser.add_argument("--num_parallel_reads", type=int, default=4,
+                      help="Number of train shards read concurrently.")
+  parser.add_argument("--train_mixture", type=str, default=None,
+                      help="""\
+      Comma-separated prefix:weight pairs, e.g. data/in:3,data/web:1, to
+      sample train pairs from several corpora on the fly with the given
+      ratios. A prefix may be a glob pattern of shards. Overrides
+      train_prefix and train_manifest.\
+      """)
   parser.add_argument("--dev_prefix", type=str, default=None,
                       help="Dev prefix, expect files with src/tgt suffixes.")
   parser.add_argument("--test_prefix", type=str, default=None,
@@ -165,6 +226,13 @@ def add_arguments(parser):
       Whether to use the source vocab and embeddings for both source and
       target.\
       """)
+  parser.add_argument("--tie_embeddings", type="bool", nargs="?", const=True,
+                      default=False,
+                      help="""\
+      Whether to use the target embedding as the output projection (and, with
+      share_vocab, as the source embedding as well). A pretrained target
+      embedding is then trainable for all tokens.\
+      """)
   parser.add_argument("--check_special_token", type="bool", default=True,
                       help="""\
                       Whether check special sos, eos, unk tokens exist in the
@@ -186,13 +254,39 @@ def add_arguments(parser):
 
   # Default settings works well (rarely need to change)
   parser.add_argument("--unit_type", type=str, default="lstm",
-                      help="lstm | gru | layer_norm_lstm | nas")
+                      help="lstm | gru | layer_norm_lstm | nas | sru")
   parser.add_argument("--forget_bias", type=float, default=1.0,
                       help="Forget bias for BasicLSTMCell.")
+  parser.add_argument("--use_fused_rnn", type="bool", nargs="?", const=True,
+                      default=False,
+                      help="""\
+      Run lstm cells with fused kernels: LSTMBlockCell steps, and one
+      LSTMBlockFusedCell op per layer over the whole sequence for time major
+      encoders. Checkpoints are compatible with the non-fused cells.\
+      """)
   parser.add_argument("--dropout", type=float, default=0.2,
                       help="Dropout rate (not keep_prob)")
   parser.add_argument("--max_gradient_norm", type=float, default=5.0,
                       help="Clip gradients to this norm.")
+  parser.add_argument("--output_projection_rank", type=int, default=0,
+                      help="""\
+      Factorize the output projection into [num_units, rank] and [rank,
+      tgt_vocab_size] kernels, e.g. for models written by compress.py. 0 uses
+      a single kernel.\
+      """)
+  parser.add_argument("--num_sampled_softmax", type=int, default=0,
+                      help="""\
+      Train with a sampled softmax over this many target words drawn from a
+      log-uniform distribution (the vocab file should be sorted by frequency)
+      instead of the full softmax. Eval and inference use the full softmax.
+      0 disables it.\
+      """)
+  parser.add_argument("--loss_chunk_size", type=int, default=0,
+                      help="""\
+      Project the decoder outputs and compute the train/eval loss this many
+      time steps at a time, recomputing the logits in the backward pass, to
+      bound the memory of the logits. 0 projects all time steps at once.\
+      """)
   parser.add_argument("--batch_size", type=int, default=128, help="Batch size.")
 
   parser.add_argument("--steps_per_stats", type=int, default=100,
@@ -202,6 +296,45 @@ def add_arguments(parser):
                       help="Limit on the size of training data (0: no limit).")
   parser.add_argument("--num_buckets", type=int, default=5,
                       help="Put data into similar-length buckets.")
+  parser.add_argument("--repeat_train_data", type="bool", nargs="?",
+                      const=True, default=False,
+                      help="""\
+      Stream the training data over epochs instead of re-initializing the
+      iterator at the end of each epoch. The end-of-epoch evaluation then runs
+      in the background while training continues.\
+      """)
+  parser.add_argument("--steps_per_epoch", type=int, default=0,
+                      help="""\
+      Training steps per epoch with repeat_train_data. 0 counts the non-empty
+      train pairs once and caches the count in out_dir. Required with a
+      train_mixture.\
+      """)
+  parser.add_argument("--input_memory_budget_mb", type=int, default=0,
+                      help="""\
+      Host memory (MB) the train/eval input pipelines may use for buffering.
+      Buffer sizes and map parallelism are derived from it, and the chosen
+      values are logged. 0 keeps the default batch_size * 1000 buffers.\
+      """)
+  parser.add_argument("--lazy_graph_build", type="bool", nargs="?",
+                      const=True, default=False,
+                      help="""\
+      Build the eval and infer graphs in a background thread while training
+      starts, and skip the evaluation before the first training step. The
+      first eval then waits until the graphs are ready.\
+      """)
+  parser.add_argument("--cache_graphs", type="bool", nargs="?", const=True,
+                      default=False,
+                      help="""\
+      Export the train/eval/infer graphs to out_dir/graph_cache and import
+      them on restart instead of building them, as long as the hparams are
+      unchanged.\
+      """)
+  parser.add_argument("--batch_first_preprocessing", type="bool", nargs="?",
+                      const=True, default=False,
+                      help="""\
+      Batch raw lines before tokenizing, so that splitting, vocab lookup and
+      length computation run once per batch instead of once per sentence.\
+      """)
 
   # SPM
   parser.add_argument("--subword_option", type=str, default="",
@@ -240,6 +373,34 @@ def add_arguments(parser):
                       Average the last N checkpoints for external evaluation.
                       N can be controlled by setting --num_keep_ckpts.\
                       """))
+  parser.add_argument("--eval_time_fraction", type=float, default=0.0,
+                      help="""\
+      If > 0, adapt the internal and external eval intervals to keep eval,
+      sample decoding and checkpointing under this fraction of wall-clock
+      time, e.g. 0.1. steps_per_external_eval is only the first interval.\
+      """)
+  parser.add_argument("--eval_sets", type=str, default="",
+                      help="""\
+      Extra eval sets as comma-separated name:prefix pairs, e.g.
+      nt2014:data/newstest2014,nt2015:data/newstest2015. When set, the
+      external eval decodes dev, test and these sets together in one pass and
+      reports scores per set.\
+      """)
+  parser.add_argument("--eval_subset_size", type=int, default=0,
+                      help="""\
+      If > 0, external evals decode a fixed, length-stratified subset of this
+      many dev sentences, and the full dev/test sets only every
+      full_eval_every evals and at the end of training.\
+      """)
+  parser.add_argument("--full_eval_every", type=int, default=10,
+                      help="Run a full external eval every N evals when "
+                           "eval_subset_size > 0.")
+  parser.add_argument("--best_metric_source", type=str, default="full",
+                      choices=["full", "subset"],
+                      help="""\
+      Which external evals pick the best checkpoints when eval_subset_size > 0:
+      the full dev set or the dev subset.\
+      """)
 
   # Inference
   parser.add_argument("--ckpt", type=str, default="",
@@ -251,12 +412,36 @@ def add_arguments(parser):
                             "(0-based) to decode."))
   parser.add_argument("--infer_batch_size", type=int, default=32,
                       help="Batch size for inference mode.")
+  parser.add_argument("--eval_batch_size", type=int, default=0,
+                      help="""\
+      Batch size for perplexity eval, which sorts the eval data by length and
+      keeps no gradients, so it can be much larger than batch_size
+      (0: use batch_size).\
+      """)
+  parser.add_argument("--eval_batch_tokens", type=int, default=0,
+                      help="""\
+      If > 0, batch perplexity eval by this many tokens per side instead of
+      eval_batch_size sentences.\
+      """)
   parser.add_argument("--inference_output_file", type=str, default=None,
                       help="Output file to store decoding results.")
   parser.add_argument("--inference_ref_file", type=str, default=None,
                       help=("""\
       Reference file to compute evaluation scores (if provided).\
       """))
+  parser.add_argument("--sweep_checkpoints", type="bool", nargs="?",
+                      const=True, default=False,
+                      help="""\
+      Evaluate every checkpoint in out_dir on inference_input_file against
+      inference_ref_file, and write a step-vs-metric table to out_dir/sweep.
+      Results are cached per checkpoint, so reruns skip finished ones.\
+      """)
+  parser.add_argument("--sweep_min_step", type=int, default=0,
+                      help="Skip checkpoints before this step when sweeping.")
+  parser.add_argument("--sweep_max_step", type=int, default=None,
+                      help="Skip checkpoints after this step when sweeping.")
+  parser.add_argument("--sweep_num_workers", type=int, default=1,
+                      help="Number of processes evaluating checkpoints.")
   parser.add_argument("--beam_width", type=int, default=0,
                       help=("""\
       beam width when using beam search decoder. If 0 (default), use standard
@@ -285,6 +470,9 @@ def add_arguments(parser):
                       help="number of inter_op_parallelism_threads")
   parser.add_argument("--num_intra_threads", type=int, default=0,
                       help="number of intra_op_parallelism_threads")
+  parser.add_argument("--report_import_times", type="bool", nargs="?",
+                      const=True, default=False,
+                      help="Print the time spent importing modules.")
 
 
 def create_hparams(flags):
@@ -295,6 +483,9 @@ def create_hparams(flags):
       src=flags.src,
       tgt=flags.tgt,
       train_prefix=flags.train_prefix,
+      train_manifest=flags.train_manifest,
+      num_parallel_reads=flags.num_parallel_reads,
+      train_mixture=flags.train_mixture,
       dev_prefix=flags.dev_prefix,
       test_prefix=flags.test_prefix,
       vocab_prefix=flags.vocab_prefix,
@@ -303,12 +494,15 @@ def create_hparams(flags):
 
       # Networks
       num_units=flags.num_units,
+      embed_dim=flags.embed_dim,
       num_layers=flags.num_layers,  # Compatible
       num_encoder_layers=(flags.num_encoder_layers or flags.num_layers),
       num_decoder_layers=(flags.num_decoder_layers or flags.num_layers),
       dropout=flags.dropout,
       unit_type=flags.unit_type,
       encoder_type=flags.encoder_type,
+      num_attention_heads=flags.num_attention_heads,
+      transformer_ffn_units=flags.transformer_ffn_units,
       residual=flags.residual,
       time_major=flags.time_major,
       num_embeddings_partitions=flags.num_embeddings_partitions,
@@ -326,6 +520,9 @@ def create_hparams(flags):
       init_op=flags.init_op,
       init_weight=flags.init_weight,
       max_gradient_norm=flags.max_gradient_norm,
+      output_projection_rank=flags.output_projection_rank,
+      num_sampled_softmax=flags.num_sampled_softmax,
+      loss_chunk_size=flags.loss_chunk_size,
       learning_rate=flags.learning_rate,
       warmup_steps=flags.warmup_steps,
       warmup_scheme=flags.warmup_scheme,
@@ -335,6 +532,12 @@ def create_hparams(flags):
       # Data constraints
       num_buckets=flags.num_buckets,
       max_train=flags.max_train,
+      repeat_train_data=flags.repeat_train_data,
+      steps_per_epoch=flags.steps_per_epoch,
+      input_memory_budget_mb=flags.input_memory_budget_mb,
+      batch_first_preprocessing=flags.batch_first_preprocessing,
+      lazy_graph_build=flags.lazy_graph_build,
+      cache_graphs=flags.cache_graphs,
       src_max_len=flags.src_max_len,
       tgt_max_len=flags.tgt_max_len,
 
@@ -342,6 +545,8 @@ def create_hparams(flags):
       src_max_len_infer=flags.src_max_len_infer,
       tgt_max_len_infer=flags.tgt_max_len_infer,
       infer_batch_size=flags.infer_batch_size,
+      eval_batch_size=flags.eval_batch_size,
+      eval_batch_tokens=flags.eval_batch_tokens,
       beam_width=flags.beam_width,
       length_penalty_weight=flags.length_penalty_weight,
       sampling_temperature=flags.sampling_temperature,
@@ -355,17 +560,24 @@ def create_hparams(flags):
 
       # Misc
       forget_bias=flags.forget_bias,
+      use_fused_rnn=flags.use_fused_rnn,
       num_gpus=flags.num_gpus,
       epoch_step=0,  # record where we were within an epoch.
       steps_per_stats=flags.steps_per_stats,
       steps_per_external_eval=flags.steps_per_external_eval,
       share_vocab=flags.share_vocab,
+      tie_embeddings=flags.tie_embeddings,
       metrics=flags.metrics.split(","),
       log_device_placement=flags.log_device_placement,
       random_seed=flags.random_seed,
       override_loaded_hparams=flags.override_loaded_hparams,
       num_keep_ckpts=flags.num_keep_ckpts,
       avg_ckpts=flags.avg_ckpts,
+      eval_time_fraction=flags.eval_time_fraction,
+      eval_sets=flags.eval_sets,
+      eval_subset_size=flags.eval_subset_size,
+      full_eval_every=flags.full_eval_every,
+      best_metric_source=flags.best_metric_source,
       num_intra_threads=flags.num_intra_threads,
       num_inter_threads=flags.num_inter_threads,
   )
@@ -385,6 +597,26 @@ def extend_hparams(hparams):
   if hparams.encoder_type == "bi" and hparams.num_encoder_layers % 2 != 0:
     raise ValueError("For bi, num_encoder_layers %d should be even" %
                      hparams.num_encoder_layers)
+  if not 0 <= hparams.embed_dim <= hparams.num_units:
+    raise ValueError("embed_dim %d should be in [0, num_units %d]" %
+                     (hparams.embed_dim, hparams.num_units))
+  if not 0 <= hparams.output_projection_rank <= hparams.num_units:
+    raise ValueError("output_projection_rank %d should be in [0, num_units %d]"
+                     % (hparams.output_projection_rank, hparams.num_units))
+  if hparams.output_projection_rank and hparams.tie_embeddings:
+    raise ValueError("Can't factorize a tied output projection, use embed_dim "
+                     "instead")
+  if hparams.encoder_type == "transformer":
+    if not hparams.attention:
+      raise ValueError("The transformer encoder needs an attention decoder")
+    if hparams.num_units % hparams.num_attention_heads != 0:
+      raise ValueError("For transformer, num_units %d should be divisible by "
+                       "num_attention_heads %d" %
+                       (hparams.num_units, hparams.num_attention_heads))
+    if hparams.pass_hidden_state:
+      hparams.pass_hidden_state = False
+      utils.print_out("The transformer encoder has no recurrent state, so set "
+                      "pass_hidden_state to False")
   if (hparams.attention_architecture in ["gnmt"] and
       hparams.num_encoder_layers < 2):
     raise ValueError("For gnmt attention architecture, "
@@ -415,11 +647,19 @@ def extend_hparams(hparams):
   if hparams.subword_option and hparams.subword_option not in ["spm", "bpe"]:
     raise ValueError("subword option must be either spm, or bpe")
 
+  if not 0.0 <= hparams.eval_time_fraction < 1.0:
+    raise ValueError("eval_time_fraction must be in [0, 1), got %g" %
+                     hparams.eval_time_fraction)
+
   # Flags
   utils.print_out("# hparams:")
   utils.print_out("  src=%s" % hparams.src)
   utils.print_out("  tgt=%s" % hparams.tgt)
   utils.print_out("  train_prefix=%s" % hparams.train_prefix)
+  if hparams.train_manifest:
+    utils.print_out("  train_manifest=%s" % hparams.train_manifest)
+  if hparams.train_mixture:
+    utils.print_out("  train_mixture=%s" % hparams.train_mixture)
   utils.print_out("  dev_prefix=%s" % hparams.dev_prefix)
   utils.print_out("  test_prefix=%s" % hparams.test_prefix)
   utils.print_out("  out_dir=%s" % hparams.out_dir)
@@ -456,6 +696,10 @@ def extend_hparams(hparams):
         unk=vocab_utils.UNK)
   hparams.add_hparam("src_vocab_size", src_vocab_size)
   hparams.add_hparam("tgt_vocab_size", tgt_vocab_size)
+  if hparams.num_sampled_softmax >= tgt_vocab_size:
+    raise ValueError("num_sampled_softmax %d should be smaller than the target "
+                     "vocab size %d" %
+                     (hparams.num_sampled_softmax, tgt_vocab_size))
   hparams.add_hparam("src_vocab_file", src_vocab_file)
   hparams.add_hparam("tgt_vocab_file", tgt_vocab_file)
 
@@ -514,6 +758,13 @@ def ensure_compatible_hparams(hparams, default_hparams, hparams_path):
                         (key, str(getattr(hparams, key)),
                          str(default_config[key])))
         setattr(hparams, key, default_config[key])
+
+  # Mixture weights always follow the command line, so that the data ratios
+  # can change from one run to the next.
+  if hparams.train_mixture != default_config["train_mixture"]:
+    utils.print_out("# Updating hparams.train_mixture: %s -> %s" %
+                    (hparams.train_mixture, default_config["train_mixture"]))
+    hparams.train_mixture = default_config["train_mixture"]
   return hparams
 
 
@@ -542,6 +793,8 @@ def create_or_load_hparams(
 
 def run_main(flags, default_hparams, train_fn, inference_fn, target_session=""):
   """Run main."""
+  utils.check_tensorflow_version()
+
   # Job
   jobid = flags.jobid
   num_workers = flags.num_workers
@@ -562,7 +815,19 @@ def run_main(flags, default_hparams, train_fn, inference_fn, target_session=""):
   hparams = create_or_load_hparams(
       out_dir, default_hparams, flags.hparams_path, save_hparams=(jobid == 0))
 
-  if flags.inference_input_file:
+  if flags.sweep_checkpoints:
+    # Checkpoint sweep
+    if not (flags.inference_input_file and flags.inference_ref_file):
+      raise ValueError("Sweeping checkpoints needs inference_input_file and "
+                       "inference_ref_file")
+    sweep = _import("sweep")
+    sweep.sweep(hparams, out_dir, flags.inference_input_file,
+                flags.inference_ref_file,
+                min_step=flags.sweep_min_step,
+                max_step=flags.sweep_max_step,
+                num_workers=flags.sweep_num_workers,
+                scope=flags.scope)
+  elif flags.inference_input_file:
     # Inference indices
     hparams.inference_indices = None
     if flags.inference_list:
@@ -580,6 +845,7 @@ def run_main(flags, default_hparams, train_fn, inference_fn, target_session=""):
     # Evaluation
     ref_file = flags.inference_ref_file
     if ref_file and tf.gfile.Exists(trans_file):
+      evaluation_utils = _import("utils.evaluation_utils")
       for metric in hparams.metrics:
         score = evaluation_utils.evaluate(
             ref_file,
@@ -591,10 +857,20 @@ def run_main(flags, default_hparams, train_fn, inference_fn, target_session=""):
     # Train
     train_fn(hparams, target_session=target_session)
 
+  if flags.report_import_times:
+    _print_import_times()
+
+
 def main(unused_argv):
   default_hparams = create_hparams(FLAGS)
-  train_fn = train.train
-  inference_fn = inference.inference
+  # Only import the modules of the job being run; run_main imports sweep
+  # itself for sweep_checkpoints.
+  train_fn, inference_fn = None, None
+  if not FLAGS.sweep_checkpoints:
+    if FLAGS.inference_input_file:
+      inference_fn = _import("inference").inference
+    else:
+      train_fn = _import("train").train
   run_main(FLAGS, default_hparams, train_fn, inference_fn)
 
 
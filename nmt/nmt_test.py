@@ -19,13 +19,18 @@ from __future__ import division
 
 
 import argparse
+import json
 import os
 import tensorflow as tf
 
 
+from . import compress
 from . import inference
 from . import nmt
+from . import prune_vocab
+from . import sweep
 from . import train
+from .utils import vocab_utils
 
 
 def _update_flags(flags, test_name):
@@ -76,6 +81,107 @@ class NMTTest(tf.test.TestCase):
     nmt.run_main(FLAGS, default_hparams, train_fn, None)
 
 
+  def testTrainWithGraphCache(self):
+    """Test a restarted training imports its graphs from the cache."""
+    nmt_parser = argparse.ArgumentParser()
+    nmt.add_arguments(nmt_parser)
+    FLAGS, unparsed = nmt_parser.parse_known_args()
+
+    _update_flags(FLAGS, "nmt_train_test_graph_cache")
+    FLAGS.num_train_steps = 10
+    FLAGS.cache_graphs = True
+
+    default_hparams = nmt.create_hparams(FLAGS)
+    nmt.run_main(FLAGS, default_hparams, train.train, None)
+    cache_dir = os.path.join(FLAGS.out_dir, "graph_cache")
+    cached_files = sorted(tf.gfile.ListDirectory(cache_dir))
+    self.assertEqual(6, len(cached_files))
+
+    # The restart imports the same graphs instead of caching new ones, also
+    # with more steps and other hparams that do not change the graphs.
+    FLAGS.num_train_steps = 12
+    FLAGS.steps_per_stats = 3
+    default_hparams = nmt.create_hparams(FLAGS)
+    nmt.run_main(FLAGS, default_hparams, train.train, None)
+    self.assertEqual(cached_files,
+                     sorted(tf.gfile.ListDirectory(cache_dir)))
+
+
+  def testTrainWithLazyGraphBuild(self):
+    """Test the eval graphs built in the background are used for evals."""
+    nmt_parser = argparse.ArgumentParser()
+    nmt.add_arguments(nmt_parser)
+    FLAGS, unparsed = nmt_parser.parse_known_args()
+
+    _update_flags(FLAGS, "nmt_train_test_lazy_graph_build")
+    FLAGS.lazy_graph_build = True
+
+    default_hparams = nmt.create_hparams(FLAGS)
+    nmt.run_main(FLAGS, default_hparams, train.train, None)
+    for output in ("output_dev", "output_test"):
+      self.assertTrue(tf.gfile.Exists(os.path.join(FLAGS.out_dir, output)))
+    # The startup times are logged after the first step.
+    log_files = tf.gfile.Glob(os.path.join(FLAGS.out_dir, "log_*"))
+    self.assertEqual(1, len(log_files))
+    with tf.gfile.GFile(log_files[0], "r") as f:
+      log = f.read()
+    self.assertIn("# Startup", log)
+    self.assertIn("train graph", log)
+    self.assertIn("first step", log)
+    self.assertNotIn("first eval", log)
+    self.assertIn("Eval/infer graphs built in the background", log)
+
+
+  def testTrainWithRepeatedData(self):
+    """Test the epoch length of repeated data is counted once and cached."""
+    nmt_parser = argparse.ArgumentParser()
+    nmt.add_arguments(nmt_parser)
+    FLAGS, unparsed = nmt_parser.parse_known_args()
+
+    _update_flags(FLAGS, "nmt_train_test_repeat")
+    FLAGS.num_train_steps = 10
+    FLAGS.batch_size = 32
+    FLAGS.repeat_train_data = True
+
+    default_hparams = nmt.create_hparams(FLAGS)
+    nmt.run_main(FLAGS, default_hparams, train.train, None)
+    with tf.gfile.GFile(
+        os.path.join(FLAGS.out_dir, "train_pairs.json"), "r") as f:
+      self.assertEqual(100, json.load(f)["num_pairs"])
+    hparams = nmt.create_or_load_hparams(
+        FLAGS.out_dir, default_hparams, None, save_hparams=False)
+    self.assertEqual(4, train._get_steps_per_epoch(hparams))
+    hparams.train_mixture = "nmt/testdata/iwslt15.tst2013.100:1"
+    with self.assertRaisesRegexp(ValueError, "steps_per_epoch"):
+      train._get_steps_per_epoch(hparams)
+    hparams.steps_per_epoch = 7
+    self.assertEqual(7, train._get_steps_per_epoch(hparams))
+
+
+  def testTrainWithMixtureRestart(self):
+    """Test a training on a mixture of corpora restarts from its checkpoint."""
+    nmt_parser = argparse.ArgumentParser()
+    nmt.add_arguments(nmt_parser)
+    FLAGS, unparsed = nmt_parser.parse_known_args()
+
+    _update_flags(FLAGS, "nmt_train_test_mixture")
+    FLAGS.num_train_steps = 10
+    FLAGS.train_mixture = ("nmt/testdata/iwslt15.tst2013.100:3,"
+                           "nmt/testdata/iwslt15.tst2013.*:1")
+
+    default_hparams = nmt.create_hparams(FLAGS)
+    nmt.run_main(FLAGS, default_hparams, train.train, None)
+    hparams = nmt.create_or_load_hparams(
+        FLAGS.out_dir, default_hparams, None, save_hparams=False)
+    self.assertGreater(hparams.epoch_step, 0)
+
+    # The restart resumes the endless mixture stream without skipping pairs.
+    hparams.num_train_steps = 20
+    train.train(hparams)
+    self.assertTrue(
+        tf.train.latest_checkpoint(FLAGS.out_dir).endswith("-20"))
+
+
   def testInference(self):
     """Test inference is function with basic hparams."""
     nmt_parser = argparse.ArgumentParser()
@@ -102,6 +208,139 @@ class NMTTest(tf.test.TestCase):
     inference_fn = inference.inference
     nmt.run_main(FLAGS, default_hparams, None, inference_fn)
 
+  def testMainWithReportImportTimes(self):
+    """Test main imports and reports the modules of each job."""
+    nmt_parser = argparse.ArgumentParser()
+    nmt.add_arguments(nmt_parser)
+    FLAGS, unparsed = nmt_parser.parse_known_args()
+
+    _update_flags(FLAGS, "nmt_main_import_times")
+    FLAGS.num_train_steps = 1
+    FLAGS.report_import_times = True
+
+    try:
+      nmt.FLAGS = FLAGS
+      nmt.main(None)
+      self.assertIn("train", nmt._import_times)
+
+      FLAGS.num_train_steps = 2
+      FLAGS.lazy_graph_build = True
+      FLAGS.override_loaded_hparams = True
+      nmt.main(None)
+
+      FLAGS.inference_input_file = ("nmt/testdata/"
+                                    "iwslt15.tst2013.100.en")
+      FLAGS.inference_output_file = os.path.join(FLAGS.out_dir, "output")
+      FLAGS.inference_ref_file = ("nmt/testdata/"
+                                  "iwslt15.tst2013.100.vi")
+      nmt.main(None)
+      self.assertIn("inference", nmt._import_times)
+      self.assertIn("utils.evaluation_utils", nmt._import_times)
+    finally:
+      nmt.FLAGS = None
+    self.assertTrue(tf.train.latest_checkpoint(FLAGS.out_dir).endswith("-2"))
+    self.assertTrue(tf.gfile.Exists(FLAGS.inference_output_file))
+
+
+  def testSweepCheckpoints(self):
+    """Test the checkpoint sweep evaluates and caches every checkpoint."""
+    nmt_parser = argparse.ArgumentParser()
+    nmt.add_arguments(nmt_parser)
+    FLAGS, unparsed = nmt_parser.parse_known_args()
+
+    _update_flags(FLAGS, "nmt_sweep")
+
+    # Train a few steps, with checkpoints at steps 0, 5 and 10.
+    FLAGS.num_train_steps = 10
+    FLAGS.steps_per_external_eval = 5
+    default_hparams = nmt.create_hparams(FLAGS)
+    nmt.run_main(FLAGS, default_hparams, train.train, None)
+
+    FLAGS.sweep_checkpoints = True
+    FLAGS.sweep_min_step = 5
+    FLAGS.inference_input_file = ("nmt/testdata/"
+                                  "iwslt15.tst2013.100.en")
+    FLAGS.inference_ref_file = ("nmt/testdata/"
+                                "iwslt15.tst2013.100.vi")
+    default_hparams = nmt.create_hparams(FLAGS)
+    nmt.run_main(FLAGS, default_hparams, None, None)
+
+    hparams = nmt.create_or_load_hparams(
+        FLAGS.out_dir, default_hparams, None, save_hparams=False)
+    results = sweep.sweep(hparams, FLAGS.out_dir, FLAGS.inference_input_file,
+                          FLAGS.inference_ref_file, min_step=5)
+    self.assertEqual([5, 10], [step for step, _ in results])
+    self.assertTrue(
+        tf.gfile.Exists(os.path.join(FLAGS.out_dir, "sweep", "results")))
+
+  def testCompress(self):
+    """Test a compressed model is written, evaluated and loadable."""
+    nmt_parser = argparse.ArgumentParser()
+    nmt.add_arguments(nmt_parser)
+    FLAGS, unparsed = nmt_parser.parse_known_args()
+
+    _update_flags(FLAGS, "nmt_compress")
+    FLAGS.num_train_steps = 10
+    default_hparams = nmt.create_hparams(FLAGS)
+    nmt.run_main(FLAGS, default_hparams, train.train, None)
+
+    hparams = nmt.create_or_load_hparams(
+        FLAGS.out_dir, default_hparams, None, save_hparams=False)
+    compress_dir = os.path.join(FLAGS.out_dir, "compressed")
+    dev_src = "nmt/testdata/iwslt15.tst2013.100.en"
+    dev_ref = "nmt/testdata/iwslt15.tst2013.100.vi"
+    compress.compress(hparams, tf.train.latest_checkpoint(FLAGS.out_dir),
+                      compress_dir, [0.5, 0.9], src_file=dev_src,
+                      ref_file=dev_ref, max_bleu_drop=100.0)
+    self.assertTrue(
+        tf.gfile.Exists(os.path.join(compress_dir, "report")))
+
+    # The compressed model is a model directory of its own.
+    FLAGS.out_dir = compress_dir
+    FLAGS.inference_input_file = dev_src
+    FLAGS.inference_output_file = os.path.join(compress_dir, "output")
+    default_hparams = nmt.create_hparams(FLAGS)
+    nmt.run_main(FLAGS, default_hparams, None, inference.inference)
+    compressed_hparams = nmt.create_or_load_hparams(
+        compress_dir, default_hparams, None, save_hparams=False)
+    self.assertLess(0, compressed_hparams.embed_dim)
+    self.assertLess(compressed_hparams.embed_dim, FLAGS.num_units)
+    self.assertLess(0, compressed_hparams.output_projection_rank)
+
+  def testPruneVocab(self):
+    """Test a model with pruned vocabs is written and loadable."""
+    nmt_parser = argparse.ArgumentParser()
+    nmt.add_arguments(nmt_parser)
+    FLAGS, unparsed = nmt_parser.parse_known_args()
+
+    _update_flags(FLAGS, "nmt_prune_vocab")
+    FLAGS.num_train_steps = 10
+    default_hparams = nmt.create_hparams(FLAGS)
+    nmt.run_main(FLAGS, default_hparams, train.train, None)
+
+    hparams = nmt.create_or_load_hparams(
+        FLAGS.out_dir, default_hparams, None, save_hparams=False)
+    prune_dir = os.path.join(FLAGS.out_dir, "pruned")
+    prune_vocab.prune_vocab(
+        hparams, tf.train.latest_checkpoint(FLAGS.out_dir), prune_dir,
+        src_vocab_size=20, tgt_vocab_size=30,
+        src_corpus_files=["nmt/testdata/iwslt15.tst2013.100.en"],
+        tgt_corpus_files=["nmt/testdata/iwslt15.tst2013.100.vi"])
+
+    # The pruned model is a model directory of its own.
+    FLAGS.out_dir = prune_dir
+    FLAGS.inference_input_file = "nmt/testdata/iwslt15.tst2013.100.en"
+    FLAGS.inference_output_file = os.path.join(prune_dir, "output")
+    default_hparams = nmt.create_hparams(FLAGS)
+    nmt.run_main(FLAGS, default_hparams, None, inference.inference)
+    pruned_hparams = nmt.create_or_load_hparams(
+        prune_dir, default_hparams, None, save_hparams=False)
+    self.assertEqual(20, pruned_hparams.src_vocab_size)
+    self.assertEqual(30, pruned_hparams.tgt_vocab_size)
+    new_vocab, _ = vocab_utils.load_vocab(pruned_hparams.tgt_vocab_file)
+    self.assertEqual(
+        [vocab_utils.UNK, vocab_utils.SOS, vocab_utils.EOS], new_vocab[:3])
+
 
 if __name__ == "__main__":
   tf.test.main()
@@ -0,0 +1,210 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Prune the rarest words from the vocabularies of a trained model.
+
+The words of the source and target vocabs are counted in a corpus (all the
+training files by default), and only the most frequent ones are kept. The
+embedding rows and output projection columns of the kept words are copied
+into a new model directory, with the trimmed vocab files. "<unk>", "<s>" and
+"</s>" stay at ids 0-2, and the other words are sorted by frequency.
+
+Usage:
+  python -m nmt.prune_vocab --out_dir=/tmp/nmt_model \
+      --prune_dir=/tmp/nmt_model_pruned \
+      --src_vocab_size=30000 --tgt_vocab_size=30000
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import codecs
+import collections
+import os
+import time
+
+import tensorflow as tf
+
+from . import compress
+from . import model_helper
+from .utils import misc_utils as utils
+from .utils import vocab_utils
+
+__all__ = ["prune_variables", "prune_vocab"]
+
+
+def prune_variables(values, src_ids, tgt_ids):
+  """Keep the embedding rows and output projection columns of kept words.
+
+  Args:
+    values: An OrderedDict of variable names to numpy values.
+    src_ids: Ids of the kept source words in the old vocab, in their new
+      order. Also used for a shared embedding.
+    tgt_ids: Same for the target words.
+
+  Returns:
+    An OrderedDict of the pruned variables.
+  """
+  pruned_values = collections.OrderedDict()
+  for name, value in values.items():
+    base_name = name.rsplit("/", 1)[-1]
+    if base_name in ("embedding_encoder", "embedding_share"):
+      value = value[src_ids]
+    elif base_name == "embedding_decoder":
+      value = value[tgt_ids]
+    elif (name.endswith("output_projection/kernel") or
+          name.endswith("output_projection/kernel_out")):
+      value = value[:, tgt_ids]
+    pruned_values[name] = value
+  return pruned_values
+
+
+def _select_words(vocab_file, counts, vocab_size, hparams):
+  """Ids of the kept words of vocab_file, and their coverage of counts."""
+  vocab, _ = vocab_utils.load_vocab(vocab_file)
+  if hparams.check_special_token and vocab[:3] != [
+      vocab_utils.UNK, hparams.sos, hparams.eos]:
+    raise ValueError("%s should start with %s, %s and %s" %
+                     (vocab_file, vocab_utils.UNK, hparams.sos, hparams.eos))
+  ids = vocab_utils.select_vocab_by_frequency(
+      vocab, counts, vocab_size or len(vocab))
+  total = sum(counts.values())
+  coverage = sum(counts.get(vocab[i], 0) for i in ids) / max(total, 1)
+  utils.print_out("  %s: %d -> %d words, %.2f%% of the corpus words" %
+                  (vocab_file, len(vocab), len(ids), 100.0 * coverage))
+  return [vocab[i] for i in ids], ids
+
+
+def _write_vocab(words, vocab_file):
+  with codecs.getwriter("utf-8")(tf.gfile.GFile(vocab_file, "wb")) as f:
+    for word in words:
+      f.write("%s\n" % word)
+
+
+def prune_vocab(hparams,
+                ckpt,
+                prune_dir,
+                src_vocab_size,
+                tgt_vocab_size,
+                src_corpus_files,
+                tgt_corpus_files,
+                scope=None):
+  """Prune the vocabs of the model of ckpt into prune_dir.
+
+  Args:
+    hparams: Hparams of the model of ckpt.
+    ckpt: Checkpoint to prune.
+    prune_dir: Directory of the pruned model.
+    src_vocab_size: Number of source words to keep, 0 to keep all.
+    tgt_vocab_size: Number of target words to keep, 0 to keep all. Ignored
+      with share_vocab, where src_vocab_size applies to the shared vocab.
+    src_corpus_files: List of the source files to count the words of.
+    tgt_corpus_files: List of the target files to count the words of.
+    scope: VariableScope of the model.
+
+  Returns:
+    The path of the pruned checkpoint.
+  """
+  start_time = time.time()
+  if hparams.tie_embeddings and hparams.tgt_embed_file:
+    raise ValueError("Can't prune a pretrained tied embedding")
+  utils.print_out("# Pruning the vocabs of %s into %s" % (ckpt, prune_dir))
+  tf.gfile.MakeDirs(prune_dir)
+
+  src_counts = collections.Counter()
+  for corpus_file in src_corpus_files:
+    src_counts.update(vocab_utils.count_words(corpus_file))
+  tgt_counts = collections.Counter()
+  for corpus_file in tgt_corpus_files:
+    tgt_counts.update(vocab_utils.count_words(corpus_file))
+  vocab_prefix = os.path.join(prune_dir, "vocab")
+  updates = {"vocab_prefix": vocab_prefix}
+  if hparams.share_vocab:
+    words, src_ids = _select_words(hparams.src_vocab_file,
+                                   src_counts + tgt_counts, src_vocab_size,
+                                   hparams)
+    tgt_ids = src_ids
+    vocab_file = "%s.%s" % (vocab_prefix, hparams.src)
+    _write_vocab(words, vocab_file)
+    updates.update(src_vocab_file=vocab_file, tgt_vocab_file=vocab_file,
+                   src_vocab_size=len(words), tgt_vocab_size=len(words))
+  else:
+    src_words, src_ids = _select_words(hparams.src_vocab_file, src_counts,
+                                       src_vocab_size, hparams)
+    tgt_words, tgt_ids = _select_words(hparams.tgt_vocab_file, tgt_counts,
+                                       tgt_vocab_size, hparams)
+    src_vocab_file = "%s.%s" % (vocab_prefix, hparams.src)
+    tgt_vocab_file = "%s.%s" % (vocab_prefix, hparams.tgt)
+    _write_vocab(src_words, src_vocab_file)
+    _write_vocab(tgt_words, tgt_vocab_file)
+    updates.update(src_vocab_file=src_vocab_file,
+                   tgt_vocab_file=tgt_vocab_file,
+                   src_vocab_size=len(src_words),
+                   tgt_vocab_size=len(tgt_words))
+
+  values = compress.load_serving_variables(hparams, ckpt, scope)
+  pruned_values = prune_variables(values, src_ids, tgt_ids)
+  _, pruned_ckpt = compress.write_model(
+      hparams, pruned_values, updates, prune_dir,
+      int(ckpt.rsplit("-", 1)[1]))
+  utils.print_out("  %d -> %d parameters" %
+                  (sum(v.size for v in values.values()),
+                   sum(v.size for v in pruned_values.values())))
+  utils.print_time("# Done pruning", start_time)
+  return pruned_ckpt
+
+
+def add_arguments(parser):
+  """Build ArgumentParser."""
+  parser.add_argument("--out_dir", type=str, required=True,
+                      help="Model directory to prune.")
+  parser.add_argument("--ckpt", type=str, default="",
+                      help="Checkpoint to prune, the latest by default.")
+  parser.add_argument("--prune_dir", type=str, required=True,
+                      help="Directory of the pruned model.")
+  parser.add_argument("--src_vocab_size", type=int, default=0,
+                      help="""\
+      Number of source words to keep, including <unk>, <s> and </s>. 0 keeps
+      all of them. With share_vocab, the size of the shared vocab.\
+      """)
+  parser.add_argument("--tgt_vocab_size", type=int, default=0,
+                      help="Number of target words to keep, 0 keeps all.")
+  parser.add_argument("--corpus_prefix", type=str, default=None,
+                      help="""\
+      Corpus to count the words of, e.g. en/vi files with suffixes .en/.vi.
+      All the model's training files by default, including the shards of a
+      glob train_prefix or train_manifest and the corpora of a train_mixture.\
+      """)
+
+
+def main(unused_argv=None):
+  parser = argparse.ArgumentParser()
+  add_arguments(parser)
+  flags = parser.parse_args()
+
+  hparams = compress.load_model_hparams(flags.out_dir)
+  ckpt = flags.ckpt or tf.train.latest_checkpoint(flags.out_dir)
+  if flags.corpus_prefix:
+    src_corpus_files = [utils.get_data_file(flags.corpus_prefix, hparams.src)]
+    tgt_corpus_files = [utils.get_data_file(flags.corpus_prefix, hparams.tgt)]
+  else:
+    src_corpus_files, tgt_corpus_files = model_helper.get_train_files(hparams)
+  prune_vocab(hparams, ckpt, flags.prune_dir,
+              flags.src_vocab_size, flags.tgt_vocab_size,
+              src_corpus_files, tgt_corpus_files)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,131 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Time the encoder and decoder RNNs of each unit type.
+
+Each unit type runs a time major encoder the way Model builds it (with
+model_helper.run_fused_rnn when there is a fused version) and a decoder
+stepping the cells of model_helper.create_rnn_cell, on random inputs. The
+time per train step (forward and backward) and per inference step (forward)
+is printed for each unit type.
+
+This only measures speed: compare the dev BLEU of full trainings with
+--unit_type=lstm and --unit_type=sru for quality.
+
+Usage:
+  python -m nmt.scripts.benchmark_rnn --unit_types=lstm,sru \
+      --num_units=512 --num_layers=2 --batch_size=128 --max_time=50
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+import tensorflow as tf
+
+from .. import model_helper
+
+
+def _build(unit_type, mode, num_units, num_layers, batch_size, max_time,
+           use_fused_rnn):
+  """Encoder and decoder outputs of unit_type on random inputs."""
+  inputs = tf.random_normal([max_time, batch_size, num_units])
+  sequence_length = tf.fill([batch_size], max_time)
+  kwargs = dict(num_units=num_units,
+                num_layers=num_layers,
+                num_residual_layers=num_layers - 1,
+                forget_bias=1.0,
+                dropout=0.2,
+                mode=mode,
+                num_gpus=0)
+
+  with tf.variable_scope("encoder"):
+    if unit_type == "sru" or (use_fused_rnn and unit_type == "lstm"):
+      encoder_outputs, encoder_state = model_helper.run_fused_rnn(
+          unit_type, inputs, sequence_length, dtype=tf.float32, **kwargs)
+    else:
+      encoder_outputs, encoder_state = tf.nn.dynamic_rnn(
+          model_helper.create_rnn_cell(unit_type, fused=use_fused_rnn,
+                                       **kwargs),
+          inputs, sequence_length=sequence_length, time_major=True,
+          dtype=tf.float32)
+
+  with tf.variable_scope("decoder"):
+    decoder_outputs, _ = tf.nn.dynamic_rnn(
+        model_helper.create_rnn_cell(unit_type, fused=use_fused_rnn,
+                                     **kwargs),
+        encoder_outputs, sequence_length=sequence_length,
+        initial_state=encoder_state, time_major=True)
+  return decoder_outputs
+
+
+def benchmark(unit_type, num_units, num_layers, batch_size, max_time,
+              num_steps, use_fused_rnn=False):
+  """Return the seconds per train step and per inference step."""
+  times = []
+  for mode in (tf.contrib.learn.ModeKeys.TRAIN,
+               tf.contrib.learn.ModeKeys.INFER):
+    with tf.Graph().as_default():
+      outputs = _build(unit_type, mode, num_units, num_layers, batch_size,
+                       max_time, use_fused_rnn)
+      if mode == tf.contrib.learn.ModeKeys.TRAIN:
+        fetch = tf.gradients(tf.reduce_sum(outputs),
+                             tf.trainable_variables())
+      else:
+        fetch = outputs
+      with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(fetch)  # Warm up.
+        start_time = time.time()
+        for _ in range(num_steps):
+          sess.run(fetch)
+        times.append((time.time() - start_time) / num_steps)
+  return times
+
+
+def add_arguments(parser):
+  """Build ArgumentParser."""
+  parser.add_argument("--unit_types", type=str, default="lstm,sru",
+                      help="Comma-separated unit types to compare.")
+  parser.add_argument("--num_units", type=int, default=512,
+                      help="Network size.")
+  parser.add_argument("--num_layers", type=int, default=2,
+                      help="Encoder and decoder depth.")
+  parser.add_argument("--batch_size", type=int, default=128,
+                      help="Batch size.")
+  parser.add_argument("--max_time", type=int, default=50,
+                      help="Sequence length.")
+  parser.add_argument("--num_steps", type=int, default=20,
+                      help="Number of timed steps.")
+  parser.add_argument("--use_fused_rnn", type="bool", nargs="?", const=True,
+                      default=False, help="Use the fused lstm kernels.")
+
+
+def main(unused_argv=None):
+  parser = argparse.ArgumentParser()
+  parser.register("type", "bool", lambda v: v.lower() == "true")
+  add_arguments(parser)
+  flags = parser.parse_args()
+
+  print("unit_type\ttrain ms/step\tinfer ms/step")
+  for unit_type in flags.unit_types.split(","):
+    train_time, infer_time = benchmark(
+        unit_type, flags.num_units, flags.num_layers, flags.batch_size,
+        flags.max_time, flags.num_steps, use_fused_rnn=flags.use_fused_rnn)
+    print("%s\t%.1f\t%.1f" % (unit_type, train_time * 1000, infer_time * 1000))
+
+
+if __name__ == "__main__":
+  main()
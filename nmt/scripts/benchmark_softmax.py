@@ -0,0 +1,108 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Time the full and the sampled softmax training losses.
+
+Both losses are computed the way Model computes them, from random decoder
+outputs through an output projection, and the time of a forward and backward
+pass is printed for the full softmax and for each number of samples.
+
+This only measures speed: compare the dev perplexity and BLEU of full
+trainings with and without --num_sampled_softmax for quality.
+
+Usage:
+  python -m nmt.scripts.benchmark_softmax --tgt_vocab_size=80000 \
+      --num_units=512 --batch_size=128 --max_time=50 \
+      --num_sampled=1024,4096
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+import tensorflow as tf
+
+
+def _build_loss(num_sampled, tgt_vocab_size, num_units, num_outputs):
+  """Loss of num_outputs random outputs, sampled if num_sampled > 0."""
+  outputs = tf.get_variable("outputs", [num_outputs, num_units])
+  kernel = tf.get_variable("kernel", [num_units, tgt_vocab_size])
+  labels = tf.random_uniform([num_outputs], maxval=tgt_vocab_size,
+                             dtype=tf.int64)
+  if num_sampled:
+    crossent = tf.nn.sampled_softmax_loss(
+        weights=tf.transpose(kernel),
+        biases=tf.zeros([tgt_vocab_size]),
+        labels=tf.expand_dims(labels, 1),
+        inputs=outputs,
+        num_sampled=num_sampled,
+        num_classes=tgt_vocab_size,
+        partition_strategy="div")
+  else:
+    crossent = tf.nn.sparse_softmax_cross_entropy_with_logits(
+        labels=labels, logits=tf.matmul(outputs, kernel))
+  return tf.reduce_sum(crossent)
+
+
+def benchmark(num_sampled, tgt_vocab_size, num_units, num_outputs,
+              num_steps):
+  """Return the seconds per forward and backward pass."""
+  with tf.Graph().as_default():
+    loss = _build_loss(num_sampled, tgt_vocab_size, num_units, num_outputs)
+    gradients = tf.gradients(loss, tf.trainable_variables())
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      sess.run(gradients)  # Warm up.
+      start_time = time.time()
+      for _ in range(num_steps):
+        sess.run(gradients)
+      return (time.time() - start_time) / num_steps
+
+
+def add_arguments(parser):
+  """Build ArgumentParser."""
+  parser.add_argument("--tgt_vocab_size", type=int, default=80000,
+                      help="Target vocab size.")
+  parser.add_argument("--num_units", type=int, default=512,
+                      help="Network size.")
+  parser.add_argument("--batch_size", type=int, default=128,
+                      help="Batch size.")
+  parser.add_argument("--max_time", type=int, default=50,
+                      help="Target length.")
+  parser.add_argument("--num_sampled", type=str, default="1024,4096",
+                      help="Comma-separated numbers of sampled words.")
+  parser.add_argument("--num_steps", type=int, default=20,
+                      help="Number of timed steps.")
+
+
+def main(unused_argv=None):
+  parser = argparse.ArgumentParser()
+  add_arguments(parser)
+  flags = parser.parse_args()
+
+  num_outputs = flags.batch_size * flags.max_time
+  full_time = benchmark(0, flags.tgt_vocab_size, flags.num_units, num_outputs,
+                        flags.num_steps)
+  print("num_sampled\tms/step\tspeedup")
+  print("full\t%.1f\t1.00" % (full_time * 1000))
+  for num_sampled in flags.num_sampled.split(","):
+    sampled_time = benchmark(int(num_sampled), flags.tgt_vocab_size,
+                             flags.num_units, num_outputs, flags.num_steps)
+    print("%s\t%.1f\t%.2f" % (num_sampled, sampled_time * 1000,
+                              full_time / sampled_time))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,324 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Shuffle an aligned parallel corpus that does not fit in memory.
+
+The shuffle is done on disk in two passes:
+1. every sentence pair is sent to a random bucket file, so each bucket holds
+   a uniform random sample of the corpus;
+2. workers shuffle the buckets in memory, in parallel, and write them to
+   output shards. A bucket that is still larger than the memory budget is
+   scattered again into smaller buckets first.
+
+Each output shard is then a random sample of the whole corpus in random
+order, so training can read the shards with --train_prefix=<output>-* and
+keep a small shuffle buffer.
+
+Usage:
+  python -m nmt.scripts.shuffle_corpus \
+      --input_prefix=data/train --src=en --tgt=de \
+      --output_prefix=data/shuffled/train --num_shards=16 \
+      --memory_mb=4096 --num_workers=4
+"""
+from __future__ import print_function
+
+import argparse
+import gzip
+import io
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+  import resource  # pylint: disable=g-import-not-at-top
+except ImportError:  # Windows
+  resource = None
+
+try:
+  import zstandard  # pylint: disable=g-import-not-at-top
+except ImportError:
+  zstandard = None
+
+# Compressed text is a few times smaller on disk than in memory.
+_COMPRESSED_EXPANSION = 4
+_COMPRESSED_SUFFIXES = (".gz", ".zst")
+# Open files left for the input, the output shards and python itself when
+# scattering into buckets.
+_RESERVED_FILES = 32
+# Buckets are sized to this fraction of a worker's memory, leaving room for
+# the python string overhead of the loaded lines.
+_BUCKET_MEMORY_FRACTION = 0.3
+
+
+def _open(filename, mode):
+  """Open a plain, gzip or zstd compressed file in binary mode.
+
+  zstd files can only be read, and need the zstandard package.
+  """
+  if filename.endswith(".gz"):
+    return gzip.open(filename, mode)
+  if filename.endswith(".zst"):
+    if zstandard is None or "r" not in mode:
+      raise ValueError("Can't open %s with mode %s, zstd files can only be "
+                       "read, with the zstandard package" % (filename, mode))
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+        open(filename, mode), closefd=True))
+  return open(filename, mode)
+
+
+def _file_bytes(filename):
+  """Estimated uncompressed size of a file."""
+  size = os.path.getsize(filename)
+  if filename.endswith(_COMPRESSED_SUFFIXES):
+    size *= _COMPRESSED_EXPANSION
+  return size
+
+
+def _max_buckets():
+  """Number of buckets _scatter can keep open, two files each."""
+  max_files = 512  # The default limit of the Windows C runtime.
+  if resource is not None:
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+      soft_limit = 1 << 20
+    max_files = soft_limit
+  return max(1, (max_files - _RESERVED_FILES) // 2)
+
+
+def _scatter(src_file, tgt_file, bucket_dir, num_buckets, rng):
+  """Send every sentence pair to a random bucket, returns the bucket files.
+
+  All the bucket files are open at once, so num_buckets must not exceed
+  _max_buckets().
+  """
+  buckets = [(os.path.join(bucket_dir, "bucket-%05d.src" % i),
+              os.path.join(bucket_dir, "bucket-%05d.tgt" % i))
+             for i in range(num_buckets)]
+  bucket_files = [(open(src, "wb"), open(tgt, "wb")) for src, tgt in buckets]
+  num_pairs = 0
+  try:
+    with _open(src_file, "rb") as src_f, _open(tgt_file, "rb") as tgt_f:
+      for src_line in src_f:
+        tgt_line = tgt_f.readline()
+        if not tgt_line:
+          raise ValueError("%s has more lines than %s" % (src_file, tgt_file))
+        bucket_src_f, bucket_tgt_f = bucket_files[rng.randrange(num_buckets)]
+        bucket_src_f.write(src_line if src_line.endswith(b"\n")
+                           else src_line + b"\n")
+        bucket_tgt_f.write(tgt_line if tgt_line.endswith(b"\n")
+                           else tgt_line + b"\n")
+        num_pairs += 1
+      if tgt_f.readline():
+        raise ValueError("%s has more lines than %s" % (tgt_file, src_file))
+  finally:
+    for bucket_src_f, bucket_tgt_f in bucket_files:
+      bucket_src_f.close()
+      bucket_tgt_f.close()
+  return buckets, num_pairs
+
+
+def _shuffle_bucket(src_file, tgt_file, out_src_f, out_tgt_f, bucket_bytes,
+                    rng, depth=0):
+  """Shuffle one bucket in memory and append it to the output files.
+
+  Buckets larger than bucket_bytes are scattered into smaller buckets first,
+  which makes the shuffle multi-pass where the data requires it.
+  """
+  size = _file_bytes(src_file) + _file_bytes(tgt_file)
+  if size > bucket_bytes and depth < 8:
+    sub_dir = tempfile.mkdtemp(dir=os.path.dirname(src_file))
+    # Sub-buckets that are still too large are scattered again.
+    num_buckets = min(int(math.ceil(size / float(bucket_bytes))) + 1,
+                      _max_buckets())
+    buckets, _ = _scatter(src_file, tgt_file, sub_dir, num_buckets, rng)
+    for sub_src_file, sub_tgt_file in buckets:
+      _shuffle_bucket(sub_src_file, sub_tgt_file, out_src_f, out_tgt_f,
+                      bucket_bytes, rng, depth + 1)
+    shutil.rmtree(sub_dir)
+    return
+
+  with open(src_file, "rb") as f:
+    src_lines = f.readlines()
+  with open(tgt_file, "rb") as f:
+    tgt_lines = f.readlines()
+  order = list(range(len(src_lines)))
+  rng.shuffle(order)
+  out_src_f.writelines(src_lines[i] for i in order)
+  out_tgt_f.writelines(tgt_lines[i] for i in order)
+
+
+def _write_shard(args):
+  """Shuffle the buckets of one output shard; runs in a worker process."""
+  (buckets, out_src_file, out_tgt_file, bucket_bytes, seed) = args
+  rng = random.Random(seed)
+  # The order of the buckets inside a shard is random as well.
+  buckets = list(buckets)
+  rng.shuffle(buckets)
+  with _open(out_src_file, "wb") as out_src_f, \
+      _open(out_tgt_file, "wb") as out_tgt_f:
+    for src_file, tgt_file in buckets:
+      _shuffle_bucket(src_file, tgt_file, out_src_f, out_tgt_f, bucket_bytes,
+                      rng)
+      os.remove(src_file)
+      os.remove(tgt_file)
+  return out_src_file
+
+
+def shuffle_corpus(src_file,
+                   tgt_file,
+                   output_prefix,
+                   src,
+                   tgt,
+                   num_shards=1,
+                   memory_mb=1024,
+                   num_workers=1,
+                   tmp_dir=None,
+                   random_seed=None,
+                   compress=False):
+  """Shuffle an aligned corpus on disk into num_shards output shards.
+
+  Args:
+    src_file: source side of the corpus, plain, gzip or zstd compressed.
+    tgt_file: target side, aligned line by line with src_file.
+    output_prefix: shards are written to <output_prefix>-00000.<src> etc.
+    src: source suffix of the output shards.
+    tgt: target suffix of the output shards.
+    num_shards: number of output shards.
+    memory_mb: memory budget shared by all workers.
+    num_workers: number of processes shuffling buckets in parallel.
+    tmp_dir: directory for the buckets, needs as much free space as the
+      uncompressed corpus. Defaults to the output directory.
+    random_seed: seed for a reproducible shuffle.
+    compress: gzip the output shards.
+
+  Returns:
+    The list of source shard files.
+
+  Raises:
+    ValueError: if the shards can't all have a bucket file open at once.
+  """
+  start_time = time.time()
+  rng = random.Random(random_seed)
+  memory_per_worker = memory_mb * 1024 * 1024 / max(1, num_workers)
+  bucket_bytes = max(1, int(memory_per_worker * _BUCKET_MEMORY_FRACTION))
+
+  # Every shard gets the same number of buckets, enough for each of them to
+  # fit in the memory of one worker, and as many as the open file limit
+  # allows. Workers scatter the buckets that are still too large again.
+  max_buckets = _max_buckets()
+  if num_shards > max_buckets:
+    raise ValueError("%d shards need %d open files, more than the limit; "
+                     "raise it with ulimit -n or use fewer shards" %
+                     (num_shards, 2 * num_shards + _RESERVED_FILES))
+  corpus_bytes = _file_bytes(src_file) + _file_bytes(tgt_file)
+  buckets_per_shard = max(
+      1, int(math.ceil(corpus_bytes / float(bucket_bytes * num_shards))))
+  buckets_per_shard = min(buckets_per_shard, max_buckets // num_shards)
+  num_buckets = buckets_per_shard * num_shards
+
+  output_dir = os.path.dirname(os.path.abspath(output_prefix))
+  if not os.path.exists(output_dir):
+    os.makedirs(output_dir)
+  bucket_dir = tempfile.mkdtemp(prefix="shuffle_", dir=tmp_dir or output_dir)
+  print("# Scattering %s, %s (%.1fMB) into %d buckets in %s" %
+        (src_file, tgt_file, corpus_bytes / 1048576.0, num_buckets,
+         bucket_dir))
+  try:
+    buckets, num_pairs = _scatter(src_file, tgt_file, bucket_dir, num_buckets,
+                                  rng)
+    print("  %d pairs, %ds" % (num_pairs, time.time() - start_time))
+
+    suffix = ".gz" if compress else ""
+    shard_args = []
+    for shard in range(num_shards):
+      shard_prefix = "%s-%05d" % (output_prefix, shard)
+      shard_args.append((buckets[shard::num_shards],
+                         "%s.%s%s" % (shard_prefix, src, suffix),
+                         "%s.%s%s" % (shard_prefix, tgt, suffix),
+                         bucket_bytes,
+                         rng.randint(0, sys.maxsize)))
+
+    print("# Shuffling %d shards with %d workers" % (num_shards, num_workers))
+    if num_workers > 1:
+      pool = multiprocessing.Pool(num_workers)
+      try:
+        shard_files = pool.map(_write_shard, shard_args)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      shard_files = [_write_shard(args) for args in shard_args]
+  finally:
+    shutil.rmtree(bucket_dir, ignore_errors=True)
+
+  print("# Done, wrote %d shards to %s-*, %ds" %
+        (num_shards, output_prefix, time.time() - start_time))
+  return shard_files
+
+
+def add_arguments(parser):
+  """Build ArgumentParser."""
+  parser.add_argument("--input_prefix", type=str, required=True,
+                      help="Corpus prefix, expect files with src/tgt suffixes.")
+  parser.add_argument("--src", type=str, required=True,
+                      help="Source suffix, e.g., en.")
+  parser.add_argument("--tgt", type=str, required=True,
+                      help="Target suffix, e.g., de.")
+  parser.add_argument("--output_prefix", type=str, required=True,
+                      help="Write shards to <output_prefix>-NNNNN.<suffix>.")
+  parser.add_argument("--num_shards", type=int, default=1,
+                      help="Number of output shards.")
+  parser.add_argument("--memory_mb", type=int, default=1024,
+                      help="Memory budget in MB, shared by all workers.")
+  parser.add_argument("--num_workers", type=int, default=1,
+                      help="Number of processes shuffling in parallel.")
+  parser.add_argument("--tmp_dir", type=str, default=None,
+                      help="Directory for the temporary buckets.")
+  parser.add_argument("--random_seed", type=int, default=None,
+                      help="Random seed (>0, set a specific seed).")
+  parser.add_argument("--compress", type="bool", nargs="?", const=True,
+                      default=False, help="Gzip the output shards.")
+
+
+def main(unused_argv=None):
+  parser = argparse.ArgumentParser()
+  parser.register("type", "bool", lambda v: v.lower() == "true")
+  add_arguments(parser)
+  flags = parser.parse_args()
+
+  src_file = "%s.%s" % (flags.input_prefix, flags.src)
+  tgt_file = "%s.%s" % (flags.input_prefix, flags.tgt)
+  if not os.path.exists(src_file):
+    for suffix in _COMPRESSED_SUFFIXES:
+      if os.path.exists(src_file + suffix):
+        src_file += suffix
+        tgt_file += suffix
+        break
+  shuffle_corpus(src_file, tgt_file, flags.output_prefix, flags.src, flags.tgt,
+                 num_shards=flags.num_shards,
+                 memory_mb=flags.memory_mb,
+                 num_workers=flags.num_workers,
+                 tmp_dir=flags.tmp_dir,
+                 random_seed=flags.random_seed,
+                 compress=flags.compress)
+
+
+if __name__ == "__main__":
+  main()
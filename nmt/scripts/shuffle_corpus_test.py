@@ -0,0 +1,171 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for shuffle_corpus."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+  from unittest import mock  # pylint: disable=g-import-not-at-top
+except ImportError:  # python 2
+  import mock  # pylint: disable=g-import-not-at-top
+
+from . import shuffle_corpus
+
+
+def _write_lines(filename, lines):
+  with shuffle_corpus._open(filename, "wb") as f:
+    for line in lines:
+      f.write(line.encode("utf-8") + b"\n")
+
+
+def _read_lines(filename):
+  with shuffle_corpus._open(filename, "rb") as f:
+    return [line.decode("utf-8").rstrip("\n") for line in f]
+
+
+class ShuffleCorpusTest(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.src_lines = ["src %d %s" % (i, "w " * (i % 7)) for i in range(2000)]
+    self.tgt_lines = ["tgt %d" % i for i in range(2000)]
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _readShards(self, shard_files, src, tgt):
+    pairs = []
+    for src_file in shard_files:
+      prefix, _, suffix = src_file.rpartition("." + src)
+      tgt_file = prefix + "." + tgt + suffix
+      src_lines, tgt_lines = _read_lines(src_file), _read_lines(tgt_file)
+      self.assertEqual(len(src_lines), len(tgt_lines))
+      self.assertTrue(src_lines)
+      pairs.extend(zip(src_lines, tgt_lines))
+    return pairs
+
+  def testShuffleCorpusWithWorkers(self):
+    src_file = os.path.join(self.test_dir, "train.en.gz")
+    tgt_file = os.path.join(self.test_dir, "train.vi.gz")
+    _write_lines(src_file, self.src_lines)
+    _write_lines(tgt_file, self.tgt_lines)
+    output_prefix = os.path.join(self.test_dir, "shuffled", "train")
+
+    shard_files = shuffle_corpus.shuffle_corpus(
+        src_file, tgt_file, output_prefix, "en", "vi", num_shards=3,
+        memory_mb=1, num_workers=2, random_seed=1, compress=True)
+
+    self.assertEqual(
+        ["%s-%05d.en.gz" % (output_prefix, shard) for shard in range(3)],
+        shard_files)
+    # The shards are gzip files.
+    with gzip.open(shard_files[0], "rb") as f:
+      f.readline()
+    pairs = self._readShards(shard_files, "en", "vi")
+    # Every pair is kept once, still aligned, and the order changed.
+    self.assertEqual(sorted(zip(self.src_lines, self.tgt_lines)),
+                     sorted(pairs))
+    for src_line, tgt_line in pairs:
+      self.assertEqual(src_line.split()[1], tgt_line.split()[1])
+    self.assertNotEqual(list(zip(self.src_lines, self.tgt_lines)), pairs)
+    # The temporary buckets are removed.
+    self.assertEqual(["shuffled", "train.en.gz", "train.vi.gz"],
+                     sorted(os.listdir(self.test_dir)))
+
+  def testShuffleCorpusIsReproducible(self):
+    src_file = os.path.join(self.test_dir, "train.en")
+    tgt_file = os.path.join(self.test_dir, "train.vi")
+    _write_lines(src_file, self.src_lines)
+    _write_lines(tgt_file, self.tgt_lines)
+
+    shuffled_pairs = []
+    for output_dir in ("a", "b"):
+      output_prefix = os.path.join(self.test_dir, output_dir, "train")
+      shard_files = shuffle_corpus.shuffle_corpus(
+          src_file, tgt_file, output_prefix, "en", "vi", num_shards=2,
+          random_seed=3)
+      shuffled_pairs.append(self._readShards(shard_files, "en", "vi"))
+    self.assertEqual(shuffled_pairs[0], shuffled_pairs[1])
+    self.assertEqual(sorted(zip(self.src_lines, self.tgt_lines)),
+                     sorted(shuffled_pairs[0]))
+
+  def testShuffleCorpusWithFewOpenFiles(self):
+    src_file = os.path.join(self.test_dir, "train.en")
+    tgt_file = os.path.join(self.test_dir, "train.vi")
+    _write_lines(src_file, self.src_lines)
+    _write_lines(tgt_file, self.tgt_lines)
+    output_prefix = os.path.join(self.test_dir, "train")
+    num_buckets = []
+    scatter = shuffle_corpus._scatter
+
+    def counting_scatter(src_file, tgt_file, bucket_dir, buckets, rng):
+      num_buckets.append(buckets)
+      return scatter(src_file, tgt_file, bucket_dir, buckets, rng)
+
+    # The ~45KB corpus needs 8 buckets of 6KB, more than the 4 allowed.
+    with mock.patch.object(shuffle_corpus, "_max_buckets", return_value=4), \
+        mock.patch.object(shuffle_corpus, "_scatter", counting_scatter):
+      shard_files = shuffle_corpus.shuffle_corpus(
+          src_file, tgt_file, output_prefix, "en", "vi", num_shards=2,
+          memory_mb=0.02, random_seed=1)
+      with self.assertRaises(ValueError):
+        shuffle_corpus.shuffle_corpus(
+            src_file, tgt_file, output_prefix, "en", "vi", num_shards=5)
+
+    # The oversized buckets were scattered again by the workers.
+    self.assertEqual(4, num_buckets[0])
+    self.assertGreater(len(num_buckets), 1)
+    self.assertLessEqual(max(num_buckets), 4)
+    self.assertEqual(sorted(zip(self.src_lines, self.tgt_lines)),
+                     sorted(self._readShards(shard_files, "en", "vi")))
+
+  @unittest.skipIf(shuffle_corpus.zstandard is None, "needs zstandard")
+  def testShuffleZstdCorpus(self):
+    src_file = os.path.join(self.test_dir, "train.en.zst")
+    tgt_file = os.path.join(self.test_dir, "train.vi.zst")
+    for filename, lines in ((src_file, self.src_lines),
+                            (tgt_file, self.tgt_lines)):
+      with open(filename, "wb") as f:
+        f.write(shuffle_corpus.zstandard.ZstdCompressor().compress(
+            "".join(line + "\n" for line in lines).encode("utf-8")))
+
+    shard_files = shuffle_corpus.shuffle_corpus(
+        src_file, tgt_file, os.path.join(self.test_dir, "train"), "en", "vi",
+        num_shards=2, random_seed=1)
+    self.assertEqual(sorted(zip(self.src_lines, self.tgt_lines)),
+                     sorted(self._readShards(shard_files, "en", "vi")))
+
+  def testShuffleCorpusChecksAlignment(self):
+    src_file = os.path.join(self.test_dir, "train.en")
+    tgt_file = os.path.join(self.test_dir, "train.vi")
+    _write_lines(src_file, self.src_lines)
+    _write_lines(tgt_file, self.tgt_lines[:-1])
+    with self.assertRaises(ValueError):
+      shuffle_corpus.shuffle_corpus(
+          src_file, tgt_file, os.path.join(self.test_dir, "train"), "en",
+          "vi")
+
+
+if __name__ == "__main__":
+  unittest.main()
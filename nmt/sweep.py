@@ -0,0 +1,198 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Evaluate every checkpoint of a model directory on one eval set."""
+from __future__ import print_function
+
+import codecs
+import json
+import multiprocessing
+import os
+import time
+
+import tensorflow as tf
+
+from . import inference
+from . import model_helper
+from .utils import misc_utils as utils
+from .utils import nmt_utils
+
+__all__ = ["get_checkpoints", "sweep"]
+
+
+def get_checkpoints(model_dir, min_step=0, max_step=None):
+  """List the (step, checkpoint) pairs of model_dir within a step range.
+
+  All checkpoints on disk are listed, not only the last num_keep_ckpts ones
+  recorded in the checkpoint state file.
+  """
+  checkpoints = []
+  for index_file in tf.gfile.Glob(os.path.join(model_dir, "*.ckpt-*.index")):
+    ckpt = index_file[:-len(".index")]
+    step = int(ckpt.rsplit("-", 1)[1])
+    if step >= min_step and (max_step is None or step <= max_step):
+      checkpoints.append((step, ckpt))
+  return sorted(checkpoints)
+
+
+def _get_cache_file(sweep_dir, ckpt):
+  return os.path.join(sweep_dir, "%s.json" % os.path.basename(ckpt))
+
+
+def _load_cached_scores(sweep_dir, ckpt, src_file, ref_file, metrics):
+  """Scores of a previous sweep of ckpt on the same data, or None."""
+  cache_file = _get_cache_file(sweep_dir, ckpt)
+  if not tf.gfile.Exists(cache_file):
+    return None
+  with codecs.getreader("utf-8")(tf.gfile.GFile(cache_file, "rb")) as f:
+    result = json.load(f)
+  if (result["src_file"] != src_file or result["ref_file"] != ref_file or
+      any(metric not in result["scores"] for metric in metrics)):
+    return None
+  return result["scores"]
+
+
+def _evaluate_checkpoints(args):
+  """Evaluate a list of checkpoints with one infer graph.
+
+  The graph is built once; each checkpoint only restores its variables.
+  This runs in a worker process when the sweep is parallel.
+  """
+  (hparams_values, checkpoints, src_file, ref_file, sweep_dir, scope,
+   num_threads) = args
+  hparams = tf.contrib.training.HParams(**hparams_values)
+  infer_model = model_helper.create_infer_model(
+      inference.get_model_creator(hparams), hparams, scope)
+  infer_data = inference.load_data(src_file)
+
+  results = []
+  config_proto = utils.get_config_proto(
+      num_intra_threads=hparams.num_intra_threads or num_threads,
+      num_inter_threads=hparams.num_inter_threads or num_threads)
+  with tf.Session(graph=infer_model.graph, config=config_proto) as sess:
+    for step, ckpt in checkpoints:
+      start_time = time.time()
+      loaded_infer_model = model_helper.load_model(
+          infer_model.model, ckpt, sess, "infer")
+      sess.run(
+          infer_model.iterator.initializer,
+          feed_dict={
+              infer_model.src_placeholder: infer_data,
+              infer_model.batch_size_placeholder: hparams.infer_batch_size
+          })
+      scores = nmt_utils.decode_and_evaluate(
+          "step %d" % step,
+          loaded_infer_model,
+          sess,
+          os.path.join(sweep_dir, "output_%s" % os.path.basename(ckpt)),
+          ref_file=ref_file,
+          metrics=hparams.metrics,
+          subword_option=hparams.subword_option,
+          beam_width=hparams.beam_width,
+          tgt_eos=hparams.eos)
+
+      # Cache the scores so that reruns skip this checkpoint.
+      with codecs.getwriter("utf-8")(
+          tf.gfile.GFile(_get_cache_file(sweep_dir, ckpt), "wb")) as f:
+        f.write(json.dumps({"step": step,
+                            "checkpoint": ckpt,
+                            "src_file": src_file,
+                            "ref_file": ref_file,
+                            "scores": scores,
+                            "time": time.time() - start_time}))
+      results.append((step, scores))
+  return results
+
+
+def sweep(hparams,
+          model_dir,
+          src_file,
+          ref_file,
+          min_step=0,
+          max_step=None,
+          num_workers=1,
+          scope=None):
+  """Evaluate all checkpoints of model_dir within [min_step, max_step].
+
+  Results are cached per checkpoint in <model_dir>/sweep, so a rerun only
+  evaluates new checkpoints. With num_workers > 1, the checkpoints are split
+  between worker processes that each build the infer graph once, and unless
+  num_intra_threads/num_inter_threads are set, each worker gets an equal
+  share of the cores.
+
+  Returns:
+    A list of (step, scores) pairs sorted by step. The step-vs-metric table
+    is also printed and written to <model_dir>/sweep/results.
+  """
+  start_time = time.time()
+  sweep_dir = os.path.join(model_dir, "sweep")
+  tf.gfile.MakeDirs(sweep_dir)
+
+  checkpoints = get_checkpoints(model_dir, min_step, max_step)
+  utils.print_out("# Sweeping %d checkpoints of %s in steps [%d, %s]" %
+                  (len(checkpoints), model_dir, min_step, max_step))
+
+  results = []
+  todo = []
+  for step, ckpt in checkpoints:
+    scores = _load_cached_scores(sweep_dir, ckpt, src_file, ref_file,
+                                 hparams.metrics)
+    if scores is None:
+      todo.append((step, ckpt))
+    else:
+      results.append((step, scores))
+  utils.print_out("  %d cached, %d to evaluate" % (len(results), len(todo)))
+
+  num_workers = max(1, min(num_workers, len(todo)))
+  # 0 lets a single worker use all the cores.
+  num_threads = 0
+  if num_workers > 1:
+    num_threads = max(1, multiprocessing.cpu_count() // num_workers)
+  worker_args = [(hparams.values(), todo[i::num_workers], src_file, ref_file,
+                  sweep_dir, scope, num_threads) for i in range(num_workers)]
+  if num_workers > 1:
+    # Fresh processes, so that no TensorFlow state is inherited. Python 2
+    # can only fork, which is safe as long as no session was created yet.
+    if hasattr(multiprocessing, "get_context"):
+      pool = multiprocessing.get_context("spawn").Pool(num_workers)
+    else:
+      pool = multiprocessing.Pool(num_workers)
+    try:
+      for worker_results in pool.map(_evaluate_checkpoints, worker_args):
+        results.extend(worker_results)
+    finally:
+      pool.close()
+      pool.join()
+  elif todo:
+    results.extend(_evaluate_checkpoints(worker_args[0]))
+  results.sort(key=lambda result: result[0])
+
+  # Step-vs-metric table.
+  lines = ["step\t" + "\t".join(hparams.metrics)]
+  for step, scores in results:
+    lines.append("%d\t" % step + "\t".join(
+        "%.2f" % scores[metric] for metric in hparams.metrics))
+  with codecs.getwriter("utf-8")(
+      tf.gfile.GFile(os.path.join(sweep_dir, "results"), "wb")) as f:
+    f.write("\n".join(lines) + "\n")
+  utils.print_out("\n".join(lines))
+
+  for metric in hparams.metrics:
+    if results:
+      best_step, best_scores = max(results, key=lambda r: r[1][metric])
+      utils.print_out("  best %s %.2f at step %d" %
+                      (metric, best_scores[metric], best_step))
+  utils.print_time("# Done sweeping", start_time)
+  return results
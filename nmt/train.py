@@ -15,29 +15,35 @@
 """For training NMT models."""
 from __future__ import print_function
 
+import collections
+import json
 import math
 import os
 import random
+import threading
 import time
 
+import six
 import tensorflow as tf
 
 from . import attention_model
 from . import gnmt_model
+from . import graph_cache
 from . import inference
 from . import model as nmt_model
 from . import model_helper
 from .utils import misc_utils as utils
 from .utils import nmt_utils
 
-utils.check_tensorflow_version()
-
 __all__ = [
     "run_sample_decode", "run_internal_eval", "run_external_eval",
     "run_avg_external_eval", "run_full_eval", "init_stats", "update_stats",
     "print_step_info", "process_stats", "train"
 ]
 
+# Cached count of the train pairs, for the epoch length of repeated data.
+_TRAIN_PAIRS_CACHE = "train_pairs.json"
+
 
 def run_sample_decode(infer_model, infer_sess, model_dir, hparams,
                       summary_writer, src_data, tgt_data):
@@ -57,6 +63,21 @@ def run_sample_decode(infer_model, infer_sess, model_dir, hparams,
                  summary_writer)
 
 
+def _get_eval_feed_dict(eval_model, prefix, hparams):
+  """Feed the src/tgt files of prefix, which may be gzip compressed."""
+  src_file = utils.get_data_file(prefix, hparams.src)
+  tgt_file = utils.get_data_file(prefix, hparams.tgt)
+  compression_type = utils.get_compression_type(src_file)
+  if compression_type == "ZSTD":
+    raise ValueError("Perplexity eval reads %s in-graph and does not support "
+                     "zstd, use gzip for dev/test files" % src_file)
+  return {
+      eval_model.src_file_placeholder: src_file,
+      eval_model.tgt_file_placeholder: tgt_file,
+      eval_model.compression_type_placeholder: compression_type
+  }
+
+
 def run_internal_eval(
     eval_model, eval_sess, model_dir, hparams, summary_writer,
     use_test_set=True):
@@ -65,24 +86,16 @@ def run_internal_eval(
     loaded_eval_model, global_step = model_helper.create_or_load_model(
         eval_model.model, model_dir, eval_sess, "eval")
 
-  dev_src_file = "%s.%s" % (hparams.dev_prefix, hparams.src)
-  dev_tgt_file = "%s.%s" % (hparams.dev_prefix, hparams.tgt)
-  dev_eval_iterator_feed_dict = {
-      eval_model.src_file_placeholder: dev_src_file,
-      eval_model.tgt_file_placeholder: dev_tgt_file
-  }
+  dev_eval_iterator_feed_dict = _get_eval_feed_dict(
+      eval_model, hparams.dev_prefix, hparams)
 
   dev_ppl = _internal_eval(loaded_eval_model, global_step, eval_sess,
                            eval_model.iterator, dev_eval_iterator_feed_dict,
                            summary_writer, "dev")
   test_ppl = None
   if use_test_set and hparams.test_prefix:
-    test_src_file = "%s.%s" % (hparams.test_prefix, hparams.src)
-    test_tgt_file = "%s.%s" % (hparams.test_prefix, hparams.tgt)
-    test_eval_iterator_feed_dict = {
-        eval_model.src_file_placeholder: test_src_file,
-        eval_model.tgt_file_placeholder: test_tgt_file
-    }
+    test_eval_iterator_feed_dict = _get_eval_feed_dict(
+        eval_model, hparams.test_prefix, hparams)
     test_ppl = _internal_eval(loaded_eval_model, global_step, eval_sess,
                               eval_model.iterator, test_eval_iterator_feed_dict,
                               summary_writer, "test")
@@ -91,14 +104,47 @@ def run_internal_eval(
 
 def run_external_eval(infer_model, infer_sess, model_dir, hparams,
                       summary_writer, save_best_dev=True, use_test_set=True,
-                      avg_ckpts=False):
-  """Compute external evaluation (bleu, rouge, etc.) for both dev / test."""
+                      avg_ckpts=False, subset=False, save_hparams=True):
+  """Compute external evaluation (bleu, rouge, etc.) for both dev / test.
+
+  With subset=True, only the cached dev subset is decoded (see
+  nmt_utils.get_eval_subset) and the test set is skipped. With
+  save_hparams=False, new best scores are only set in hparams and not
+  written to out_dir.
+  """
   with infer_model.graph.as_default():
     loaded_infer_model, global_step = model_helper.create_or_load_model(
         infer_model.model, model_dir, infer_sess, "infer")
 
-  dev_src_file = "%s.%s" % (hparams.dev_prefix, hparams.src)
-  dev_tgt_file = "%s.%s" % (hparams.dev_prefix, hparams.tgt)
+  dev_prefix = hparams.dev_prefix
+  dev_label = "dev"
+  if subset:
+    dev_prefix = nmt_utils.get_eval_subset(
+        hparams.dev_prefix, hparams.src, hparams.tgt,
+        hparams.eval_subset_size, hparams.out_dir,
+        random_seed=hparams.random_seed)
+    dev_label = "dev_subset"
+    use_test_set = False
+  # Only one kind of eval, full or subset, keeps the best checkpoints.
+  if hparams.eval_subset_size and hparams.best_metric_source == "subset":
+    save_best_dev = save_best_dev and subset
+  else:
+    save_best_dev = save_best_dev and not subset
+
+  if hparams.eval_sets and not subset:
+    # Decode dev, test and the extra eval sets together in one pass.
+    eval_sets = [("dev", hparams.dev_prefix)]
+    if use_test_set and hparams.test_prefix:
+      eval_sets.append(("test", hparams.test_prefix))
+    eval_sets.extend(_get_eval_sets(hparams))
+    scores = _external_eval_sets(
+        loaded_infer_model, global_step, infer_sess, hparams, infer_model,
+        eval_sets, summary_writer, save_on_best=save_best_dev,
+        avg_ckpts=avg_ckpts, save_hparams=save_hparams)
+    return scores["dev"], scores.get("test"), global_step
+
+  dev_src_file = utils.get_data_file(dev_prefix, hparams.src)
+  dev_tgt_file = utils.get_data_file(dev_prefix, hparams.tgt)
   dev_infer_iterator_feed_dict = {
       infer_model.src_placeholder: inference.load_data(dev_src_file),
       infer_model.batch_size_placeholder: hparams.infer_batch_size,
@@ -111,15 +157,16 @@ def run_external_eval(infer_model, infer_sess, model_dir, hparams,
       infer_model.iterator,
       dev_infer_iterator_feed_dict,
       dev_tgt_file,
-      "dev",
+      dev_label,
       summary_writer,
       save_on_best=save_best_dev,
-      avg_ckpts=avg_ckpts)
+      avg_ckpts=avg_ckpts,
+      save_hparams=save_hparams)
 
   test_scores = None
   if use_test_set and hparams.test_prefix:
-    test_src_file = "%s.%s" % (hparams.test_prefix, hparams.src)
-    test_tgt_file = "%s.%s" % (hparams.test_prefix, hparams.tgt)
+    test_src_file = utils.get_data_file(hparams.test_prefix, hparams.src)
+    test_tgt_file = utils.get_data_file(hparams.test_prefix, hparams.tgt)
     test_infer_iterator_feed_dict = {
         infer_model.src_placeholder: inference.load_data(test_src_file),
         infer_model.batch_size_placeholder: hparams.infer_batch_size,
@@ -135,12 +182,13 @@ def run_external_eval(infer_model, infer_sess, model_dir, hparams,
         "test",
         summary_writer,
         save_on_best=False,
-        avg_ckpts=avg_ckpts)
+        avg_ckpts=avg_ckpts,
+        save_hparams=save_hparams)
   return dev_scores, test_scores, global_step
 
 
 def run_avg_external_eval(infer_model, infer_sess, model_dir, hparams,
-                          summary_writer, global_step):
+                          summary_writer, global_step, save_hparams=True):
   """Creates an averaged checkpoint and run external eval with it."""
   avg_dev_scores, avg_test_scores = None, None
   if hparams.avg_ckpts:
@@ -156,7 +204,8 @@ def run_avg_external_eval(infer_model, infer_sess, model_dir, hparams,
           avg_model_dir,
           hparams,
           summary_writer,
-          avg_ckpts=True)
+          avg_ckpts=True,
+          save_hparams=save_hparams)
 
   return avg_dev_scores, avg_test_scores
 
@@ -213,7 +262,7 @@ def init_stats():
 def update_stats(stats, start_time, step_result):
   """Update stats: write summary and accumulate statistics."""
   (_, step_loss, step_predict_count, step_summary, global_step,
-   step_word_count, batch_size, grad_norm, learning_rate) = step_result
+   step_word_count, batch_size, grad_norm, learning_rate) = step_result[:9]
 
   # Update statistics
   stats["step_time"] += (time.time() - start_time)
@@ -221,6 +270,8 @@ def update_stats(stats, start_time, step_result):
   stats["predict_count"] += step_predict_count
   stats["total_count"] += float(step_word_count)
   stats["grad_norm"] += grad_norm
+  if len(step_result) > 9:
+    stats["source_counts"] = stats.get("source_counts", 0) + step_result[9]
 
   return global_step, learning_rate, step_summary
 
@@ -242,6 +293,8 @@ def process_stats(stats, info, global_step, steps_per_stats, log_f):
   info["avg_grad_norm"] = stats["grad_norm"] / steps_per_stats
   info["train_ppl"] = utils.safe_exp(stats["loss"] / stats["predict_count"])
   info["speed"] = stats["total_count"] / (1000 * stats["step_time"])
+  if "source_counts" in stats:
+    info["source_counts"] = stats["source_counts"]
 
   # Check for overflow
   is_overflow = False
@@ -254,6 +307,78 @@ def process_stats(stats, info, global_step, steps_per_stats, log_f):
   return is_overflow
 
 
+def _log_mixture_counts(source_counts, hparams, summary_writer, global_step,
+                        log_f):
+  """Report how many train pairs each mixture source actually contributed."""
+  total = float(max(1, sum(source_counts)))
+  counts = []
+  for (prefix, weight), count in zip(
+      model_helper.get_train_mixture(hparams), source_counts):
+    name = os.path.basename(prefix)
+    counts.append("%s %d (%.1f%%, weight %g)" %
+                  (name, count, 100 * count / total, weight))
+    utils.add_summary(summary_writer, global_step, "mixture/%s" % name,
+                      count / total)
+  utils.print_out("  mixture counts: %s" % ", ".join(counts), log_f)
+
+
+def _init_eval_schedule(global_step, steps_per_eval, steps_per_external_eval):
+  """State of the wall-clock eval scheduler, see _update_eval_schedule."""
+  return {"start_time": time.time(),
+          "start_step": global_step,
+          "eval_time": 0.0,
+          "eval_cost": {"internal": None, "external": None},
+          "steps": {"internal": steps_per_eval,
+                    "external": steps_per_external_eval}}
+
+
+def _update_eval_schedule(schedule, kind, eval_time, global_step, hparams,
+                          log_f):
+  """Record an eval that took eval_time seconds and adapt the eval intervals.
+
+  Evals may take a fraction f = hparams.eval_time_fraction of the wall-clock
+  time, i.e. f / (1 - f) seconds per second of training, split evenly between
+  internal and external evals. An eval costing c seconds every n steps of t
+  seconds takes c / (n * t) seconds per second of training, so
+  n = 2 * c * (1 - f) / (f * t), from the smoothed cost of each kind of eval
+  and the step time measured since the previous eval. The share actually
+  spent on evals since the previous eval is logged.
+
+  Returns:
+    The new (steps_per_eval, steps_per_external_eval).
+  """
+  schedule["eval_time"] += eval_time
+  eval_cost = schedule["eval_cost"][kind]
+  if eval_cost is None:
+    schedule["eval_cost"][kind] = eval_time
+  else:
+    schedule["eval_cost"][kind] = 0.5 * (eval_cost + eval_time)
+
+  wall_time = time.time() - schedule["start_time"]
+  train_time = max(wall_time - schedule["eval_time"], 1e-6)
+  num_steps = global_step - schedule["start_step"]
+  if num_steps > 0:
+    step_time = train_time / num_steps
+    fraction = hparams.eval_time_fraction
+    for eval_kind, cost in schedule["eval_cost"].items():
+      if cost is not None:
+        schedule["steps"][eval_kind] = max(
+            hparams.steps_per_stats,
+            int(math.ceil(2 * cost * (1 - fraction) / (fraction * step_time))))
+
+  utils.print_out(
+      "  eval overhead %.1f%% (train %.0fs, eval %.0fs over %d steps), next "
+      "internal eval every %d steps, external eval every %d steps" %
+      (100 * schedule["eval_time"] / max(wall_time, 1e-6), train_time,
+       schedule["eval_time"], num_steps, schedule["steps"]["internal"],
+       schedule["steps"]["external"]), log_f)
+
+  schedule["start_time"] = time.time()
+  schedule["start_step"] = global_step
+  schedule["eval_time"] = 0.0
+  return schedule["steps"]["internal"], schedule["steps"]["external"]
+
+
 def before_train(loaded_train_model, train_model, train_sess, global_step,
                  hparams, log_f):
   """Misc tasks to do before training."""
@@ -268,8 +393,11 @@ def before_train(loaded_train_model, train_model, train_sess, global_step,
   utils.print_out("# Start step %d, lr %g, %s" %
                   (global_step, info["learning_rate"], time.ctime()), log_f)
 
-  # Initialize all of the iterators
-  skip_count = hparams.batch_size * hparams.epoch_step
+  # Initialize all of the iterators. A mixture is an endless random stream
+  # with no position to resume from, so it restarts without skipping.
+  skip_count = 0
+  if not hparams.train_mixture:
+    skip_count = hparams.batch_size * hparams.epoch_step
   utils.print_out("# Init train iterator, skipping %d elements" % skip_count)
   train_sess.run(
       train_model.iterator.initializer,
@@ -278,8 +406,193 @@ def before_train(loaded_train_model, train_model, train_sess, global_step,
   return stats, info, start_train_time
 
 
+def _has_words(line):
+  """Whether get_iterator finds any word in a line read from a file.
+
+  Same rule as tf.string_split(delimiter=" ") in get_iterator: words are
+  separated by spaces only, and empty words are dropped.
+  """
+  return any(line.rstrip(b"\r\n").split(b" "))
+
+
+def _count_train_pairs(src_file, tgt_file):
+  """Number of pairs of src_file and tgt_file that get_iterator keeps."""
+  num_pairs = 0
+  with utils.open_file(src_file, mode="rb") as src_f, \
+      utils.open_file(tgt_file, mode="rb") as tgt_f:
+    for src_line, tgt_line in six.moves.zip(src_f, tgt_f):
+      # Pairs with an empty side are filtered out; long lines are truncated.
+      if _has_words(src_line) and _has_words(tgt_line):
+        num_pairs += 1
+  return num_pairs
+
+
+def _get_steps_per_epoch(hparams):
+  """Number of training steps in an epoch of the train data.
+
+  Taken from hparams.steps_per_epoch if set. Otherwise the train pairs are
+  counted once and the count is cached in out_dir, keyed by the train files
+  and their sizes. A mixture has no epoch that counting could find, so it
+  needs steps_per_epoch.
+
+  Raises:
+    ValueError: for a train_mixture without steps_per_epoch.
+  """
+  if hparams.steps_per_epoch:
+    return hparams.steps_per_epoch
+  if hparams.train_mixture:
+    raise ValueError("repeat_train_data with a train_mixture needs "
+                     "steps_per_epoch")
+
+  src_files, tgt_files = model_helper.get_train_files(hparams)
+  files = [[src_file, tgt_file,
+            tf.gfile.Stat(src_file).length, tf.gfile.Stat(tgt_file).length]
+           for src_file, tgt_file in zip(src_files, tgt_files)]
+  cache_file = os.path.join(hparams.out_dir, _TRAIN_PAIRS_CACHE)
+  num_pairs = None
+  if tf.gfile.Exists(cache_file):
+    with tf.gfile.GFile(cache_file, "r") as f:
+      cache = json.load(f)
+    if cache["files"] == files:
+      num_pairs = cache["num_pairs"]
+  if num_pairs is None:
+    start_time = time.time()
+    num_pairs = sum(_count_train_pairs(src_file, tgt_file)
+                    for src_file, tgt_file in zip(src_files, tgt_files))
+    with tf.gfile.GFile(cache_file, "w") as f:
+      f.write(json.dumps({"files": files, "num_pairs": num_pairs}))
+    utils.print_time("# Counted %d train pairs" % num_pairs, start_time)
+
+  return max(1, int(math.ceil(num_pairs / float(hparams.batch_size))))
+
+
+def _start_epoch_end_eval(infer_model, infer_sess, model_dir, hparams,
+                          summary_writer, sample_src_data, sample_tgt_data,
+                          global_step):
+  """Run the end-of-epoch evaluation in a background thread.
+
+  The evaluation works on a copy of hparams, so the training loop can keep
+  updating epoch_step, and does not save hparams. _wait_for_epoch_end_eval
+  copies the best scores back and is the only one to save them.
+  """
+  eval_hparams = tf.contrib.training.HParams(**hparams.values())
+
+  def _epoch_end_eval():
+    run_sample_decode(infer_model, infer_sess, model_dir, eval_hparams,
+                      summary_writer, sample_src_data, sample_tgt_data)
+    run_external_eval(infer_model, infer_sess, model_dir, eval_hparams,
+                      summary_writer, save_hparams=False)
+    if eval_hparams.avg_ckpts:
+      run_avg_external_eval(infer_model, infer_sess, model_dir, eval_hparams,
+                            summary_writer, global_step, save_hparams=False)
+
+  eval_thread = threading.Thread(target=_epoch_end_eval,
+                                 name="epoch_end_eval")
+  eval_thread.daemon = True
+  eval_thread.hparams = eval_hparams
+  eval_thread.start()
+  return eval_thread
+
+
+def _wait_for_epoch_end_eval(eval_thread, hparams):
+  """Block until a pending background evaluation is done.
+
+  Copies the best scores of the evaluation into hparams and saves them from
+  the calling thread.
+  """
+  if eval_thread is None:
+    return None
+  if eval_thread.is_alive():
+    utils.print_out("# Waiting for the end-of-epoch evaluation to finish")
+    eval_thread.join()
+  best_metric_prefixes = ["best_"]
+  if hparams.avg_ckpts:
+    best_metric_prefixes.append("avg_best_")
+  for metric in hparams.metrics:
+    for prefix in best_metric_prefixes:
+      setattr(hparams, prefix + metric,
+              getattr(eval_thread.hparams, prefix + metric))
+  utils.save_hparams(hparams.out_dir, hparams)
+  return None
+
+
+def _create_model(create_fn, model_creator, hparams, name, scope):
+  """Create a model with create_fn, through the graph cache if enabled."""
+  if hparams.cache_graphs:
+    return graph_cache.create_model(create_fn, model_creator, hparams, name,
+                                    scope)
+  return create_fn(model_creator, hparams, scope)
+
+
+class _EvalModels(
+    collections.namedtuple("_EvalModels", ("eval_model", "eval_sess",
+                                           "infer_model", "infer_sess",
+                                           "build_time"))):
+  pass
+
+
+def _create_eval_models(model_creator, hparams, scope, target_session,
+                        config_proto):
+  """Create the eval and infer models and their sessions.
+
+  May run in a background thread, so the build time is returned rather than
+  recorded in the startup times.
+  """
+  start_time = time.time()
+  eval_model = _create_model(model_helper.create_eval_model, model_creator,
+                             hparams, "eval", scope)
+  infer_model = _create_model(model_helper.create_infer_model, model_creator,
+                              hparams, "infer", scope)
+  eval_sess = tf.Session(
+      target=target_session, config=config_proto, graph=eval_model.graph)
+  infer_sess = tf.Session(
+      target=target_session, config=config_proto, graph=infer_model.graph)
+  build_time = time.time() - start_time
+  utils.print_out("  created eval/infer graphs, time %.2fs" % build_time)
+  return _EvalModels(eval_model=eval_model, eval_sess=eval_sess,
+                     infer_model=infer_model, infer_sess=infer_sess,
+                     build_time=build_time)
+
+
+class _BackgroundBuild(object):
+  """Run build_fn in a background thread; get() waits for its result."""
+
+  def __init__(self, build_fn):
+    self._result = None
+    self._error = None
+    self._thread = threading.Thread(target=self._run, args=(build_fn,))
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self, build_fn):
+    try:
+      self._result = build_fn()
+    except Exception as e:  # pylint: disable=broad-except
+      self._error = e
+
+  def get(self):
+    if self._thread.is_alive():
+      utils.print_out("# Waiting for the eval/infer graphs to be built")
+      self._thread.join()
+    if self._error is not None:
+      raise self._error
+    return self._result
+
+
+def _print_startup_times(startup_times, start_time, log_f):
+  """Report how long each phase of the training startup took."""
+  utils.print_out(
+      "# Startup %.2fs: %s" % (
+          time.time() - start_time,
+          ", ".join("%s %.2fs" % (phase, seconds)
+                    for phase, seconds in startup_times.items())),
+      log_f)
+
+
 def train(hparams, scope=None, target_session=""):
   """Train a translation model."""
+  start_startup_time = time.time()
+  startup_times = collections.OrderedDict()
   log_device_placement = hparams.log_device_placement
   out_dir = hparams.out_dir
   num_train_steps = hparams.num_train_steps
@@ -303,15 +616,18 @@ def train(hparams, scope=None, target_session=""):
       raise ValueError("Unknown attention architecture %s" %
                        hparams.attention_architecture)
 
-  train_model = model_helper.create_train_model(model_creator, hparams, scope)
-  eval_model = model_helper.create_eval_model(model_creator, hparams, scope)
-  infer_model = model_helper.create_infer_model(model_creator, hparams, scope)
+  start_time = time.time()
+  train_model = _create_model(model_helper.create_train_model, model_creator,
+                              hparams, "train", scope)
+  startup_times["train graph"] = time.time() - start_time
 
   # Preload data for sample decoding.
-  dev_src_file = "%s.%s" % (hparams.dev_prefix, hparams.src)
-  dev_tgt_file = "%s.%s" % (hparams.dev_prefix, hparams.tgt)
+  start_time = time.time()
+  dev_src_file = utils.get_data_file(hparams.dev_prefix, hparams.src)
+  dev_tgt_file = utils.get_data_file(hparams.dev_prefix, hparams.tgt)
   sample_src_data = inference.load_data(dev_src_file)
   sample_tgt_data = inference.load_data(dev_tgt_file)
+  startup_times["sample data"] = time.time() - start_time
 
   summary_name = "train_log"
   model_dir = hparams.out_dir
@@ -328,41 +644,92 @@ def train(hparams, scope=None, target_session=""):
       num_inter_threads=hparams.num_inter_threads)
   train_sess = tf.Session(
       target=target_session, config=config_proto, graph=train_model.graph)
-  eval_sess = tf.Session(
-      target=target_session, config=config_proto, graph=eval_model.graph)
-  infer_sess = tf.Session(
-      target=target_session, config=config_proto, graph=infer_model.graph)
 
+  # With lazy_graph_build, the eval and infer graphs are built in a
+  # background thread while the train model is restored and starts training,
+  # and get_eval_models() only blocks on their first use. Their build time
+  # is only added to startup_times here, on the main thread.
+  if hparams.lazy_graph_build:
+    background_build = _BackgroundBuild(
+        lambda: _create_eval_models(model_creator, hparams, scope,
+                                    target_session, config_proto))
+
+    def get_eval_models():
+      eval_models = background_build.get()
+      if "eval/infer graphs" not in startup_times:
+        startup_times["eval/infer graphs"] = eval_models.build_time
+        utils.print_out("# Eval/infer graphs built in the background, "
+                        "time %.2fs" % eval_models.build_time, log_f)
+      return eval_models[:4]
+  else:
+    eval_models = _create_eval_models(model_creator, hparams, scope,
+                                      target_session, config_proto)
+    startup_times["eval/infer graphs"] = eval_models.build_time
+    get_eval_models = lambda: eval_models[:4]
+
+  start_time = time.time()
   with train_model.graph.as_default():
     loaded_train_model, global_step = model_helper.create_or_load_model(
         train_model.model, model_dir, train_sess, "train")
+  startup_times["train restore"] = time.time() - start_time
 
   # Summary writer
   summary_writer = tf.summary.FileWriter(
       os.path.join(out_dir, summary_name), train_model.graph)
 
   # First evaluation
-  run_full_eval(
-      model_dir, infer_model, infer_sess,
-      eval_model, eval_sess, hparams,
-      summary_writer, sample_src_data,
-      sample_tgt_data, avg_ckpts)
+  if hparams.lazy_graph_build:
+    utils.print_out("# Skipping the first evaluation, the eval/infer graphs "
+                    "are built in the background")
+  else:
+    start_time = time.time()
+    eval_model, eval_sess, infer_model, infer_sess = get_eval_models()
+    run_full_eval(
+        model_dir, infer_model, infer_sess,
+        eval_model, eval_sess, hparams,
+        summary_writer, sample_src_data,
+        sample_tgt_data, avg_ckpts)
+    startup_times["first eval"] = time.time() - start_time
 
   last_stats_step = global_step
   last_eval_step = global_step
   last_external_eval_step = global_step
+  num_external_evals = 0
+
+  # Optionally adapt the eval intervals to spend a fixed share of wall-clock
+  # time on evaluation, sample decoding and checkpointing.
+  eval_schedule = None
+  if hparams.eval_time_fraction:
+    eval_schedule = _init_eval_schedule(
+        global_step, steps_per_eval, steps_per_external_eval)
+
+  # With a repeated train dataset the iterator never runs out, so epochs are
+  # counted in steps and the end-of-epoch evaluation runs in the background.
+  steps_per_epoch = None
+  epoch_eval_thread = None
+  if hparams.repeat_train_data:
+    steps_per_epoch = _get_steps_per_epoch(hparams)
+    utils.print_out("# Repeating train data, %d steps per epoch" %
+                    steps_per_epoch)
 
   # This is the training loop.
   stats, info, start_train_time = before_train(
       loaded_train_model, train_model, train_sess, global_step, hparams, log_f)
+  first_step = True
   while global_step < num_train_steps:
     ### Run a step ###
     start_time = time.time()
     try:
       step_result = loaded_train_model.train(train_sess)
       hparams.epoch_step += 1
+      if first_step:
+        first_step = False
+        startup_times["first step"] = time.time() - start_time
+        _print_startup_times(startup_times, start_startup_time, log_f)
     except tf.errors.OutOfRangeError:
       # Finished going through the training dataset.  Go to next epoch.
+      eval_start_time = time.time()
+      eval_model, eval_sess, infer_model, infer_sess = get_eval_models()
       hparams.epoch_step = 0
       utils.print_out(
           "# Finished an epoch, step %d. Perform external evaluation" %
@@ -379,6 +746,8 @@ def train(hparams, scope=None, target_session=""):
       train_sess.run(
           train_model.iterator.initializer,
           feed_dict={train_model.skip_count_placeholder: 0})
+      if eval_schedule:
+        eval_schedule["eval_time"] += time.time() - eval_start_time
       continue
 
     # Process step_result, accumulate stats, and write summary
@@ -386,6 +755,21 @@ def train(hparams, scope=None, target_session=""):
         stats, start_time, step_result)
     summary_writer.add_summary(step_summary, global_step)
 
+    if steps_per_epoch and hparams.epoch_step >= steps_per_epoch:
+      hparams.epoch_step = 0
+      utils.print_out(
+          "# Finished an epoch, step %d. Perform external evaluation in the "
+          "background" % global_step)
+      epoch_eval_thread = _wait_for_epoch_end_eval(epoch_eval_thread, hparams)
+      loaded_train_model.saver.save(
+          train_sess,
+          os.path.join(out_dir, "translate.ckpt"),
+          global_step=global_step)
+      eval_model, eval_sess, infer_model, infer_sess = get_eval_models()
+      epoch_eval_thread = _start_epoch_end_eval(
+          infer_model, infer_sess, model_dir, hparams, summary_writer,
+          sample_src_data, sample_tgt_data, global_step)
+
     # Once in a while, we print statistics.
     if global_step - last_stats_step >= steps_per_stats:
       last_stats_step = global_step
@@ -393,6 +777,9 @@ def train(hparams, scope=None, target_session=""):
           stats, info, global_step, steps_per_stats, log_f)
       print_step_info("  ", global_step, info, _get_best_results(hparams),
                       log_f)
+      if "source_counts" in info:
+        _log_mixture_counts(info["source_counts"], hparams, summary_writer,
+                            global_step, log_f)
       if is_overflow:
         break
 
@@ -401,6 +788,8 @@ def train(hparams, scope=None, target_session=""):
 
     if global_step - last_eval_step >= steps_per_eval:
       last_eval_step = global_step
+      eval_start_time = time.time()
+      epoch_eval_thread = _wait_for_epoch_end_eval(epoch_eval_thread, hparams)
       utils.print_out("# Save eval, global step %d" % global_step)
       utils.add_summary(summary_writer, global_step, "train_ppl",
                         info["train_ppl"])
@@ -412,14 +801,22 @@ def train(hparams, scope=None, target_session=""):
           global_step=global_step)
 
       # Evaluate on dev/test
+      eval_model, eval_sess, infer_model, infer_sess = get_eval_models()
       run_sample_decode(infer_model, infer_sess,
                         model_dir, hparams, summary_writer, sample_src_data,
                         sample_tgt_data)
       run_internal_eval(
           eval_model, eval_sess, model_dir, hparams, summary_writer)
 
+      if eval_schedule:
+        steps_per_eval, steps_per_external_eval = _update_eval_schedule(
+            eval_schedule, "internal", time.time() - eval_start_time,
+            global_step, hparams, log_f)
+
     if global_step - last_external_eval_step >= steps_per_external_eval:
       last_external_eval_step = global_step
+      eval_start_time = time.time()
+      epoch_eval_thread = _wait_for_epoch_end_eval(epoch_eval_thread, hparams)
 
       # Save checkpoint
       loaded_train_model.saver.save(
@@ -427,6 +824,7 @@ def train(hparams, scope=None, target_session=""):
           os.path.join(out_dir, "translate.ckpt"),
           global_step=global_step)
 
+      eval_model, eval_sess, infer_model, infer_sess = get_eval_models()
       run_sample_decode(infer_model,
                         infer_sess,
                         model_dir,
@@ -435,15 +833,28 @@ def train(hparams, scope=None, target_session=""):
                         sample_src_data,
                         sample_tgt_data)
 
+      # With eval_subset_size, most evals only decode the dev subset and
+      # every full_eval_every-th eval decodes the full dev/test sets.
+      num_external_evals += 1
+      subset = bool(hparams.eval_subset_size and (
+          hparams.full_eval_every <= 0 or
+          num_external_evals % hparams.full_eval_every != 0))
       run_external_eval(
           infer_model, infer_sess, model_dir,
-          hparams, summary_writer)
+          hparams, summary_writer, subset=subset)
 
-      if avg_ckpts:
+      if avg_ckpts and not subset:
         run_avg_external_eval(infer_model, infer_sess, model_dir, hparams,
                               summary_writer, global_step)
 
+      if eval_schedule:
+        steps_per_eval, steps_per_external_eval = _update_eval_schedule(
+            eval_schedule, "external", time.time() - eval_start_time,
+            global_step, hparams, log_f)
+
   # Done training
+  epoch_eval_thread = _wait_for_epoch_end_eval(epoch_eval_thread, hparams)
+  eval_model, eval_sess, infer_model, infer_sess = get_eval_models()
   loaded_train_model.saver.save(
       train_sess,
       os.path.join(out_dir, "translate.ckpt"),
@@ -551,7 +962,7 @@ def _sample_decode(model, global_step, sess, hparams, iterator, src_data,
 
 def _external_eval(model, global_step, sess, hparams, iterator,
                    iterator_feed_dict, tgt_file, label, summary_writer,
-                   save_on_best, avg_ckpts=False):
+                   save_on_best, avg_ckpts=False, save_hparams=True):
   """External evaluation such as BLEU and ROUGE scores."""
   out_dir = hparams.out_dir
   decode = global_step > 0
@@ -576,6 +987,91 @@ def _external_eval(model, global_step, sess, hparams, iterator,
       beam_width=hparams.beam_width,
       tgt_eos=hparams.eos,
       decode=decode)
+  _save_external_eval_scores(model, global_step, sess, hparams, scores, label,
+                             summary_writer, save_on_best, avg_ckpts,
+                             save_hparams)
+  return scores
+
+
+def _get_eval_sets(hparams):
+  """Parse hparams.eval_sets into a list of (name, prefix) pairs."""
+  eval_sets = []
+  for eval_set in hparams.eval_sets.split(","):
+    name, _, prefix = eval_set.strip().partition(":")
+    if not prefix:
+      raise ValueError("Expected name:prefix in eval_sets, got %s" % eval_set)
+    eval_sets.append((name, prefix))
+  return eval_sets
+
+
+def _external_eval_sets(model, global_step, sess, hparams, infer_model,
+                        eval_sets, summary_writer, save_on_best,
+                        avg_ckpts=False, save_hparams=True):
+  """External evaluation of several eval sets decoded in a single pass.
+
+  The sentences of all sets are sorted by length and fed to the infer
+  iterator together, so batches are packed across sets with little padding.
+
+  Args:
+    eval_sets: list of (label, prefix) pairs; the first one is the dev set,
+      which is the only one that can save the best checkpoints.
+
+  Returns:
+    A dict from label to the scores of that set.
+  """
+  decode = global_step > 0
+  if decode:
+    utils.print_out("# External evaluation of %s, global step %d" %
+                    (", ".join(label for label, _ in eval_sets), global_step))
+
+  labels, src_data, ref_files, trans_files = [], [], [], []
+  for label, prefix in eval_sets:
+    if avg_ckpts:
+      label = "avg_" + label
+    labels.append(label)
+    src_data.append(
+        inference.load_data(utils.get_data_file(prefix, hparams.src)))
+    ref_files.append(utils.get_data_file(prefix, hparams.tgt))
+    trans_files.append(os.path.join(hparams.out_dir, "output_%s" % label))
+
+  packed_src_data, order = nmt_utils.pack_eval_sets(src_data)
+  sess.run(
+      infer_model.iterator.initializer,
+      feed_dict={
+          infer_model.src_placeholder: packed_src_data,
+          infer_model.batch_size_placeholder: hparams.infer_batch_size,
+      })
+  set_scores = nmt_utils.decode_and_evaluate_sets(
+      labels,
+      model,
+      sess,
+      order,
+      trans_files,
+      ref_files,
+      metrics=hparams.metrics,
+      subword_option=hparams.subword_option,
+      beam_width=hparams.beam_width,
+      tgt_eos=hparams.eos,
+      decode=decode)
+
+  scores = {}
+  for i, ((label, _), set_label) in enumerate(zip(eval_sets, labels)):
+    _save_external_eval_scores(
+        model, global_step, sess, hparams, set_scores[i], set_label,
+        summary_writer, save_on_best and i == 0, avg_ckpts, save_hparams)
+    scores[label] = set_scores[i]
+  return scores
+
+
+def _save_external_eval_scores(model, global_step, sess, hparams, scores,
+                               label, summary_writer, save_on_best, avg_ckpts,
+                               save_hparams=True):
+  """Add summaries of the scores and save the model on best metrics.
+
+  With save_hparams, hparams with the new best scores are written to out_dir.
+  """
+  out_dir = hparams.out_dir
+  decode = global_step > 0
   # Save on best metrics
   if decode:
     for metric in hparams.metrics:
@@ -594,5 +1090,5 @@ def _external_eval(model, global_step, sess, hparams, iterator,
             os.path.join(
                 getattr(hparams, best_metric_label + "_dir"), "translate.ckpt"),
             global_step=model.global_step)
-    utils.save_hparams(out_dir, hparams)
-  return scores
+    if save_hparams:
+      utils.save_hparams(out_dir, hparams)
@@ -0,0 +1,192 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for the helpers of train.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import codecs
+import collections
+import io
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from . import train
+from .utils import misc_utils as utils
+
+
+_FakeIterator = collections.namedtuple("_FakeIterator", ("initializer",))
+
+
+class _FakeInferModel(
+    collections.namedtuple("_FakeInferModel", ("iterator", "src_placeholder",
+                                               "batch_size_placeholder"))):
+  pass
+
+
+class _FakeSaver(object):
+
+  def __init__(self):
+    self.saved = []
+
+  def save(self, sess, save_path, global_step=None):
+    self.saved.append(save_path)
+
+
+class _EchoSession(object):
+  """Keeps the sentences fed to the infer iterator for _EchoModel."""
+
+  def run(self, fetches, feed_dict=None):
+    self.sentences = list(feed_dict["src"])
+    self.batch_size = feed_dict["batch_size"]
+
+
+class _EchoModel(object):
+  """Infer model that translates every sentence to itself."""
+
+  global_step = None
+
+  def __init__(self):
+    self.saver = _FakeSaver()
+
+  def decode(self, sess):
+    if not sess.sentences:
+      raise tf.errors.OutOfRangeError(None, None, "End of sequence")
+    batch = sess.sentences[:sess.batch_size]
+    sess.sentences = sess.sentences[sess.batch_size:]
+    words = [sentence.encode("utf-8").split() for sentence in batch]
+    max_len = max(len(w) for w in words)
+    return np.array([w + [b"</s>"] * (max_len - len(w)) for w in words]), None
+
+
+def _write_lines(filename, lines):
+  with codecs.getwriter("utf-8")(tf.gfile.GFile(filename, "wb")) as f:
+    for line in lines:
+      f.write(line + "\n")
+
+
+def _read_lines(filename):
+  with codecs.getreader("utf-8")(tf.gfile.GFile(filename, "rb")) as f:
+    return f.read().splitlines()
+
+
+class TrainTest(tf.test.TestCase):
+
+  def testHasWords(self):
+    # Only spaces separate words, as in get_iterator's tf.string_split.
+    for line in (b"a\n", b" a b \r\n", b"\t\n", b"a"):
+      self.assertTrue(train._has_words(line))
+    for line in (b"\n", b"   \n", b" \r\n", b""):
+      self.assertFalse(train._has_words(line))
+    # The lines tf.string_split finds words in.
+    lines = [b"\t", b"   ", b" a b "]
+    with self.test_session() as sess:
+      indices = sess.run(tf.string_split(lines, delimiter=" ").indices)
+    self.assertEqual([train._has_words(line) for line in lines],
+                     [i in indices[:, 0] for i in range(len(lines))])
+
+  def testUpdateEvalSchedule(self):
+    hparams = tf.contrib.training.HParams(
+        eval_time_fraction=0.1, steps_per_stats=5)
+    schedule = train._init_eval_schedule(0, 50, 250)
+    schedule["eval_cost"]["external"] = 5.0
+    log_f = io.BytesIO()
+
+    # 100 steps of 1s, then an internal eval of 10s.
+    schedule["start_time"] = time.time() - 110.0
+    steps = train._update_eval_schedule(
+        schedule, "internal", 10.0, 100, hparams, log_f)
+    # Each kind of eval takes 0.1 / (2 * 0.9) seconds per training second.
+    self.assertEqual((180, 90), steps)
+    self.assertIn(b"eval overhead 9.1% (train 100s, eval 10s over 100 steps)",
+                  log_f.getvalue())
+    self.assertIn(b"internal eval every 180 steps, external eval every 90",
+                  log_f.getvalue())
+    self.assertEqual(100, schedule["start_step"])
+    self.assertEqual(0.0, schedule["eval_time"])
+
+    # 10 steps of 2.3s. The external cost is smoothed to 2.5005s, which
+    # would give an interval of 3 steps, below steps_per_stats.
+    hparams.eval_time_fraction = 0.5
+    schedule["start_time"] = time.time() - 23.0
+    steps = train._update_eval_schedule(
+        schedule, "external", 0.001, 110, hparams, log_f)
+    self.assertEqual((9, 5), steps)
+    self.assertIn(b"eval overhead 0.0% (train 23s, eval 0s over 10 steps)",
+                  log_f.getvalue())
+
+  def testExternalEvalSets(self):
+    out_dir = os.path.join(tf.test.get_temp_dir(), "external_eval_sets")
+    best_bleu_dir = os.path.join(out_dir, "best_bleu")
+    tf.gfile.MakeDirs(best_bleu_dir)
+    lines = _read_lines("nmt/testdata/iwslt15.tst2013.100.en")
+    # The dev and test references are the sources, so their translations
+    # are perfect; the references of the extra set are shuffled.
+    eval_sets = [("dev", lines[:6]), ("test", lines[6:9]),
+                 ("extra", lines[9:13])]
+    refs = {"dev": lines[:6], "test": lines[6:9],
+            "extra": lines[10:13] + lines[9:10]}
+    for label, src_lines in eval_sets:
+      _write_lines(os.path.join(out_dir, label + ".en"), src_lines)
+      _write_lines(os.path.join(out_dir, label + ".vi"), refs[label])
+    hparams = tf.contrib.training.HParams(
+        out_dir=out_dir, src="en", tgt="vi", infer_batch_size=4,
+        metrics=["bleu"], subword_option="", beam_width=0, eos="</s>",
+        best_bleu=0, best_bleu_dir=best_bleu_dir)
+    infer_model = _FakeInferModel(
+        iterator=_FakeIterator(initializer=None), src_placeholder="src",
+        batch_size_placeholder="batch_size")
+    model = _EchoModel()
+    summary_writer = tf.summary.FileWriter(os.path.join(out_dir, "summary"))
+
+    def _external_eval_sets(global_step, save_hparams=True):
+      return train._external_eval_sets(
+          model, global_step, _EchoSession(), hparams, infer_model,
+          [(label, os.path.join(out_dir, label)) for label, _ in eval_sets],
+          summary_writer, save_on_best=True, save_hparams=save_hparams)
+
+    scores = _external_eval_sets(10)
+    # The packed translations are written back per set, in order.
+    for label, src_lines in eval_sets:
+      self.assertEqual(src_lines,
+                       _read_lines(os.path.join(out_dir, "output_" + label)))
+    self.assertEqual(["dev", "extra", "test"], sorted(scores))
+    self.assertAllClose(100.0, scores["dev"]["bleu"])
+    self.assertAllClose(100.0, scores["test"]["bleu"])
+    self.assertLess(scores["extra"]["bleu"], 100.0)
+
+    # Only the dev set picks the best checkpoint, and only when it improves.
+    self.assertAllClose(100.0, hparams.best_bleu)
+    self.assertEqual([os.path.join(best_bleu_dir, "translate.ckpt")],
+                     model.saver.saved)
+    self.assertAllClose(100.0, utils.load_hparams(out_dir).best_bleu)
+    _external_eval_sets(20)
+    self.assertEqual(1, len(model.saver.saved))
+
+    # The background end-of-epoch eval leaves saving hparams to the caller.
+    hparams.best_bleu = 0
+    tf.gfile.Remove(os.path.join(out_dir, "hparams"))
+    _external_eval_sets(30, save_hparams=False)
+    self.assertAllClose(100.0, hparams.best_bleu)
+    self.assertFalse(tf.gfile.Exists(os.path.join(out_dir, "hparams")))
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -19,10 +19,9 @@ import os
 import re
 import subprocess
 
-import tensorflow as tf
-
 from ..scripts import bleu
 from ..scripts import rouge
+from ..utils import misc_utils as utils
 
 
 __all__ = ["evaluate"]
@@ -73,7 +72,7 @@ def _bleu(ref_file, trans_file, subword_option=None):
   reference_text = []
   for reference_filename in ref_files:
     with codecs.getreader("utf-8")(
-        tf.gfile.GFile(reference_filename, "rb")) as fh:
+        utils.open_file(reference_filename, "rb")) as fh:
       reference_text.append(fh.readlines())
 
   per_segment_references = []
@@ -85,7 +84,7 @@ def _bleu(ref_file, trans_file, subword_option=None):
     per_segment_references.append(reference_list)
 
   translations = []
-  with codecs.getreader("utf-8")(tf.gfile.GFile(trans_file, "rb")) as fh:
+  with codecs.getreader("utf-8")(utils.open_file(trans_file, "rb")) as fh:
     for line in fh:
       line = _clean(line, subword_option=None)
       translations.append(line.split(" "))
@@ -100,13 +99,13 @@ def _rouge(ref_file, summarization_file, subword_option=None):
   """Compute ROUGE scores and handling BPE."""
 
   references = []
-  with codecs.getreader("utf-8")(tf.gfile.GFile(ref_file, "rb")) as fh:
+  with codecs.getreader("utf-8")(utils.open_file(ref_file, "rb")) as fh:
     for line in fh:
       references.append(_clean(line, subword_option))
 
   hypotheses = []
   with codecs.getreader("utf-8")(
-      tf.gfile.GFile(summarization_file, "rb")) as fh:
+      utils.open_file(summarization_file, "rb")) as fh:
     for line in fh:
       hypotheses.append(_clean(line, subword_option=None))
 
@@ -117,8 +116,8 @@ def _rouge(ref_file, summarization_file, subword_option=None):
 def _accuracy(label_file, pred_file):
   """Compute accuracy, each line contains a label."""
 
-  with codecs.getreader("utf-8")(tf.gfile.GFile(label_file, "rb")) as label_fh:
-    with codecs.getreader("utf-8")(tf.gfile.GFile(pred_file, "rb")) as pred_fh:
+  with codecs.getreader("utf-8")(utils.open_file(label_file, "rb")) as label_fh:
+    with codecs.getreader("utf-8")(utils.open_file(pred_file, "rb")) as pred_fh:
       count = 0.0
       match = 0.0
       for label in label_fh:
@@ -133,8 +132,8 @@ def _accuracy(label_file, pred_file):
 def _word_accuracy(label_file, pred_file):
   """Compute accuracy on per word basis."""
 
-  with codecs.getreader("utf-8")(tf.gfile.GFile(label_file, "r")) as label_fh:
-    with codecs.getreader("utf-8")(tf.gfile.GFile(pred_file, "r")) as pred_fh:
+  with codecs.getreader("utf-8")(utils.open_file(label_file, "rb")) as label_fh:
+    with codecs.getreader("utf-8")(utils.open_file(pred_file, "rb")) as pred_fh:
       total_acc, total_count = 0., 0.
       for sentence in label_fh:
         labels = sentence.strip().split(" ")
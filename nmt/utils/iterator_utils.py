@@ -16,10 +16,27 @@
 from __future__ import print_function
 
 import collections
+import multiprocessing
 
+import six
 import tensorflow as tf
 
-__all__ = ["BatchedInput", "get_iterator", "get_infer_iterator"]
+from ..utils import misc_utils as utils
+
+__all__ = ["BatchedInput", "PipelineConfig", "get_pipeline_config",
+           "get_text_line_dataset", "get_sharded_dataset",
+           "get_mixture_dataset", "get_iterator", "get_eval_iterator",
+           "get_infer_iterator"]
+
+# Rough host-memory cost of the pipeline elements, used to turn a memory budget
+# into buffer sizes. A raw token is a few utf-8 bytes plus its separator, and
+# every string tensor carries some fixed overhead.
+_BYTES_PER_RAW_TOKEN = 8
+_BYTES_PER_STRING = 64
+_BYTES_PER_ID = 4
+_DEFAULT_MAX_LEN = 50
+# Number of eval pairs preprocessed together by get_eval_iterator.
+_EVAL_PREPROCESS_BATCH_SIZE = 1024
 
 
 # NOTE(ebrevdo): When we subclass this, instances' __dict__ becomes empty.
@@ -27,26 +44,284 @@ class BatchedInput(
     collections.namedtuple("BatchedInput",
                            ("initializer", "source", "target_input",
                             "target_output", "source_sequence_length",
-                            "target_sequence_length"))):
+                            "target_sequence_length", "source_counts"))):
   pass
 
+
+class PipelineConfig(
+    collections.namedtuple("PipelineConfig",
+                           ("shuffle_buffer_size", "prefetch_batches",
+                            "num_parallel_calls"))):
+  pass
+
+
+def get_pipeline_config(batch_size,
+                        memory_budget_mb,
+                        src_max_len=None,
+                        tgt_max_len=None,
+                        num_buckets=1):
+  """Split a host-memory budget between the buffers of get_iterator.
+
+  Three quarters of the budget go to the shuffle buffer, which holds raw
+  sentence pairs. The rest holds the partially filled bucket windows and the
+  prefetched padded batches. Map parallelism is left to the tf.data autotuner
+  when it is available and follows the number of cores otherwise.
+
+  Args:
+    batch_size: the training batch size.
+    memory_budget_mb: host memory, in MB, the input pipeline may use.
+    src_max_len: max source length, used to size the elements.
+    tgt_max_len: max target length, used to size the elements.
+    num_buckets: number of length buckets waiting to fill a batch.
+
+  Returns:
+    A PipelineConfig.
+  """
+  src_max_len = src_max_len or _DEFAULT_MAX_LEN
+  tgt_max_len = tgt_max_len or _DEFAULT_MAX_LEN
+  budget_bytes = memory_budget_mb * 1024 * 1024
+
+  raw_pair_bytes = (2 * _BYTES_PER_STRING +
+                    (src_max_len + tgt_max_len) * _BYTES_PER_RAW_TOKEN)
+  # src, tgt_input, tgt_output and the two lengths.
+  id_pair_bytes = (src_max_len + 2 * (tgt_max_len + 1) + 2) * _BYTES_PER_ID
+  batch_bytes = batch_size * id_pair_bytes
+  window_bytes = max(num_buckets, 1) * batch_bytes
+
+  shuffle_buffer_size = max(batch_size, int(budget_bytes * 3 // 4 //
+                                            raw_pair_bytes))
+  prefetch_bytes = budget_bytes // 4 - window_bytes
+  prefetch_batches = max(1, int(prefetch_bytes // batch_bytes))
+
+  num_parallel_calls = getattr(tf.contrib.data, "AUTOTUNE", None)
+  if num_parallel_calls is None:
+    num_parallel_calls = multiprocessing.cpu_count()
+
+  utils.print_out(
+      "# Input pipeline under %dMB: shuffle_buffer_size=%d (%.1fMB), "
+      "prefetch_batches=%d (%.1fMB), num_parallel_calls=%s" %
+      (memory_budget_mb,
+       shuffle_buffer_size, shuffle_buffer_size * raw_pair_bytes / 1048576.0,
+       prefetch_batches,
+       (prefetch_batches * batch_bytes + window_bytes) / 1048576.0,
+       "autotune" if num_parallel_calls < 0 else num_parallel_calls))
+  return PipelineConfig(
+      shuffle_buffer_size=shuffle_buffer_size,
+      prefetch_batches=prefetch_batches,
+      num_parallel_calls=num_parallel_calls)
+
+
+def _get_zstd_line_dataset(filename):
+  """A dataset of the lines of one zstd file, decompressed in python."""
+  def _read_lines(filename):
+    with utils.open_file(tf.compat.as_str(filename), "rb", "ZSTD") as f:
+      for line in f:
+        yield line.rstrip(b"\r\n")
+  return tf.data.Dataset.from_generator(
+      _read_lines, tf.string, tf.TensorShape([]), args=(filename,))
+
+
+def _get_line_dataset(filename, compression_type):
+  """A dataset of the lines of one file, see get_text_line_dataset."""
+  if compression_type == "ZSTD":
+    return _get_zstd_line_dataset(filename)
+  return tf.data.TextLineDataset(filename, compression_type=compression_type)
+
+
+def get_text_line_dataset(filenames, compression_type=None):
+  """A dataset of the lines of plain, gzip or zstd compressed text files.
+
+  TextLineDataset decompresses gzip natively. zstd is not supported by
+  tf.data, so those files are streamed through python with zstandard, one
+  file after the other. get_sharded_dataset reads several zstd files in
+  parallel.
+
+  Args:
+    filenames: a file name or a list of python file names.
+    compression_type: "GZIP", "ZSTD" or "". Inferred from the suffix of the
+      first file when None.
+
+  Returns:
+    A dataset of lines without their trailing newline.
+  """
+  if isinstance(filenames, six.string_types):
+    filenames = [filenames]
+  if compression_type is None:
+    compression_type = utils.get_compression_type(filenames[0])
+
+  if compression_type == "ZSTD":
+    return tf.data.Dataset.from_tensor_slices(
+        tf.constant(filenames)).flat_map(_get_zstd_line_dataset)
+  return tf.data.TextLineDataset(filenames, compression_type=compression_type)
+
+
+def get_sharded_dataset(src_files,
+                        tgt_files,
+                        num_shards=1,
+                        shard_index=0,
+                        random_seed=None,
+                        num_parallel_reads=4):
+  """Read aligned source/target shard files with parallel interleaved reads.
+
+  Workers split the shard files between them instead of every worker reading
+  all lines and keeping one in num_shards. If there are fewer files than
+  workers, every worker keeps one line in num_shards of each file. Compressed shards are
+  decompressed in parallel, one stream per file being read; for zstd, each
+  stream is a python generator.
+
+  Args:
+    src_files: list of source files.
+    tgt_files: list of target files, aligned line by line with src_files.
+    num_shards: number of workers reading the data.
+    shard_index: index of this worker.
+    random_seed: seed for the order in which the files are read.
+    num_parallel_reads: number of files read concurrently.
+
+  Returns:
+    A dataset of (src, tgt) line pairs.
+  """
+  assert len(src_files) == len(tgt_files)
+  file_level_shards = len(src_files) >= num_shards
+  num_files = len(src_files)
+  if file_level_shards:
+    num_files = len(src_files[shard_index::num_shards])
+  else:
+    utils.print_out("# Only %d train shards for %d workers, sharding by line" %
+                    (len(src_files), num_shards))
+
+  compression_type = utils.get_compression_type(src_files[0])
+  files = tf.data.Dataset.from_tensor_slices(
+      (tf.constant(src_files), tf.constant(tgt_files)))
+  if file_level_shards:
+    files = files.shard(num_shards, shard_index)
+  files = files.shuffle(num_files, seed=random_seed)
+
+  def _read_file_pair(src_file, tgt_file):
+    pairs = tf.data.Dataset.zip(
+        (_get_line_dataset(src_file, compression_type),
+         _get_line_dataset(tgt_file, compression_type)))
+    if not file_level_shards:
+      # Shard the lines of each file before the files are interleaved, so
+      # the workers split every file the same way whatever order they read
+      # the files in.
+      pairs = pairs.shard(num_shards, shard_index)
+    return pairs
+
+  return files.apply(
+      tf.contrib.data.parallel_interleave(
+          _read_file_pair,
+          cycle_length=max(1, min(num_parallel_reads, num_files))))
+
+
+def get_mixture_dataset(src_tgt_datasets, weights, random_seed=None):
+  """Sample (src, tgt) pairs from several corpora with the given weights.
+
+  Every corpus is repeated, so the mixture is an endless stream in which the
+  pairs of corpus i make up weights[i] / sum(weights) of the data on average.
+
+  Args:
+    src_tgt_datasets: list of datasets of (src, tgt) line pairs.
+    weights: list of non-negative sampling weights, one per dataset.
+    random_seed: seed for the sampling.
+
+  Returns:
+    A dataset of (src, tgt, source_id) triples, where source_id is the int32
+    index of the corpus the pair was drawn from.
+  """
+  assert len(src_tgt_datasets) == len(weights)
+  total_weight = float(sum(weights))
+  if total_weight <= 0:
+    raise ValueError("Mixture weights must not all be zero: %s" % weights)
+
+  tagged_datasets = []
+  for source_id, dataset in enumerate(src_tgt_datasets):
+    tagged_datasets.append(dataset.repeat().map(
+        lambda src, tgt, source_id=source_id: (
+            src, tgt, tf.constant(source_id, dtype=tf.int32))))
+  return tf.contrib.data.sample_from_datasets(
+      tagged_datasets, weights=[w / total_weight for w in weights],
+      seed=random_seed)
+
+
+def _lookup_batch(lines, vocab_table, max_len, eos_id):
+  """Split a batch of lines into eos-padded word ids and their lengths."""
+  words = tf.string_split(lines, delimiter=" ")
+  ids = tf.SparseTensor(
+      indices=words.indices,
+      values=tf.cast(vocab_table.lookup(words.values), tf.int32),
+      dense_shape=words.dense_shape)
+  ids = tf.sparse_tensor_to_dense(ids, default_value=eos_id)
+  num_lines = tf.size(lines)
+  lengths = tf.bincount(tf.to_int32(words.indices[:, 0]),
+                        minlength=num_lines, maxlength=num_lines)
+  if max_len:
+    ids = ids[:, :max_len]
+    lengths = tf.minimum(lengths, max_len)
+  return ids, lengths
+
+
+def _preprocess_pair_batch(src, tgt, src_vocab_table, tgt_vocab_table,
+                           src_max_len, tgt_max_len, src_eos_id, tgt_sos_id,
+                           tgt_eos_id):
+  """Turn a batch of raw line pairs into padded model inputs.
+
+  Returns:
+    (src, tgt_in, tgt_out, src_len, tgt_len), without the pairs that have an
+    empty side, and a boolean mask of the pairs that were kept.
+  """
+  src, src_len = _lookup_batch(src, src_vocab_table, src_max_len, src_eos_id)
+  tgt, tgt_len = _lookup_batch(tgt, tgt_vocab_table, tgt_max_len, tgt_eos_id)
+  # Filter zero length input sequences.
+  keep = tf.logical_and(src_len > 0, tgt_len > 0)
+  src, src_len = tf.boolean_mask(src, keep), tf.boolean_mask(src_len, keep)
+  tgt, tgt_len = tf.boolean_mask(tgt, keep), tf.boolean_mask(tgt_len, keep)
+  # tgt is padded with eos, so appending an eos column gives tgt_output.
+  num_rows = tf.shape(tgt)[0]
+  tgt_in = tf.concat((tf.fill([num_rows, 1], tgt_sos_id), tgt), axis=1)
+  tgt_out = tf.concat((tgt, tf.fill([num_rows, 1], tgt_eos_id)), axis=1)
+  return (src, tgt_in, tgt_out, src_len, tgt_len + 1), keep
+
 # src_vocab_table: 源数据单词查找表，就是个单词和int类型数据的对应表
 # tgt_vocab_table: 目标数据单词查找表，就是个单词和int类型数据的对应表
 def get_infer_iterator(src_dataset,
                        src_vocab_table,
                        batch_size,
                        eos,
-                       src_max_len=None):
+                       src_max_len=None,
+                       num_parallel_calls=4,
+                       batch_first=False):
   src_eos_id = tf.cast(src_vocab_table.lookup(tf.constant(eos)), tf.int32)
-  src_dataset = src_dataset.map(lambda src: tf.string_split([src]).values)
+
+  if batch_first:
+    # Batch the raw lines, then tokenize and look up the whole batch at once.
+    batched_dataset = src_dataset.batch(batch_size).map(
+        lambda src: _lookup_batch(src, src_vocab_table, src_max_len,
+                                  src_eos_id),
+        num_parallel_calls=num_parallel_calls).prefetch(1)
+    batched_iter = batched_dataset.make_initializable_iterator()
+    (src_ids, src_seq_len) = batched_iter.get_next()
+    return BatchedInput(
+        initializer=batched_iter.initializer,
+        source=src_ids,
+        target_input=None,
+        target_output=None,
+        source_sequence_length=src_seq_len,
+        target_sequence_length=None,
+        source_counts=None)
+
+  src_dataset = src_dataset.map(lambda src: tf.string_split([src]).values,
+                                num_parallel_calls=num_parallel_calls)
 
   if src_max_len:
-    src_dataset = src_dataset.map(lambda src: src[:src_max_len])
+    src_dataset = src_dataset.map(lambda src: src[:src_max_len],
+                                  num_parallel_calls=num_parallel_calls)
   # Convert the word strings to ids
   src_dataset = src_dataset.map(
-      lambda src: tf.cast(src_vocab_table.lookup(src), tf.int32))
+      lambda src: tf.cast(src_vocab_table.lookup(src), tf.int32),
+      num_parallel_calls=num_parallel_calls)
   # Add in the word counts.
-  src_dataset = src_dataset.map(lambda src: (src, tf.size(src)))
+  src_dataset = src_dataset.map(lambda src: (src, tf.size(src)),
+                                num_parallel_calls=num_parallel_calls)
 
   def batching_func(x):
     return x.padded_batch(
@@ -64,7 +339,7 @@ def get_infer_iterator(src_dataset,
             src_eos_id,  # src
             0))  # src_len -- unused
 
-  batched_dataset = batching_func(src_dataset)
+  batched_dataset = batching_func(src_dataset).prefetch(1)
   batched_iter = batched_dataset.make_initializable_iterator()
   (src_ids, src_seq_len) = batched_iter.get_next()
   return BatchedInput(
@@ -73,7 +348,84 @@ def get_infer_iterator(src_dataset,
       target_input=None,
       target_output=None,
       source_sequence_length=src_seq_len,
-      target_sequence_length=None)
+      target_sequence_length=None,
+      source_counts=None)
+
+
+def get_eval_iterator(src_dataset,
+                      tgt_dataset,
+                      src_vocab_table,
+                      tgt_vocab_table,
+                      batch_size,
+                      sos,
+                      eos,
+                      src_max_len=None,
+                      tgt_max_len=None,
+                      batch_tokens=None,
+                      num_parallel_calls=4):
+  """Deterministic input pipeline for perplexity evaluation.
+
+  Nothing is shuffled. Pairs are grouped by length, max(src_len, tgt_len), so
+  that batches need little or no padding, and every batch holds either
+  batch_size pairs or, with batch_tokens, about batch_tokens tokens per side.
+  Since no gradients are kept, both can be much larger than in training.
+  """
+  src_eos_id = tf.cast(src_vocab_table.lookup(tf.constant(eos)), tf.int32)
+  tgt_sos_id = tf.cast(tgt_vocab_table.lookup(tf.constant(sos)), tf.int32)
+  tgt_eos_id = tf.cast(tgt_vocab_table.lookup(tf.constant(eos)), tf.int32)
+
+  # Preprocess in large vectorized batches, then split them back into pairs.
+  src_tgt_dataset = tf.data.Dataset.zip((src_dataset, tgt_dataset)).batch(
+      _EVAL_PREPROCESS_BATCH_SIZE).map(
+          lambda src, tgt: _preprocess_pair_batch(
+              src, tgt, src_vocab_table, tgt_vocab_table, src_max_len,
+              tgt_max_len, src_eos_id, tgt_sos_id, tgt_eos_id)[0],
+          num_parallel_calls=num_parallel_calls)
+  src_tgt_dataset = src_tgt_dataset.apply(tf.contrib.data.unbatch()).map(
+      lambda src, tgt_in, tgt_out, src_len, tgt_len: (
+          src[:src_len], tgt_in[:tgt_len], tgt_out[:tgt_len], src_len,
+          tgt_len),
+      num_parallel_calls=num_parallel_calls)
+
+  def key_func(unused_1, unused_2, unused_3, src_len, tgt_len):
+    return tf.to_int64(tf.maximum(src_len, tgt_len))
+
+  def window_size_func(key):
+    if batch_tokens:
+      return tf.maximum(tf.constant(1, tf.int64), batch_tokens // key)
+    return tf.constant(batch_size, tf.int64)
+
+  def reduce_func(key, windowed_data):
+    return windowed_data.padded_batch(
+        window_size_func(key),
+        padded_shapes=(
+            tf.TensorShape([None]),  # src
+            tf.TensorShape([None]),  # tgt_input
+            tf.TensorShape([None]),  # tgt_output
+            tf.TensorShape([]),  # src_len
+            tf.TensorShape([])),  # tgt_len
+        padding_values=(src_eos_id, tgt_eos_id, tgt_eos_id, 0, 0))
+
+  batched_dataset = src_tgt_dataset.apply(
+      tf.contrib.data.group_by_window(
+          key_func=key_func,
+          reduce_func=reduce_func,
+          window_size_func=window_size_func)).prefetch(1)
+
+  batched_iter = batched_dataset.make_initializable_iterator()
+  (src_ids,
+   tgt_input_ids,
+   tgt_output_ids,
+   src_seq_len,
+   tgt_seq_len) = batched_iter.get_next()
+  return BatchedInput(
+      initializer=batched_iter.initializer,
+      source=src_ids,
+      target_input=tgt_input_ids,
+      target_output=tgt_output_ids,
+      source_sequence_length=src_seq_len,
+      target_sequence_length=tgt_seq_len,
+      source_counts=None)
 
 
 def get_iterator(src_dataset,
@@ -92,81 +444,151 @@ def get_iterator(src_dataset,
                  skip_count=None,
                  num_shards=1,
                  shard_index=0,
-                 reshuffle_each_iteration=True):
+                 reshuffle_each_iteration=True,
+                 repeat_dataset=False,
+                 memory_budget_mb=None,
+                 batch_first=False,
+                 num_sources=0):
+  """Build the batched train/eval input pipeline.
+
+  With num_sources > 0, src_dataset is a mixture from get_mixture_dataset and
+  yields (src, tgt, source_id) triples; the source id of each pair is carried
+  along every stage so that source_counts holds the number of pairs of each
+  source in every batch that is produced.
+  """
+  # With a memory budget, buffer sizes and parallelism come from the budget
+  # and only the final batches are prefetched, instead of a full
+  # output_buffer_size after every map stage.
+  pipeline_config = None
+  if memory_budget_mb:
+    pipeline_config = get_pipeline_config(
+        batch_size, memory_budget_mb, src_max_len=src_max_len,
+        tgt_max_len=tgt_max_len, num_buckets=num_buckets)
+    output_buffer_size = pipeline_config.shuffle_buffer_size
+    num_parallel_calls = pipeline_config.num_parallel_calls
   if not output_buffer_size:
     output_buffer_size = batch_size * 1000
+
+  def maybe_prefetch(dataset):
+    if pipeline_config:
+      return dataset
+    return dataset.prefetch(buffer_size=output_buffer_size)
+
   # 获取eos_id
   src_eos_id = tf.cast(src_vocab_table.lookup(tf.constant(eos)), tf.int32)
   tgt_sos_id = tf.cast(tgt_vocab_table.lookup(tf.constant(sos)), tf.int32)
   tgt_eos_id = tf.cast(tgt_vocab_table.lookup(tf.constant(eos)), tf.int32)
 
-  src_tgt_dataset = tf.data.Dataset.zip((src_dataset, tgt_dataset)) # 将样本按行对齐,(源样本,目标样本)
+  # A None tgt_dataset means src_dataset already yields aligned (src, tgt)
+  # pairs, e.g. from get_sharded_dataset, or (src, tgt, source_id) triples.
+  if tgt_dataset is None:
+    src_tgt_dataset = src_dataset
+  else:
+    src_tgt_dataset = tf.data.Dataset.zip((src_dataset, tgt_dataset)) # 将样本按行对齐,(源样本,目标样本)
 
   src_tgt_dataset = src_tgt_dataset.shard(num_shards, shard_index) # 将数据集分成num_shards份
-  if skip_count is not None:
+  if repeat_dataset:
+    # Stream the data over epochs so that the shuffle buffer below is never
+    # drained and refilled at an epoch boundary. Only the first pass skips
+    # skip_count elements; the following passes start at the beginning.
+    if skip_count is not None:
+      src_tgt_dataset = src_tgt_dataset.skip(skip_count).concatenate(
+          src_tgt_dataset.repeat())
+    else:
+      src_tgt_dataset = src_tgt_dataset.repeat()
+  elif skip_count is not None:
     src_tgt_dataset = src_tgt_dataset.skip(skip_count) # 跳过部分样本
   # source, target dataset
   src_tgt_dataset = src_tgt_dataset.shuffle(
       buffer_size=output_buffer_size, seed=random_seed,
       reshuffle_each_iteration=reshuffle_each_iteration)
-  """
-  For example:
-  N = 2, source[0] is 'hello world' and source[1] is 'a b c', then the output will be:
-  st.indices = [0, 0;
-                0, 1;
-                1, 0;
-                1, 1;
-                1, 2]
-  st.shape = [2, 3]
-  st.values = ['hello', 'world', 'a', 'b', 'c']
-  """
-  src_tgt_dataset = src_tgt_dataset.map(
-      lambda src, tgt: (
-          tf.string_split(source=[src], delimiter=' ').values,
-          tf.string_split(source=[tgt], delimiter=' ').values
-      ),
-      num_parallel_calls=num_parallel_calls).prefetch(buffer_size=output_buffer_size)
 
-  # Filter zero length input sequences.
-  # 过滤操作,这些操作应该是针对每条record记录
-  src_tgt_dataset = src_tgt_dataset.filter(
-      lambda src, tgt: tf.logical_and(tf.size(src) > 0, tf.size(tgt) > 0))
+  if batch_first:
+    # Batch the raw lines first, then split, truncate, look up and measure
+    # the whole batch with one vectorized op chain.
+    def preprocess_batch(src, tgt, *source_id):
+      inputs, keep = _preprocess_pair_batch(
+          src, tgt, src_vocab_table, tgt_vocab_table, src_max_len,
+          tgt_max_len, src_eos_id, tgt_sos_id, tgt_eos_id)
+      return inputs + tuple(tf.boolean_mask(ids, keep) for ids in source_id)
 
-  if src_max_len:
-    src_tgt_dataset = src_tgt_dataset.map(
-        lambda src, tgt: (src[:src_max_len], tgt),
-        num_parallel_calls=num_parallel_calls).prefetch(buffer_size=output_buffer_size)
-  if tgt_max_len:
-    src_tgt_dataset = src_tgt_dataset.map(
-        lambda src, tgt: (src, tgt[:tgt_max_len]),
-        num_parallel_calls=num_parallel_calls).prefetch(buffer_size=output_buffer_size)
-
-  # Convert the word strings to ids.  Word strings that are not in the
-  # vocab get the lookup table's default_value integer.
-  src_tgt_dataset = src_tgt_dataset.map(
-      lambda src, tgt: (tf.cast(src_vocab_table.lookup(src), tf.int32), # 将word -> id
-                        tf.cast(tgt_vocab_table.lookup(tgt), tf.int32)),
-      num_parallel_calls=num_parallel_calls).prefetch(output_buffer_size)
-
-  # Create a tgt_input prefixed with <sos> and a tgt_output suffixed with <eos>.
-  src_tgt_dataset = src_tgt_dataset.map(
-      lambda src, tgt: (src,
-                        tf.concat(([tgt_sos_id], tgt), axis=0), # target_input, 前面加入sos
-                        tf.concat((tgt, [tgt_eos_id]), axis=0)), # target_output, 后面加入eos
-      num_parallel_calls=num_parallel_calls).prefetch(output_buffer_size)
-  # Add in sequence lengths.
-  src_tgt_dataset = src_tgt_dataset.map(
-      lambda src, tgt_in, tgt_out: (
-          src,
-          tgt_in,
-          tgt_out,
-          tf.size(src), # encoder_length
-          tf.size(tgt_in) # decoder_input_length
-      ),
-      num_parallel_calls=num_parallel_calls).prefetch(output_buffer_size)
+    src_tgt_dataset = src_tgt_dataset.batch(batch_size).map(
+        preprocess_batch, num_parallel_calls=num_parallel_calls)
+
+    if num_buckets > 1:
+      # Bucketing works on single pairs: split the batches back up and drop
+      # their padding. These are cheap slices, not string ops.
+      src_tgt_dataset = src_tgt_dataset.apply(tf.contrib.data.unbatch()).map(
+          lambda src, tgt_in, tgt_out, src_len, tgt_len, *source_id: (
+              src[:src_len], tgt_in[:tgt_len], tgt_out[:tgt_len], src_len,
+              tgt_len) + source_id,
+          num_parallel_calls=num_parallel_calls)
+  else:
+    """
+    For example:
+    N = 2, source[0] is 'hello world' and source[1] is 'a b c', then the output will be:
+    st.indices = [0, 0;
+                  0, 1;
+                  1, 0;
+                  1, 1;
+                  1, 2]
+    st.shape = [2, 3]
+    st.values = ['hello', 'world', 'a', 'b', 'c']
+    """
+    src_tgt_dataset = maybe_prefetch(src_tgt_dataset.map(
+        lambda src, tgt, *source_id: (
+            tf.string_split(source=[src], delimiter=' ').values,
+            tf.string_split(source=[tgt], delimiter=' ').values
+        ) + source_id,
+        num_parallel_calls=num_parallel_calls))
+
+    # Filter zero length input sequences.
+    # 过滤操作,这些操作应该是针对每条record记录
+    src_tgt_dataset = src_tgt_dataset.filter(
+        lambda src, tgt, *unused_source_id: tf.logical_and(
+            tf.size(src) > 0, tf.size(tgt) > 0))
+
+    if src_max_len:
+      src_tgt_dataset = maybe_prefetch(src_tgt_dataset.map(
+          lambda src, tgt, *source_id: (src[:src_max_len], tgt) + source_id,
+          num_parallel_calls=num_parallel_calls))
+    if tgt_max_len:
+      src_tgt_dataset = maybe_prefetch(src_tgt_dataset.map(
+          lambda src, tgt, *source_id: (src, tgt[:tgt_max_len]) + source_id,
+          num_parallel_calls=num_parallel_calls))
+
+    # Convert the word strings to ids.  Word strings that are not in the
+    # vocab get the lookup table's default_value integer.
+    src_tgt_dataset = maybe_prefetch(src_tgt_dataset.map(
+        lambda src, tgt, *source_id: (
+            tf.cast(src_vocab_table.lookup(src), tf.int32), # 将word -> id
+            tf.cast(tgt_vocab_table.lookup(tgt), tf.int32)) + source_id,
+        num_parallel_calls=num_parallel_calls))
+
+    # Create a tgt_input prefixed with <sos> and a tgt_output suffixed with <eos>.
+    src_tgt_dataset = maybe_prefetch(src_tgt_dataset.map(
+        lambda src, tgt, *source_id: (
+            src,
+            tf.concat(([tgt_sos_id], tgt), axis=0), # target_input, 前面加入sos
+            tf.concat((tgt, [tgt_eos_id]), axis=0)) + source_id, # target_output, 后面加入eos
+        num_parallel_calls=num_parallel_calls))
+    # Add in sequence lengths.
+    src_tgt_dataset = maybe_prefetch(src_tgt_dataset.map(
+        lambda src, tgt_in, tgt_out, *source_id: (
+            src,
+            tgt_in,
+            tgt_out,
+            tf.size(src), # encoder_length
+            tf.size(tgt_in) # decoder_input_length
+        ) + source_id,
+        num_parallel_calls=num_parallel_calls))
 
   # Bucket by source sequence length (buckets for lengths 0-9, 10-19, ...)
   # 将相近长度的样本放在一起训练,padding时效率较高
+  # Mixtures carry the scalar source id of every pair after the lengths.
+  source_id_shapes = (tf.TensorShape([]),) if num_sources else ()
+  source_id_padding = (0,) if num_sources else ()
+
   def batching_func(x):
     return x.padded_batch(
         batch_size,
@@ -178,7 +600,7 @@ def get_iterator(src_dataset,
             tf.TensorShape([None]),  # tgt_input
             tf.TensorShape([None]),  # tgt_output
             tf.TensorShape([]),  # src_len, scalar
-            tf.TensorShape([])),  # tgt_len
+            tf.TensorShape([])) + source_id_shapes,  # tgt_len
 
         # Pad the source and target sequences with eos tokens.
         # (Though notice we don't generally need to do this since
@@ -189,10 +611,10 @@ def get_iterator(src_dataset,
             tgt_eos_id,  # tgt_input
             tgt_eos_id,  # tgt_output
             0,  # src_len -- unused
-            0))  # tgt_len -- unused
+            0) + source_id_padding)  # tgt_len -- unused
 
   if num_buckets > 1:
-    def key_func(unused_1, unused_2, unused_3, src_len, tgt_len):
+    def key_func(unused_1, unused_2, unused_3, src_len, tgt_len, *unused_4):
       # Calculate bucket_width by maximum source sequence length.
       # Pairs with length [0, bucket_width) go to bucket 0, length
       # [bucket_width, 2 * bucket_width) go to bucket 1, etc.  Pairs with length
@@ -216,15 +638,32 @@ def get_iterator(src_dataset,
             reduce_func=reduce_func,
             window_size=batch_size))
 
+  elif batch_first:
+    # Pairs with an empty side are dropped after batching, so a batch can
+    # come out empty, which would make the loss 0 / 0.
+    batched_dataset = src_tgt_dataset.filter(
+        lambda unused_1, unused_2, unused_3, src_len, *unused_4: (
+            tf.size(src_len) > 0))
   else:
     batched_dataset = batching_func(src_tgt_dataset)
 
+  if pipeline_config:
+    batched_dataset = batched_dataset.prefetch(
+        pipeline_config.prefetch_batches)
+
   batched_iter = batched_dataset.make_initializable_iterator()
+  next_batch = batched_iter.get_next()
   (src_ids,
    tgt_input_ids,
    tgt_output_ids,
    src_seq_len,
-   tgt_seq_len) = (batched_iter.get_next())
+   tgt_seq_len) = next_batch[:5]
+
+  source_counts = None
+  if num_sources:
+    source_ids = next_batch[5]
+    source_counts = tf.bincount(source_ids, minlength=num_sources,
+                                maxlength=num_sources)
 
   return BatchedInput(
       initializer=batched_iter.initializer,
@@ -232,4 +671,5 @@ def get_iterator(src_dataset,
       target_input=tgt_input_ids,
       target_output=tgt_output_ids,
       source_sequence_length=src_seq_len,
-      target_sequence_length=tgt_seq_len)
+      target_sequence_length=tgt_seq_len,
+      source_counts=source_counts)
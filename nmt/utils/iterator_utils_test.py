@@ -19,6 +19,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+
 import tensorflow as tf
 
 from tensorflow.python.ops import lookup_ops
@@ -106,6 +108,57 @@ class IteratorUtilsTest(tf.test.TestCase):
       with self.assertRaisesOpError("End of sequence"):
         sess.run(source)
 
+  def testGetEvalIterator(self):
+    tgt_vocab_table = src_vocab_table = lookup_ops.index_table_from_tensor(
+        tf.constant(["a", "b", "c", "eos", "sos"]))
+    src_dataset = tf.data.Dataset.from_tensor_slices(
+        tf.constant(["f e a g", "c c a", "d", "c a"]))
+    tgt_dataset = tf.data.Dataset.from_tensor_slices(
+        tf.constant(["c c", "a b", "", "b c"]))
+    iterator = iterator_utils.get_eval_iterator(
+        src_dataset=src_dataset,
+        tgt_dataset=tgt_dataset,
+        src_vocab_table=src_vocab_table,
+        tgt_vocab_table=tgt_vocab_table,
+        batch_size=100,
+        sos="sos",
+        eos="eos",
+        src_max_len=3,
+        batch_tokens=6)
+    table_initializer = tf.tables_initializer()
+    source = iterator.source
+    target_input = iterator.target_input
+    src_seq_len = iterator.source_sequence_length
+    tgt_seq_len = iterator.target_sequence_length
+    with self.test_session() as sess:
+      sess.run(table_initializer)
+      sess.run(iterator.initializer)
+
+      # All pairs have length 3, so a budget of 6 tokens fits two of them.
+      # The order is the order of the data.
+      (source_v, src_len_v, target_input_v, tgt_len_v) = (
+          sess.run((source, src_seq_len, target_input, tgt_seq_len)))
+      self.assertAllEqual(
+          [[-1, -1, 0],  # "f" == unknown, "e" == unknown, a
+           [2, 2, 0]],  # c c a
+          source_v)
+      self.assertAllEqual([3, 3], src_len_v)
+      self.assertAllEqual(
+          [[4, 2, 2],  # sos c c
+           [4, 0, 1]],  # sos a b
+          target_input_v)
+      self.assertAllEqual([3, 3], tgt_len_v)
+
+      (source_v, src_len_v, target_input_v, tgt_len_v) = (
+          sess.run((source, src_seq_len, target_input, tgt_seq_len)))
+      self.assertAllEqual([[2, 0]], source_v)  # c a
+      self.assertAllEqual([2], src_len_v)
+      self.assertAllEqual([[4, 1, 2]], target_input_v)  # sos b c
+      self.assertAllEqual([3], tgt_len_v)
+
+      with self.assertRaisesOpError("End of sequence"):
+        sess.run(source)
+
   def testGetIteratorWithShard(self):
     tf.set_random_seed(1)
     tgt_vocab_table = src_vocab_table = lookup_ops.index_table_from_tensor(
@@ -272,6 +325,267 @@ class IteratorUtilsTest(tf.test.TestCase):
       with self.assertRaisesOpError("End of sequence"):
         sess.run(source)
 
+  def testGetIteratorWithRepeat(self):
+    tf.set_random_seed(1)
+    tgt_vocab_table = src_vocab_table = lookup_ops.index_table_from_tensor(
+        tf.constant(["a", "b", "c", "eos", "sos"]))
+    src_dataset = tf.data.Dataset.from_tensor_slices(
+        tf.constant(["c a", "c c a", "d", "f e a g"]))
+    tgt_dataset = tf.data.Dataset.from_tensor_slices(
+        tf.constant(["b c", "a b", "", "c c"]))
+    hparams = tf.contrib.training.HParams(
+        random_seed=3,
+        num_buckets=5,
+        eos="eos",
+        sos="sos")
+    batch_size = 2
+    src_max_len = 3
+    skip_count = tf.placeholder(shape=(), dtype=tf.int64)
+    iterator = iterator_utils.get_iterator(
+        src_dataset=src_dataset,
+        tgt_dataset=tgt_dataset,
+        src_vocab_table=src_vocab_table,
+        tgt_vocab_table=tgt_vocab_table,
+        batch_size=batch_size,
+        sos=hparams.sos,
+        eos=hparams.eos,
+        random_seed=hparams.random_seed,
+        num_buckets=hparams.num_buckets,
+        src_max_len=src_max_len,
+        skip_count=skip_count,
+        repeat_dataset=True)
+    table_initializer = tf.tables_initializer()
+    source = iterator.source
+    src_seq_len = iterator.source_sequence_length
+    with self.test_session() as sess:
+      sess.run(table_initializer)
+      sess.run(iterator.initializer, feed_dict={skip_count: 3})
+
+      # The 3 valid pairs are streamed over and over again, so we can read
+      # more batches than a single epoch holds without reaching the end.
+      for _ in range(5):
+        (source_v, src_len_v) = sess.run((source, src_seq_len))
+        self.assertEqual(batch_size, source_v.shape[0])
+        self.assertEqual(batch_size, src_len_v.shape[0])
+
+  def testGetPipelineConfig(self):
+    config = iterator_utils.get_pipeline_config(
+        batch_size=128, memory_budget_mb=64, src_max_len=50, tgt_max_len=50,
+        num_buckets=5)
+    # 48MB of raw pairs of (2 * 64 + 100 * 8) bytes each.
+    self.assertEqual(48 * 1024 * 1024 // 928, config.shuffle_buffer_size)
+    self.assertGreaterEqual(config.prefetch_batches, 1)
+    self.assertNotEqual(0, config.num_parallel_calls)
+
+    # A tiny budget still keeps one batch in the shuffle and prefetch buffers.
+    config = iterator_utils.get_pipeline_config(
+        batch_size=128, memory_budget_mb=0.01)
+    self.assertEqual(128, config.shuffle_buffer_size)
+    self.assertEqual(1, config.prefetch_batches)
+
+  def testGetIteratorBatchFirst(self):
+    tf.set_random_seed(1)
+    tgt_vocab_table = src_vocab_table = lookup_ops.index_table_from_tensor(
+        tf.constant(["a", "b", "c", "eos", "sos"]))
+    src_dataset = tf.data.Dataset.from_tensor_slices(
+        tf.constant(["f e a g", "c c a", "d", "c a"]))
+    tgt_dataset = tf.data.Dataset.from_tensor_slices(
+        tf.constant(["c c", "a b", "", "b c"]))
+    hparams = tf.contrib.training.HParams(
+        random_seed=3,
+        num_buckets=1,
+        eos="eos",
+        sos="sos")
+    batch_size = 4
+    src_max_len = 3
+    iterator = iterator_utils.get_iterator(
+        src_dataset=src_dataset,
+        tgt_dataset=tgt_dataset,
+        src_vocab_table=src_vocab_table,
+        tgt_vocab_table=tgt_vocab_table,
+        batch_size=batch_size,
+        sos=hparams.sos,
+        eos=hparams.eos,
+        random_seed=hparams.random_seed,
+        num_buckets=hparams.num_buckets,
+        src_max_len=src_max_len,
+        reshuffle_each_iteration=False,
+        batch_first=True)
+    table_initializer = tf.tables_initializer()
+    source = iterator.source
+    target_input = iterator.target_input
+    target_output = iterator.target_output
+    src_seq_len = iterator.source_sequence_length
+    tgt_seq_len = iterator.target_sequence_length
+    self.assertEqual([None, None], source.shape.as_list())
+    self.assertEqual([None], src_seq_len.shape.as_list())
+    with self.test_session() as sess:
+      sess.run(table_initializer)
+      sess.run(iterator.initializer)
+
+      (source_v, src_len_v, target_input_v, target_output_v, tgt_len_v) = (
+          sess.run((source, src_seq_len, target_input, target_output,
+                    tgt_seq_len)))
+      # One batch holding the 3 non-empty pairs, in shuffled order.
+      self.assertEqual(3, len(src_len_v))
+      self.assertAllEqual([2, 3, 3], sorted(src_len_v))
+      self.assertAllEqual([3, 3, 3], tgt_len_v)
+      pairs = sorted(zip(source_v.tolist(), target_input_v.tolist(),
+                         target_output_v.tolist()))
+      self.assertAllEqual(
+          [([-1, -1, 0], [4, 2, 2], [2, 2, 3]),  # f e a -> c c
+           ([2, 0, 3], [4, 1, 2], [1, 2, 3]),    # c a eos -> b c
+           ([2, 2, 0], [4, 0, 1], [0, 1, 3])],   # c c a -> a b
+          pairs)
+
+      with self.assertRaisesOpError("End of sequence"):
+        sess.run(source)
+
+  def testGetIteratorBatchFirstSkipsEmptyBatches(self):
+    vocab_table = lookup_ops.index_table_from_tensor(
+        tf.constant(["a", "b", "c", "eos", "sos"]))
+    # The first batch only has pairs with an empty side, the second one only
+    # over-length lines, which are truncated.
+    src_dataset = tf.data.Dataset.from_tensor_slices(
+        tf.constant(["", "a b", "c c a b", "a b c a"]))
+    tgt_dataset = tf.data.Dataset.from_tensor_slices(
+        tf.constant(["a", " ", "b", "c c c c"]))
+    iterator = iterator_utils.get_iterator(
+        src_dataset=src_dataset,
+        tgt_dataset=tgt_dataset,
+        src_vocab_table=vocab_table,
+        tgt_vocab_table=vocab_table,
+        batch_size=2,
+        sos="sos",
+        eos="eos",
+        random_seed=3,
+        num_buckets=1,
+        src_max_len=3,
+        tgt_max_len=2,
+        output_buffer_size=1,
+        batch_first=True)
+    table_initializer = tf.tables_initializer()
+    with self.test_session() as sess:
+      sess.run(table_initializer)
+      sess.run(iterator.initializer)
+
+      (source_v, src_len_v, tgt_len_v) = sess.run(
+          (iterator.source, iterator.source_sequence_length,
+           iterator.target_sequence_length))
+      self.assertAllEqual([[2, 2, 0], [0, 1, 2]], source_v)
+      self.assertAllEqual([3, 3], src_len_v)
+      self.assertAllEqual([2, 3], tgt_len_v)
+
+      with self.assertRaisesOpError("End of sequence"):
+        sess.run(iterator.source)
+
+  def testGetShardedDataset(self):
+    data_dir = os.path.join(tf.test.get_temp_dir(), "sharded_dataset")
+    tf.gfile.MakeDirs(data_dir)
+    src_files, tgt_files = [], []
+    for i, (src_lines, tgt_lines) in enumerate(
+        [(["a", "a b"], ["c", "c d"]), (["b"], ["d"]), (["c c"], ["e e"])]):
+      src_file = os.path.join(data_dir, "train-%d.src" % i)
+      tgt_file = os.path.join(data_dir, "train-%d.tgt" % i)
+      with tf.gfile.GFile(src_file, "w") as f:
+        f.write("\n".join(src_lines) + "\n")
+      with tf.gfile.GFile(tgt_file, "w") as f:
+        f.write("\n".join(tgt_lines) + "\n")
+      src_files.append(src_file)
+      tgt_files.append(tgt_file)
+
+    # Worker 0 of 2 reads shards 0 and 2, worker 1 reads shard 1.
+    worker_pairs = []
+    for shard_index in range(2):
+      dataset = iterator_utils.get_sharded_dataset(
+          src_files, tgt_files, num_shards=2, shard_index=shard_index,
+          random_seed=3, num_parallel_reads=2)
+      next_pair = dataset.make_one_shot_iterator().get_next()
+      pairs = []
+      with self.test_session() as sess:
+        while True:
+          try:
+            pairs.append(tuple(sess.run(next_pair)))
+          except tf.errors.OutOfRangeError:
+            break
+      worker_pairs.append(sorted(pairs))
+
+    self.assertEqual(
+        [(b"a", b"c"), (b"a b", b"c d"), (b"c c", b"e e")], worker_pairs[0])
+    self.assertEqual([(b"b", b"d")], worker_pairs[1])
+
+  def testGetShardedDatasetByLine(self):
+    data_dir = os.path.join(tf.test.get_temp_dir(), "sharded_dataset_by_line")
+    tf.gfile.MakeDirs(data_dir)
+    src_files, tgt_files = [], []
+    all_pairs = []
+    for i in range(2):
+      src_lines = ["s%d_%d" % (i, j) for j in range(7)]
+      tgt_lines = ["t%d_%d" % (i, j) for j in range(7)]
+      src_file = os.path.join(data_dir, "train-%d.src" % i)
+      tgt_file = os.path.join(data_dir, "train-%d.tgt" % i)
+      with tf.gfile.GFile(src_file, "w") as f:
+        f.write("\n".join(src_lines) + "\n")
+      with tf.gfile.GFile(tgt_file, "w") as f:
+        f.write("\n".join(tgt_lines) + "\n")
+      src_files.append(src_file)
+      tgt_files.append(tgt_file)
+      all_pairs.extend((s.encode(), t.encode())
+                       for s, t in zip(src_lines, tgt_lines))
+
+    # 3 workers for 2 files, each reading the files in its own random order:
+    # together they still see every pair exactly once.
+    worker_pairs = []
+    for shard_index in range(3):
+      dataset = iterator_utils.get_sharded_dataset(
+          src_files, tgt_files, num_shards=3, shard_index=shard_index,
+          random_seed=None, num_parallel_reads=2)
+      next_pair = dataset.make_one_shot_iterator().get_next()
+      with self.test_session() as sess:
+        while True:
+          try:
+            worker_pairs.append(tuple(sess.run(next_pair)))
+          except tf.errors.OutOfRangeError:
+            break
+
+    self.assertEqual(sorted(all_pairs), sorted(worker_pairs))
+
+  def testGetIteratorWithMixture(self):
+    vocab_table = lookup_ops.index_table_from_tensor(
+        tf.constant(["a", "b", "c", "eos", "sos"]))
+    in_domain = tf.data.Dataset.from_tensor_slices(
+        (tf.constant(["a b", "a"]), tf.constant(["b", "b a"])))
+    web = tf.data.Dataset.from_tensor_slices(
+        (tf.constant(["c c"]), tf.constant(["c"])))
+    batch_size = 10
+    iterator = iterator_utils.get_iterator(
+        src_dataset=iterator_utils.get_mixture_dataset(
+            [in_domain, web], [3, 1], random_seed=3),
+        tgt_dataset=None,
+        src_vocab_table=vocab_table,
+        tgt_vocab_table=vocab_table,
+        batch_size=batch_size,
+        sos="sos",
+        eos="eos",
+        random_seed=3,
+        num_buckets=1,
+        output_buffer_size=100,
+        num_sources=2)
+    table_initializer = tf.tables_initializer()
+    self.assertEqual([2], iterator.source_counts.shape.as_list())
+    with self.test_session() as sess:
+      sess.run(table_initializer)
+      sess.run(iterator.initializer)
+      total_counts = 0
+      for _ in range(20):
+        (source, source_counts) = sess.run(
+            (iterator.source, iterator.source_counts))
+        self.assertEqual(batch_size, source.shape[0])
+        self.assertEqual(batch_size, sum(source_counts))
+        total_counts += source_counts
+      # Roughly three in-domain pairs for every web pair.
+      self.assertGreater(total_counts[0], 2 * total_counts[1])
+      self.assertGreater(total_counts[1], 0)
 
   def testGetInferIterator(self):
     src_vocab_table = lookup_ops.index_table_from_tensor(
@@ -316,6 +630,45 @@ class IteratorUtilsTest(tf.test.TestCase):
       with self.assertRaisesOpError("End of sequence"):
         sess.run((source, seq_len))
 
+  def testGetInferIteratorBatchFirst(self):
+    src_vocab_table = lookup_ops.index_table_from_tensor(
+        tf.constant(["a", "b", "c", "eos", "sos"]))
+    src_dataset = tf.data.Dataset.from_tensor_slices(
+        tf.constant(["c c a", "c a", "d", "f e a g"]))
+    batch_size = 2
+    src_max_len = 3
+    iterator = iterator_utils.get_infer_iterator(
+        src_dataset=src_dataset,
+        src_vocab_table=src_vocab_table,
+        batch_size=batch_size,
+        eos="eos",
+        src_max_len=src_max_len,
+        batch_first=True)
+    table_initializer = tf.tables_initializer()
+    source = iterator.source
+    seq_len = iterator.source_sequence_length
+    with self.test_session() as sess:
+      sess.run(table_initializer)
+      sess.run(iterator.initializer)
+
+      # Same batches as the per-sentence pipeline.
+      (source_v, seq_len_v) = sess.run((source, seq_len))
+      self.assertAllEqual(
+          [[2, 2, 0],   # c c a
+           [2, 0, 3]],  # c a eos
+          source_v)
+      self.assertAllEqual([3, 2], seq_len_v)
+
+      (source_v, seq_len_v) = sess.run((source, seq_len))
+      self.assertAllEqual(
+          [[-1, 3, 3],    # "d" == unknown, eos eos
+           [-1, -1, 0]],  # "f" == unknown, "e" == unknown, a
+          source_v)
+      self.assertAllEqual([1, 3], seq_len_v)
+
+      with self.assertRaisesOpError("End of sequence"):
+        sess.run((source, seq_len))
+
 
 if __name__ == "__main__":
   tf.test.main()
@@ -18,6 +18,8 @@ from __future__ import print_function
 
 import codecs
 import collections
+import gzip
+import io
 import json
 import math
 import os
@@ -27,6 +29,11 @@ import time
 import numpy as np
 import tensorflow as tf
 
+try:
+  import zstandard  # pylint: disable=g-import-not-at-top
+except ImportError:
+  zstandard = None
+
 
 def check_tensorflow_version():
   min_tf_version = "1.4.0-dev20171024"
@@ -122,6 +129,88 @@ def save_hparams(out_dir, hparams):
     f.write(hparams.to_json())
 
 
+def get_compression_type(filename):
+  """Compression type of a file from its suffix: "GZIP", "ZSTD" or ""."""
+  if filename.endswith(".gz"):
+    return "GZIP"
+  if filename.endswith(".zst"):
+    return "ZSTD"
+  return ""
+
+
+COMPRESSED_SUFFIXES = (".gz", ".zst")
+
+
+def get_data_file(prefix, suffix):
+  """Return "prefix.suffix", or its compressed version if only that exists."""
+  filename = "%s.%s" % (prefix, suffix)
+  if not tf.gfile.Exists(filename):
+    for compressed_suffix in COMPRESSED_SUFFIXES:
+      if tf.gfile.Exists(filename + compressed_suffix):
+        return filename + compressed_suffix
+  return filename
+
+
+class _CompressedFile(object):
+  """A (de)compressing stream that also closes the GFile underneath it."""
+
+  def __init__(self, stream, gfile):
+    self._stream = stream
+    self._gfile = gfile
+
+  def __getattr__(self, name):
+    return getattr(self._stream, name)
+
+  def __iter__(self):
+    return iter(self._stream)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_args):
+    self.close()
+
+  def close(self):
+    try:
+      self._stream.close()
+    finally:
+      self._gfile.close()
+
+
+def open_file(filename, mode="rb", compression_type=None):
+  """Open a binary GFile, decompressing gzip and zstd files transparently.
+
+  Args:
+    filename: path of the file.
+    mode: "rb" or "wb".
+    compression_type: "GZIP", "ZSTD" or "". Inferred from the file suffix
+      when None.
+
+  Returns:
+    A file object that can be wrapped with codecs.getreader/getwriter.
+
+  Raises:
+    ValueError: if the file is zstd compressed but zstandard is not installed.
+  """
+  if compression_type is None:
+    compression_type = get_compression_type(filename)
+  f = tf.gfile.GFile(filename, mode=mode)
+  if compression_type == "GZIP":
+    return _CompressedFile(gzip.GzipFile(fileobj=f, mode=mode), f)
+  if compression_type == "ZSTD":
+    if zstandard is None:
+      f.close()
+      raise ValueError("Reading or writing %s needs the zstandard package" %
+                       filename)
+    if "r" in mode:
+      stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f))
+    else:
+      # Compress with one thread per core.
+      stream = zstandard.ZstdCompressor(threads=-1).stream_writer(f)
+    return _CompressedFile(stream, f)
+  return f
+
+
 def debug_tensor(s, msg=None, summarize=10):
   """Print the shape and value of a tensor at test time. Return a new tensor."""
   if not msg:
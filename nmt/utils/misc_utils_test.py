@@ -19,6 +19,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import codecs
+import os
+
 import tensorflow as tf
 
 from ..utils import misc_utils
@@ -44,6 +47,20 @@ class MiscUtilsTest(tf.test.TestCase):
     self.assertEqual(expected_result,
                      misc_utils.format_spm_text(spm_line.split(b" ")))
 
+  def testOpenGzipFile(self):
+    filename = os.path.join(tf.test.get_temp_dir(), "text.en.gz")
+    self.assertEqual("GZIP", misc_utils.get_compression_type(filename))
+    with codecs.getwriter("utf-8")(
+        misc_utils.open_file(filename, "wb")) as f:
+      f.write(u"a b c\nd e\n")
+    with misc_utils.open_file(filename, "rb", compression_type="") as f:
+      self.assertNotEqual(b"a b c\nd e\n", f.read())
+    with codecs.getreader("utf-8")(
+        misc_utils.open_file(filename, "rb")) as f:
+      self.assertEqual([u"a b c", u"d e"], f.read().splitlines())
+    self.assertEqual(
+        filename, misc_utils.get_data_file(filename[:-len(".en.gz")], "en"))
+
 
 if __name__ == "__main__":
   tf.test.main()
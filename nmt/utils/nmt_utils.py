@@ -17,6 +17,9 @@
 from __future__ import print_function
 
 import codecs
+import hashlib
+import os
+import random
 import time
 import numpy as np
 import tensorflow as tf
@@ -24,7 +27,8 @@ import tensorflow as tf
 from ..utils import evaluation_utils
 from ..utils import misc_utils as utils
 
-__all__ = ["decode_and_evaluate", "get_translation"]
+__all__ = ["decode_and_evaluate", "pack_eval_sets", "decode_and_evaluate_sets",
+           "get_translation", "get_eval_subset"]
 
 
 def decode_and_evaluate(name,
@@ -46,7 +50,7 @@ def decode_and_evaluate(name,
     start_time = time.time()
     num_sentences = 0
     with codecs.getwriter("utf-8")(
-        tf.gfile.GFile(trans_file, mode="wb")) as trans_f:
+        utils.open_file(trans_file, mode="wb")) as trans_f:
       trans_f.write("")  # Write empty string to ensure file is created.
 
       num_translations_per_input = max(
@@ -88,6 +92,152 @@ def decode_and_evaluate(name,
 
   return evaluation_scores
 
+def pack_eval_sets(src_data):
+  """Merge the sentences of several eval sets into one length-sorted list.
+
+  Args:
+    src_data: a list with the list of source sentences of every set.
+
+  Returns:
+    packed_src_data: all sentences, sorted by number of words so that
+      batches need little padding.
+    order: the (set index, sentence index) of every packed sentence.
+  """
+  order = [(set_id, i) for set_id, sentences in enumerate(src_data)
+           for i in range(len(sentences))]
+  order.sort(key=lambda pair: len(src_data[pair[0]][pair[1]].split()))
+  packed_src_data = [src_data[set_id][i] for set_id, i in order]
+  return packed_src_data, order
+
+
+def decode_and_evaluate_sets(names,
+                             model,
+                             sess,
+                             order,
+                             trans_files,
+                             ref_files,
+                             metrics,
+                             subword_option,
+                             beam_width,
+                             tgt_eos,
+                             decode=True):
+  """Decode eval sets packed by pack_eval_sets and score every set.
+
+  The infer iterator must already be initialized with the packed sentences.
+  The translations are put back in the order of their set and written to
+  one file per set.
+
+  Returns:
+    A list with the evaluation scores of every set.
+  """
+  if decode:
+    utils.print_out("  decoding to outputs %s." % ", ".join(trans_files))
+    start_time = time.time()
+    translations = [[] for _ in names]
+    for set_id, _ in order:
+      translations[set_id].append(None)
+
+    num_sentences = 0
+    while True:
+      try:
+        nmt_outputs, _ = model.decode(sess)
+        if beam_width == 0:
+          nmt_outputs = np.expand_dims(nmt_outputs, 0)
+        for sent_id in range(nmt_outputs.shape[1]):
+          set_id, i = order[num_sentences]
+          translations[set_id][i] = get_translation(
+              nmt_outputs[0],
+              sent_id,
+              tgt_eos=tgt_eos,
+              subword_option=subword_option)
+          num_sentences += 1
+      except tf.errors.OutOfRangeError:
+        utils.print_time("  done, num sentences %d" % num_sentences,
+                         start_time)
+        break
+
+    for trans_file, set_translations in zip(trans_files, translations):
+      with codecs.getwriter("utf-8")(
+          utils.open_file(trans_file, mode="wb")) as trans_f:
+        trans_f.write("")  # Write empty string to ensure file is created.
+        for translation in set_translations:
+          trans_f.write((translation + b"\n").decode("utf-8"))
+
+  # Evaluation
+  set_scores = []
+  for name, trans_file, ref_file in zip(names, trans_files, ref_files):
+    evaluation_scores = {}
+    if ref_file and tf.gfile.Exists(trans_file):
+      for metric in metrics:
+        score = evaluation_utils.evaluate(
+            ref_file,
+            trans_file,
+            metric,
+            subword_option=subword_option)
+        evaluation_scores[metric] = score
+        utils.print_out("  %s %s: %.1f" % (metric, name, score))
+    set_scores.append(evaluation_scores)
+  return set_scores
+
+
+def get_eval_subset(prefix, src, tgt, subset_size, out_dir, random_seed=None):
+  """Pick a length-stratified subset of an eval set, once.
+
+  The pairs are sorted by source length and split into subset_size strata of
+  equal size, and one pair is drawn from each stratum, so the subset covers
+  short and long sentences like the full set does. The subset is written to
+  out_dir and reused by later calls, which keeps scores comparable across
+  evaluations and restarts. The cached files are named after a hash of prefix,
+  so another eval set with the same file name gets its own subset.
+
+  Args:
+    prefix: eval set prefix, with src/tgt suffixes.
+    src: source suffix.
+    tgt: target suffix.
+    subset_size: number of pairs in the subset.
+    out_dir: directory the subset files are cached in.
+    random_seed: seed for the choice of the pairs.
+
+  Returns:
+    The prefix of the subset files.
+  """
+  subset_prefix = os.path.join(
+      out_dir, "%s_%s_subset%d" % (
+          os.path.basename(prefix),
+          hashlib.md5(prefix.encode("utf-8")).hexdigest()[:8], subset_size))
+  subset_src_file = "%s.%s" % (subset_prefix, src)
+  subset_tgt_file = "%s.%s" % (subset_prefix, tgt)
+  if tf.gfile.Exists(subset_src_file) and tf.gfile.Exists(subset_tgt_file):
+    return subset_prefix
+
+  lines = []
+  for suffix in (src, tgt):
+    with codecs.getreader("utf-8")(
+        utils.open_file(utils.get_data_file(prefix, suffix), "rb")) as f:
+      lines.append(f.read().splitlines())
+  src_lines, tgt_lines = lines
+
+  rng = random.Random(random_seed)
+  by_length = sorted(range(len(src_lines)),
+                     key=lambda i: len(src_lines[i].split()))
+  subset_size = min(subset_size, len(by_length))
+  indices = []
+  for stratum in range(subset_size):
+    start = stratum * len(by_length) // subset_size
+    end = (stratum + 1) * len(by_length) // subset_size
+    indices.append(by_length[rng.randrange(start, end)])
+  indices.sort()
+
+  for filename, side_lines in ((subset_src_file, src_lines),
+                               (subset_tgt_file, tgt_lines)):
+    with codecs.getwriter("utf-8")(tf.gfile.GFile(filename, "wb")) as f:
+      for i in indices:
+        f.write(side_lines[i] + "\n")
+  utils.print_out("# Created %d sentence eval subset %s of %s" %
+                  (subset_size, subset_prefix, prefix))
+  return subset_prefix
+
+
 # nmt_outputs:[beam_width, batch, time]
 def get_translation(nmt_outputs, sent_id, tgt_eos, subword_option):
   """Given batch decoding outputs, select a sentence and turn to text."""
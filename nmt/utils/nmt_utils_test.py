@@ -0,0 +1,101 @@
+# Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tests for nmt_utils."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import codecs
+import os
+
+import tensorflow as tf
+
+from ..utils import nmt_utils
+
+
+def _write_lines(filename, lines):
+  with codecs.getwriter("utf-8")(tf.gfile.GFile(filename, "wb")) as f:
+    for line in lines:
+      f.write(line + "\n")
+
+
+def _read_lines(filename):
+  with codecs.getreader("utf-8")(tf.gfile.GFile(filename, "rb")) as f:
+    return f.read().splitlines()
+
+
+class NmtUtilsTest(tf.test.TestCase):
+
+  def testPackEvalSets(self):
+    src_data = [["a b c", "a"], ["a b c d", "a b", ""], ["a b c"]]
+    packed_src_data, order = nmt_utils.pack_eval_sets(src_data)
+
+    self.assertEqual(["", "a", "a b", "a b c", "a b c", "a b c d"],
+                     packed_src_data)
+    self.assertEqual(sorted((set_id, i) for set_id in range(3)
+                            for i in range(len(src_data[set_id]))),
+                     sorted(order))
+    # Each packed sentence maps back to its place in its set.
+    for sentence, (set_id, i) in zip(packed_src_data, order):
+      self.assertEqual(src_data[set_id][i], sentence)
+
+  def _writeEvalSet(self, prefix, lengths):
+    """Write an eval set whose i-th source line has lengths[i] words."""
+    tf.gfile.MakeDirs(os.path.dirname(prefix))
+    _write_lines(prefix + ".en", [" ".join(["w%d" % n] * n) for n in lengths])
+    _write_lines(prefix + ".vi", ["t%d" % n for n in lengths])
+
+  def testGetEvalSubset(self):
+    test_dir = os.path.join(tf.test.get_temp_dir(), "eval_subset")
+    out_dir = os.path.join(test_dir, "out")
+    tf.gfile.MakeDirs(out_dir)
+    prefix = os.path.join(test_dir, "a", "dev")
+    # Source lengths 1 to 20 in a scrambled order.
+    lengths = [(7 * i) % 20 + 1 for i in range(20)]
+    self._writeEvalSet(prefix, lengths)
+
+    subset_prefix = nmt_utils.get_eval_subset(
+        prefix, "en", "vi", 4, out_dir, random_seed=1)
+    src_lines = _read_lines(subset_prefix + ".en")
+    tgt_lines = _read_lines(subset_prefix + ".vi")
+
+    # One pair from each fifth of the lengths, in the order of the full set,
+    # with its own target line.
+    subset_lengths = [len(line.split()) for line in src_lines]
+    self.assertEqual([0, 1, 2, 3],
+                     sorted((n - 1) // 5 for n in subset_lengths))
+    self.assertEqual(
+        [n for n in lengths if n in subset_lengths], subset_lengths)
+    self.assertEqual(["t%d" % n for n in subset_lengths], tgt_lines)
+
+    # Later calls reuse the cached subset, whatever their seed.
+    self.assertEqual(subset_prefix, nmt_utils.get_eval_subset(
+        prefix, "en", "vi", 4, out_dir, random_seed=2))
+    self.assertEqual(src_lines, _read_lines(subset_prefix + ".en"))
+
+    # A set with the same file name in another directory is not mistaken
+    # for the cached one.
+    other_prefix = os.path.join(test_dir, "b", "dev")
+    self._writeEvalSet(other_prefix, [30] * 10)
+    other_subset_prefix = nmt_utils.get_eval_subset(
+        other_prefix, "en", "vi", 4, out_dir, random_seed=1)
+    self.assertNotEqual(subset_prefix, other_subset_prefix)
+    self.assertEqual(["t30"] * 4, _read_lines(other_subset_prefix + ".vi"))
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -28,6 +28,9 @@ def create_standard_hparams():
       src="",
       tgt="",
       train_prefix="",
+      train_manifest="",
+      num_parallel_reads=4,
+      train_mixture="",
       dev_prefix="",
       test_prefix="",
       vocab_prefix="",
@@ -36,12 +39,15 @@ def create_standard_hparams():
 
       # Networks
       num_units=512,
+      embed_dim=0,
       num_layers=2,
       num_encoder_layers=2,
       num_decoder_layers=2,
       dropout=0.2,
       unit_type="lstm",
       encoder_type="bi",
+      num_attention_heads=4,
+      transformer_ffn_units=0,
       residual=False,
       time_major=True,
       num_embeddings_partitions=0,
@@ -58,6 +64,9 @@ def create_standard_hparams():
       init_op="uniform",
       init_weight=0.1,
       max_gradient_norm=5.0,
+      output_projection_rank=0,
+      num_sampled_softmax=0,
+      loss_chunk_size=0,
       learning_rate=1.0,
       warmup_steps=0,
       warmup_scheme="t2t",
@@ -68,6 +77,12 @@ def create_standard_hparams():
       # Data constraints
       num_buckets=5,
       max_train=0,
+      repeat_train_data=False,
+      steps_per_epoch=0,
+      input_memory_budget_mb=0,
+      batch_first_preprocessing=False,
+      lazy_graph_build=False,
+      cache_graphs=False,
       src_max_len=50,
       tgt_max_len=50,
       src_max_len_infer=0,
@@ -81,11 +96,13 @@ def create_standard_hparams():
 
       # Misc
       forget_bias=1.0,
+      use_fused_rnn=False,
       num_gpus=1,
       epoch_step=0,  # record where we were within an epoch.
       steps_per_stats=100,
       steps_per_external_eval=0,
       share_vocab=False,
+      tie_embeddings=False,
       metrics=["bleu"],
       log_device_placement=False,
       random_seed=None,
@@ -95,10 +112,17 @@ def create_standard_hparams():
       override_loaded_hparams=True,
       num_keep_ckpts=5,
       avg_ckpts=False,
+      eval_time_fraction=0.0,
+      eval_sets="",
+      eval_subset_size=0,
+      full_eval_every=10,
+      best_metric_source="full",
 
       # For inference
       inference_indices=None,
       infer_batch_size=32,
+      eval_batch_size=0,
+      eval_batch_tokens=0,
       sampling_temperature=0.0,
       num_translations_per_input=1,
   )
@@ -20,6 +20,7 @@ from __future__ import division
 from __future__ import print_function
 
 import codecs
+import collections
 import os
 import tensorflow as tf
 
@@ -76,6 +77,43 @@ def check_vocab(vocab_file, out_dir, check_special_token=True, sos=None,
   return vocab_size, vocab_file
 
 
+def count_words(corpus_file):
+  """Count the space-separated words of a (possibly compressed) corpus."""
+  counts = collections.Counter()
+  with codecs.getreader("utf-8")(
+      utils.open_file(corpus_file, mode="rb")) as f:
+    for line in f:
+      counts.update(line.split())
+  return counts
+
+
+def select_vocab_by_frequency(vocab, counts, vocab_size,
+                              num_special_tokens=3):
+  """Select the vocab_size most frequent words of vocab.
+
+  The first num_special_tokens words (unk, sos and eos) are always kept at
+  ids 0 to num_special_tokens - 1. The other words follow by decreasing
+  count, ties kept in their vocab order, so that the new vocab is sorted by
+  frequency.
+
+  Args:
+    vocab: A list of words, as returned by load_vocab.
+    counts: A dict of word counts, e.g. from count_words.
+    vocab_size: Number of words to keep, special tokens included.
+    num_special_tokens: Number of leading words that are always kept.
+
+  Returns:
+    A list of the ids in vocab of the kept words, in their new order.
+  """
+  if not num_special_tokens <= vocab_size:
+    raise ValueError("vocab_size %d should keep the %d special tokens" %
+                     (vocab_size, num_special_tokens))
+  word_ids = sorted(range(num_special_tokens, len(vocab)),
+                    key=lambda i: (-counts.get(vocab[i], 0), i))
+  return (list(range(num_special_tokens)) +
+          word_ids[:vocab_size - num_special_tokens])
+
+
 def create_vocab_tables(src_vocab_file, tgt_vocab_file, share_vocab):
   """Creates vocab tables for src_vocab_file and tgt_vocab_file."""
   # Map(word -> id)
@@ -52,6 +52,21 @@ class VocabUtilsTest(tf.test.TestCase):
     self.assertEqual(
         [vocab_utils.UNK, vocab_utils.SOS, vocab_utils.EOS] + vocab, new_vocab)
 
+  def testSelectVocabByFrequency(self):
+    vocab = [vocab_utils.UNK, vocab_utils.SOS, vocab_utils.EOS,
+             "a", "b", "c", "d"]
+    counts = {"a": 1, "b": 5, "d": 1, vocab_utils.EOS: 100}
+
+    # Special tokens first, then by count, ties in vocab order.
+    self.assertEqual(
+        [0, 1, 2, 4, 3], vocab_utils.select_vocab_by_frequency(
+            vocab, counts, 5))
+    self.assertEqual(
+        [0, 1, 2, 4, 3, 6, 5], vocab_utils.select_vocab_by_frequency(
+            vocab, counts, 10))
+    with self.assertRaises(ValueError):
+      vocab_utils.select_vocab_by_frequency(vocab, counts, 2)
+
 
 if __name__ == "__main__":
   tf.test.main()